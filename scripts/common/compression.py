@@ -0,0 +1,246 @@
+# Streaming gzip and zstd for the CSV files passed between stages. The codec of a file being written
+# comes from its extension (.csv.gz, .csv.zst); a file being read is recognised by its first bytes,
+# so a compressed object is read correctly whatever it is called. Data is compressed and decompressed
+# chunk by chunk, so neither side of a conversion is ever held whole. gzip only needs the standard
+# library; zstd needs the zstandard package, imported the first time a zstd file is met.
+import io
+import itertools
+import zlib
+
+CODEC_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+MAGIC_BYTES = {
+    'gzip': b'\x1f\x8b',
+    'zstd': b'\x28\xb5\x2f\xfd',
+}
+# Enough leading bytes to recognise every codec
+MAGIC_LENGTH = max(len(magic) for magic in MAGIC_BYTES.values())
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'zstd': 3,
+}
+# zlib window bits for a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+READ_CHUNK_SIZE = 1024 * 1024
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd files need the zstandard package (pip install zstandard)")
+    return zstandard
+
+def check_codec(codec):
+    """Normalise a codec setting: '' or None for plain files, otherwise 'gzip' or 'zstd'"""
+    if not codec:
+        return None
+    if codec not in CODEC_EXTENSIONS:
+        raise ValueError(f"Unknown compression codec {codec!r}, expected one of {sorted(CODEC_EXTENSIONS)}")
+    return codec
+
+def codec_from_path(path):
+    """Codec named by a path's extension, or None for a plain file"""
+    for codec, extension in CODEC_EXTENSIONS.items():
+        if path.endswith(extension):
+            return codec
+    return None
+
+def codec_from_bytes(head):
+    """Codec recognised from the first bytes of a file, or None for a plain file"""
+    for codec, magic in MAGIC_BYTES.items():
+        if bytes(head[:len(magic)]) == magic:
+            return codec
+    return None
+
+def with_codec(path, codec):
+    """Path with the codec's extension appended"""
+    codec = check_codec(codec)
+    return f"{path}{CODEC_EXTENSIONS[codec]}" if codec else path
+
+def without_codec(path):
+    """Path with any codec extension removed (orders.csv.gz -> orders.csv)"""
+    codec = codec_from_path(path)
+    return path[:-len(CODEC_EXTENSIONS[codec])] if codec else path
+
+class _Plain:
+    """Compressor and decompressor interface for files stored as they are"""
+
+    eof = False
+    unused_data = b''
+
+    def compress(self, data):
+        return bytes(data)
+
+    decompress = compress
+
+    def flush(self):
+        return b''
+
+def compressor(codec, level=None):
+    """Object whose compress(data) and flush() return the compressed stream piece by piece"""
+    codec = check_codec(codec)
+    if codec is None:
+        return _Plain()
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return _zstandard().ZstdCompressor(level=level).compressobj()
+
+def decompressor(codec):
+    codec = check_codec(codec)
+    if codec is None:
+        return _Plain()
+    if codec == 'gzip':
+        return zlib.decompressobj(GZIP_WBITS)
+    return _zstandard().ZstdDecompressor().decompressobj()
+
+def compress_chunks(chunks, codec, level=None):
+    """Yield the compressed bytes of a stream of chunks"""
+    stream = compressor(codec, level)
+    for chunk in chunks:
+        data = stream.compress(chunk)
+        if data:
+            yield data
+    data = stream.flush()
+    if data:
+        yield data
+
+def decompress_chunks(chunks, codec=None):
+    """Yield the decompressed bytes of a stream of chunks, recognising the codec when not given.
+
+    Concatenated gzip members or zstd frames (several compressed files appended to each other)
+    are decompressed one after the other, as gunzip and zstd -d do.
+    """
+    chunks = iter(chunks)
+    head = b''
+    if codec is None:
+        # Collect enough bytes to look for a magic number
+        for chunk in chunks:
+            head += bytes(chunk)
+            if len(head) >= MAGIC_LENGTH:
+                break
+        codec = codec_from_bytes(head)
+    codec = check_codec(codec)
+    if codec is None:
+        if head:
+            yield head
+        for chunk in chunks:
+            yield chunk
+        return
+
+    stream, fed = decompressor(codec), False
+    for chunk in itertools.chain([head] if head else [], chunks):
+        while chunk:
+            data = stream.decompress(chunk)
+            fed = True
+            if data:
+                yield data
+            chunk = b''
+            if stream.eof:
+                # The next member or frame starts in the bytes left over
+                chunk = stream.unused_data
+                stream, fed = decompressor(codec), False
+    if fed:
+        raise EOFError(f"{codec} stream ended before its end marker")
+
+class _ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.leftover:
+            self.leftover = next(self.chunks, None)
+            if self.leftover is None:
+                self.leftover = b''
+                return 0
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        return size
+
+def iter_stream(stream, chunk_size=READ_CHUNK_SIZE):
+    """Chunks of a readable binary stream (a file or an S3 body)"""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def open_decompressed(stream, codec=None):
+    """Buffered binary reader returning the decompressed content of a stream (plain streams pass through)"""
+    return io.BufferedReader(_ChunkReader(decompress_chunks(iter_stream(stream), codec)), READ_CHUNK_SIZE)
+
+class CompressedWriter(io.RawIOBase):
+    """Writable binary file object compressing into another writable object (a file or an upload).
+
+    close() writes the end of the compressed stream but leaves the target open.
+    """
+
+    def __init__(self, target, codec, level=None):
+        self.target = target
+        self.stream = compressor(codec, level)
+        self.bytes_in = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        compressed = self.stream.compress(data)
+        if compressed:
+            self.target.write(compressed)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            tail = self.stream.flush()
+            if tail:
+                self.target.write(tail)
+        super().close()
+
+def file_codec(path):
+    """Codec of a local file from its first bytes, falling back to its extension when it is empty"""
+    with open(path, 'rb') as f:
+        head = f.read(MAGIC_LENGTH)
+    return codec_from_bytes(head) if head else codec_from_path(path)
+
+def pandas_compression(source):
+    """compression= argument for pd.read_csv of a path or bytes, from the content where it can be seen"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return codec_from_bytes(source[:MAGIC_LENGTH])
+    if isinstance(source, str):
+        if source.startswith('s3://'):
+            return codec_from_path(source)
+        return file_codec(source)
+    return 'infer'
+
+class _CountingWriter:
+    """Pass writes on to a file object, counting the bytes"""
+
+    def __init__(self, target):
+        self.target = target
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.target.write(data)
+
+def write_csv(df, target, codec=None, level=None):
+    """Write a dataframe as CSV into a binary file object, compressing on the fly; returns the bytes written"""
+    counter = _CountingWriter(target)
+    compressed = CompressedWriter(counter, codec, level)
+    text = io.TextIOWrapper(compressed, encoding='utf-8', newline='', write_through=True)
+    df.to_csv(text, index=False)
+    text.flush()
+    # Keep the wrapper from closing the compressed stream before its end is written
+    text.detach()
+    compressed.close()
+    return counter.bytes_written
@@ -0,0 +1,169 @@
+# Date-partitioned datasets of transformed rows, shared by the transform and compute stages. A dataset
+# is a folder (or s3:// prefix, always given with a trailing '/') holding Hive-style
+# order_date=YYYY-MM-DD/ folders with one file per batch written into that date, plus an _index.json
+# listing every file with its row count, size and write time. Readers go through the index, so a date
+# range only touches the partitions in it and files left over from earlier writes are never read.
+import json
+import os
+import re
+import time
+
+import boto3
+
+PARTITION_COLUMN = 'order_date'
+# Partition of rows without an order_date, named as Hive names it
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+INDEX_NAME = '_index.json'
+# File format of the partitions: parquet or csv
+PARTITION_FORMAT = os.environ.get("PARTITION_FORMAT", "parquet")
+# Bump when the index layout changes; format 1 indexes (one file per partition) are converted on read
+INDEX_FORMAT = 2
+# Writers of one dataset on S3 update its index with conditional writes, retried this many times
+INDEX_WRITE_ATTEMPTS = int(os.environ.get("INDEX_WRITE_ATTEMPTS", "10"))
+
+s3_client = boto3.client('s3')
+
+def is_s3_path(path):
+    """Check if the path is an S3 path"""
+    return path.startswith('s3://')
+
+def parse_s3_path(s3_path):
+    """Extract bucket and key from S3 path"""
+    path = s3_path.replace('s3://', '')
+    bucket = path.split('/')[0]
+    key = '/'.join(path.split('/')[1:])
+    return bucket, key
+
+def is_dataset_path(path):
+    """A path ending in '/' names a partitioned dataset instead of a single file"""
+    return path.endswith('/')
+
+def partition_value(value):
+    """Folder value of one order_date: YYYY-MM-DD, or the default partition for missing dates"""
+    if value is None or value != value:
+        return DEFAULT_PARTITION
+    return str(value)
+
+def partition_file(value, file_format=None, batch=''):
+    """Location of a batch's file in a partition, relative to the dataset"""
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', batch) if batch else '0000'
+    return f"{PARTITION_COLUMN}={value}/part-{name}.{file_format or PARTITION_FORMAT}"
+
+def location(dataset, relative_path):
+    return f"{dataset.rstrip('/')}/{relative_path}"
+
+def split_partitions(df):
+    """Yield (partition value, rows) for every order_date present in a dataframe"""
+    for value, rows in df.groupby(PARTITION_COLUMN, observed=True, dropna=False, sort=True):
+        if hasattr(rows[PARTITION_COLUMN], 'cat'):
+            rows = rows.assign(**{PARTITION_COLUMN: rows[PARTITION_COLUMN].cat.remove_unused_categories()})
+        yield partition_value(value), rows
+
+def empty_index():
+    return {'format': INDEX_FORMAT, 'partition_column': PARTITION_COLUMN, 'partitions': {}}
+
+def upgrade_index(index, index_path):
+    """Convert an index written by an earlier version: its one file per partition becomes the
+    file of the unnamed batch"""
+    if index.get('format') == 1:
+        index['partitions'] = {value: {'files': {'': entry}, 'rows': entry['rows'], 'bytes': entry['bytes']}
+                               for value, entry in index['partitions'].items()}
+        index['format'] = INDEX_FORMAT
+    if index.get('format') != INDEX_FORMAT:
+        raise ValueError(f"{index_path} has index format {index.get('format')}, expected {INDEX_FORMAT}")
+    return index
+
+def read_index_version(dataset):
+    """The dataset's partition index and the ETag it was read at (None locally), or (None, None)
+    if the dataset has not been written"""
+    index_path = location(dataset, INDEX_NAME)
+    try:
+        if is_s3_path(index_path):
+            bucket, key = parse_s3_path(index_path)
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+            return upgrade_index(json.loads(response['Body'].read()), index_path), response['ETag']
+        with open(index_path) as f:
+            return upgrade_index(json.load(f), index_path), None
+    except (s3_client.exceptions.NoSuchKey, FileNotFoundError):
+        return None, None
+
+def read_index(dataset):
+    """The dataset's partition index, or None if the dataset has not been written"""
+    return read_index_version(dataset)[0]
+
+def is_conflict(error):
+    """A conditional write lost to another writer of the same index"""
+    return error.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict',
+                                                           'NoSuchKey')
+
+def write_index(index, dataset, etag=None, exists=True):
+    """Write the index; on S3, only over the version read at `etag` (or only if there is none yet,
+    when exists is False). Returns False when another writer changed it first."""
+    index_path = location(dataset, INDEX_NAME)
+    body = json.dumps(index, sort_keys=True, indent=1)
+    if is_s3_path(index_path):
+        bucket, key = parse_s3_path(index_path)
+        condition = {'IfMatch': etag} if etag else {} if exists else {'IfNoneMatch': '*'}
+        try:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/json',
+                                 **condition)
+        except s3_client.exceptions.ClientError as error:
+            if is_conflict(error):
+                return False
+            raise
+        return True
+    os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+    partial = f"{index_path}.{os.getpid()}.tmp"
+    with open(partial, 'w') as f:
+        f.write(body)
+    os.replace(partial, index_path)
+    return True
+
+def update_index(dataset, apply):
+    """Read the index, apply(index) to it and write it back.
+
+    Several runs may write into one dataset at once. On S3 the write is conditional on the ETag
+    that was read, and repeated on the newer index when another run wrote it first, so no run's
+    files drop out of the index. Local datasets have a single writer.
+    """
+    for _ in range(INDEX_WRITE_ATTEMPTS):
+        index, etag = read_index_version(dataset)
+        exists = index is not None
+        index = index or empty_index()
+        apply(index)
+        if write_index(index, dataset, etag, exists):
+            return index
+        time.sleep(0.1)
+    raise RuntimeError(f"Could not update the index of {dataset} after {INDEX_WRITE_ATTEMPTS} conflicting writes")
+
+def record_partition(index, value, relative_path, rows, size, batch=''):
+    """Point the index at a batch's freshly written file in a partition, replacing the batch's
+    earlier file there"""
+    partition = index['partitions'].setdefault(value, {'files': {}})
+    partition['files'][batch] = {
+        'path': relative_path,
+        'rows': int(rows),
+        'bytes': int(size),
+        'written_at': time.time(),
+    }
+    partition['rows'] = sum(entry['rows'] for entry in partition['files'].values())
+    partition['bytes'] = sum(entry['bytes'] for entry in partition['files'].values())
+
+def select_partitions(index, date_from='', date_to='', batch=None):
+    """Index entries of the files in the partitions between date_from and date_to (inclusive,
+    YYYY-MM-DD), each with its partition 'value' and 'batch'.
+
+    An empty bound leaves that side open. Rows without an order_date are only selected when
+    no range is given. With a batch, only that batch's files are selected.
+    """
+    selected = []
+    for value, partition in sorted(index['partitions'].items()):
+        if value == DEFAULT_PARTITION:
+            if date_from or date_to:
+                continue
+        elif (date_from and value < date_from) or (date_to and value > date_to):
+            continue
+        for file_batch, entry in sorted(partition['files'].items()):
+            if batch is None or file_batch == batch:
+                selected.append({'value': value, 'batch': file_batch, **entry})
+    return selected
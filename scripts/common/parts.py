@@ -0,0 +1,40 @@
+# The CSV parts a manifest lists, shared by the merge Lambda and the backfill. Only the standard
+# library is used here, so importing it needs no AWS client, region or credentials.
+import hashlib
+import json
+
+
+def iter_part_bytes(chunks, keep_header):
+    """Yield the raw bytes of a CSV part, dropping its header line unless keep_header is set"""
+    pending = b''
+    header_done = keep_header
+    last_byte = b'\n'
+    for chunk in chunks:
+        if not header_done:
+            if pending:
+                chunk = pending + chunk
+            newline = chunk.find(b'\n')
+            if newline == -1:
+                pending = chunk
+                continue
+            # Slice through a memoryview so large parts are not copied to drop one line
+            chunk = memoryview(chunk)[newline + 1:]
+            pending = b''
+            header_done = True
+        if chunk:
+            last_byte = bytes(chunk[-1:])
+            yield chunk
+    # Make sure the next part starts on its own line
+    if last_byte != b'\n':
+        yield b'\n'
+
+
+def batch_id_for(date, manifest_key, fingerprints):
+    """KPI batch id of a manifest: its date and a hash of its key and its parts' fingerprints.
+
+    A redelivered event or a retried execution folds the same parts under the same id and is
+    skipped, while a second or corrected manifest for the date (new parts, or the same parts
+    uploaded again with new content) is a new batch.
+    """
+    content = json.dumps({'manifest': manifest_key, 'parts': fingerprints}, sort_keys=True)
+    return f"{date}-{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}"
@@ -0,0 +1,157 @@
+# Declared column types for the raw and transformed pipeline files, shared by every stage.
+# Reads go through read_csv()/apply_schema() so each stage only loads the columns it uses,
+# low-cardinality strings are categoricals, ids and counts are narrow integers and timestamps
+# are parsed with one fixed format instead of per-value inference.
+import io
+
+import numpy as np
+import pandas as pd
+
+from compression import pandas_compression
+
+# Raw files use ISO timestamps with a 'T'; pandas writes transformed timestamps with a space
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+DATETIME_FORMATS = {
+    'timestamp': TIMESTAMP_FORMAT,
+    'datetime': 'ISO8601',
+}
+INTEGER_TYPES = {'int8', 'int16', 'int32', 'int64'}
+
+SCHEMAS = {
+    # Merged raw inputs
+    'orders': {
+        'order_id': 'int32',
+        'user_id': 'int32',
+        'status': 'category',
+        'gender': 'category',
+        'created_at': 'timestamp',
+        'returned_at': 'timestamp',
+        'shipped_at': 'timestamp',
+        'delivered_at': 'timestamp',
+        'num_of_item': 'int16',
+    },
+    'order_items': {
+        'id': 'int32',
+        'order_id': 'int32',
+        'user_id': 'int32',
+        'product_id': 'int32',
+        'status': 'category',
+        'created_at': 'timestamp',
+        'shipped_at': 'timestamp',
+        'delivered_at': 'timestamp',
+        'returned_at': 'timestamp',
+        'sale_price': 'float64',
+    },
+    'products': {
+        'id': 'int32',
+        'sku': 'str',
+        'cost': 'float64',
+        'category': 'category',
+        'name': 'str',
+        'brand': 'category',
+        'retail_price': 'float64',
+        'department': 'category',
+    },
+    # Transform outputs
+    'orders_transformed': {
+        'order_id': 'int32',
+        'user_id': 'int32',
+        'status': 'category',
+        'created_at': 'datetime',
+        'order_date': 'category',
+        'num_of_item': 'int16',
+        'returned_at': 'datetime',
+        'transformed_at': 'category',
+    },
+    'order_items_transformed': {
+        'order_id': 'int32',
+        'user_id': 'int32',
+        'product_id': 'int32',
+        'status': 'category',
+        'created_at': 'datetime',
+        'order_date': 'category',
+        # Kept at full precision so revenue sums are unchanged
+        'sale_price': 'float64',
+        'category': 'category',
+        'returned_at': 'datetime',
+        'transformed_at': 'category',
+    },
+}
+
+def detect_schema(columns):
+    """Name of the schema matching a file's header, or None"""
+    columns = {str(col).lower().replace(' ', '_') for col in columns}
+    if {'product_id', 'sale_price'} <= columns:
+        return 'order_items_transformed' if 'order_date' in columns else 'order_items'
+    if 'num_of_item' in columns:
+        return 'orders_transformed' if 'order_date' in columns else 'orders'
+    if 'sku' in columns:
+        return 'products'
+    return None
+
+def csv_options(schema, columns=None, strict=True):
+    """pd.read_csv arguments for a schema: column projection plus the dtypes the parser can apply.
+
+    Integers are parsed as int64 and narrowed afterwards (the parser would silently wrap values
+    that overflow a narrow type). With strict=False only categorical and string columns are typed,
+    so files that still have to be validated load whatever they contain.
+    """
+    types = SCHEMAS[schema]
+    wanted = set(types if columns is None else columns)
+    parser_types = ('category', 'str') if not strict else ('category', 'str', 'float64')
+    return {
+        'usecols': lambda column: column in wanted,
+        'dtype': {column: kind for column, kind in types.items() if column in wanted and kind in parser_types},
+    }
+
+def narrow_integers(series, dtype):
+    """Downcast an integer column when every value fits, otherwise keep it as read"""
+    if series.dtype.kind not in 'iu' or series.dtype == dtype:
+        return series
+    info = np.iinfo(dtype)
+    if len(series) and (series.min() < info.min or series.max() > info.max):
+        return series
+    return series.astype(dtype)
+
+def apply_schema(df, schema):
+    """Convert a dataframe's columns to the declared types, leaving columns already typed alone"""
+    for column, kind in SCHEMAS[schema].items():
+        if column not in df.columns:
+            continue
+        series = df[column]
+        if kind in DATETIME_FORMATS:
+            if not pd.api.types.is_datetime64_any_dtype(series):
+                df[column] = pd.to_datetime(series, format=DATETIME_FORMATS[kind], errors='coerce')
+        elif kind in INTEGER_TYPES:
+            df[column] = narrow_integers(series, kind)
+        elif kind == 'category':
+            if not isinstance(series.dtype, pd.CategoricalDtype):
+                df[column] = series.astype('category')
+        elif kind == 'float64' and series.dtype != kind:
+            df[column] = series.astype(kind)
+    return df
+
+def read_csv(source, schema=None, columns=None, strict=True, chunksize=None):
+    """Read a CSV (path or bytes) with a declared schema.
+
+    The schema is detected from the header when not given; files matching no schema are read
+    as-is. columns restricts the read to the columns a stage uses, either as a list or as a dict
+    of lists keyed by schema name. With strict=False the values are not converted (see
+    csv_options). With chunksize an iterator of dataframes is returned. gzip and zstd files are
+    decompressed as they are parsed.
+    """
+    open_source = (lambda: io.BytesIO(source)) if isinstance(source, (bytes, bytearray)) else (lambda: source)
+    compression = pandas_compression(source)
+    if schema is None:
+        schema = detect_schema(pd.read_csv(open_source(), nrows=0, compression=compression).columns)
+    if isinstance(columns, dict):
+        columns = columns.get(schema)
+    if schema is None:
+        return pd.read_csv(open_source(), usecols=columns, chunksize=chunksize, compression=compression)
+
+    options = csv_options(schema, columns, strict)
+    if chunksize:
+        chunks = pd.read_csv(open_source(), chunksize=chunksize, compression=compression, **options)
+        return chunks if not strict else (apply_schema(chunk, schema) for chunk in chunks)
+    df = pd.read_csv(open_source(), compression=compression, **options)
+    return apply_schema(df, schema) if strict else df
@@ -0,0 +1,227 @@
+# Content-addressed cache of stage results, shared by the containers and Lambdas. A stage's cache
+# key is a hash of its input fingerprints (S3 ETag and size, or the content hash of a local file),
+# the settings that change its output and the source of the code that produces it. A successful
+# run copies its outputs into the cache next to its result. When a later run has the same key, the
+# stage copies the outputs back into place and reports the stored result without redoing the work.
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import boto3
+
+from telemetry import annotate
+
+logger = logging.getLogger(__name__)
+
+# Local folder or s3:// prefix holding the cache; empty disables it
+STAGE_CACHE_PATH = os.environ.get("STAGE_CACHE_PATH", "")
+# Entries older than this are misses, and expire_entries() deletes them
+STAGE_CACHE_TTL_DAYS = float(os.environ.get("STAGE_CACHE_TTL_DAYS", "7"))
+# Bump when the entry layout changes so older entries are never read
+CACHE_FORMAT = 1
+ENTRY_NAME = 'entry.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+# DeleteObjects takes at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+s3_client = boto3.client('s3')
+
+def is_s3_path(path):
+    """Check if the path is an S3 path"""
+    return path.startswith('s3://')
+
+def parse_s3_path(s3_path):
+    """Extract bucket and key from S3 path"""
+    path = s3_path.replace('s3://', '')
+    bucket = path.split('/')[0]
+    key = '/'.join(path.split('/')[1:])
+    return bucket, key
+
+def is_missing(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+def fingerprint(path):
+    """ETag and size of an S3 object, or the SHA-256 of a local file; None if it does not exist"""
+    if is_s3_path(path):
+        bucket, key = parse_s3_path(path)
+        try:
+            head = s3_client.head_object(Bucket=bucket, Key=key)
+        except s3_client.exceptions.ClientError as error:
+            if is_missing(error):
+                return None
+            raise
+        etag = head['ETag'].strip('"')
+        return f"{etag}-{head['ContentLength']}"
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+def input_fingerprints(inputs):
+    """Fingerprint of each input path, keyed like inputs; optional inputs given as None are left out"""
+    if not STAGE_CACHE_PATH:
+        # Nothing will be looked up, so skip the HEAD requests and local file hashing
+        return {}
+    return {name: fingerprint(path) for name, path in inputs.items() if path}
+
+def code_version(files):
+    """Hash of the source files whose code decides a stage's output"""
+    digest = hashlib.sha256()
+    for path in files:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def stage_key(stage, fingerprints, params=None, code=()):
+    """Cache key for one run of a stage, or None when the cache is off or an input is missing.
+
+    fingerprints maps input name to fingerprint (see input_fingerprints), params holds the
+    settings that change the output and code lists the source files that produce it.
+    """
+    if not STAGE_CACHE_PATH:
+        return None
+    if any(value is None for value in fingerprints.values()):
+        return None
+    content = {
+        'format': CACHE_FORMAT,
+        'stage': stage,
+        'inputs': fingerprints,
+        'params': params or {},
+        'code': code_version(code),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+def entry_location(stage, key, name=ENTRY_NAME):
+    """Location of a cache entry's document or of one of its stored outputs"""
+    return f"{STAGE_CACHE_PATH.rstrip('/')}/{stage}/{key}/{name}"
+
+def copy_file(source, destination):
+    """Copy between any two local paths or S3 locations"""
+    if is_s3_path(destination):
+        bucket, key = parse_s3_path(destination)
+        if is_s3_path(source):
+            source_bucket, source_key = parse_s3_path(source)
+            # Managed copy, so objects over 5 GB are copied in parts
+            s3_client.copy({'Bucket': source_bucket, 'Key': source_key}, bucket, key)
+        else:
+            s3_client.upload_file(source, bucket, key)
+        return
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    if is_s3_path(source):
+        bucket, key = parse_s3_path(source)
+        s3_client.download_file(bucket, key, destination)
+    else:
+        shutil.copyfile(source, destination)
+
+def read_entry(location):
+    try:
+        if is_s3_path(location):
+            bucket, key = parse_s3_path(location)
+            return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        with open(location) as f:
+            return json.load(f)
+    except (s3_client.exceptions.NoSuchKey, FileNotFoundError):
+        return None
+
+def write_entry(entry, location):
+    body = json.dumps(entry)
+    if is_s3_path(location):
+        bucket, key = parse_s3_path(location)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/json')
+    else:
+        os.makedirs(os.path.dirname(location) or '.', exist_ok=True)
+        with open(location, 'w') as f:
+            f.write(body)
+
+def restore(stage, key, outputs=None):
+    """Put a cached run's outputs in place and return its result, or None on a miss.
+
+    outputs maps output name to destination path, as passed to store(), or is a function
+    building that map from the cached result, for outputs only known once the stage has run
+    (the partitions of a dataset). Outputs that still hold the cached content are not copied
+    again. Entries older than STAGE_CACHE_TTL_DAYS and any error reading the cache count as misses.
+    """
+    if key is None:
+        return None
+    try:
+        entry = read_entry(entry_location(stage, key))
+        if entry is None or time.time() - entry['created_at'] > STAGE_CACHE_TTL_DAYS * 86400:
+            annotate(cache='miss')
+            return None
+        outputs = outputs(entry['result']) if callable(outputs) else outputs or {}
+        if any(name not in entry['outputs'] for name in outputs):
+            annotate(cache='miss')
+            return None
+        for name, path in outputs.items():
+            cached = entry['outputs'][name]
+            if fingerprint(path) != cached['fingerprint']:
+                copy_file(entry_location(stage, key, cached['file']), path)
+    except Exception as e:
+        logger.warning(f"Could not read the {stage} cache, running the stage: {str(e)}")
+        annotate(cache='error')
+        return None
+    logger.info(f"Reusing cached {stage} result {key[:12]}")
+    annotate(cache='hit')
+    return entry['result']
+
+def store(stage, key, result, outputs=None):
+    """Cache a successful run: copy its outputs in, then write the entry that points at them.
+
+    result must be JSON serializable. A failure to write the cache is logged and does not fail
+    the stage.
+    """
+    if key is None:
+        return
+    try:
+        entry = {'stage': stage, 'created_at': time.time(), 'result': result, 'outputs': {}}
+        for name, path in (outputs or {}).items():
+            file_name = name + os.path.splitext(path)[1]
+            copy_file(path, entry_location(stage, key, file_name))
+            entry['outputs'][name] = {'file': file_name, 'fingerprint': fingerprint(path)}
+        # The entry is written last, so a half-stored run is never read as a hit
+        write_entry(entry, entry_location(stage, key))
+    except Exception as e:
+        logger.warning(f"Could not cache the {stage} result: {str(e)}")
+
+def expire_entries(cache_path=None, ttl_days=None, now=None):
+    """Delete entries (and their stored outputs) not written for ttl_days; returns how many"""
+    cache_path = (STAGE_CACHE_PATH if cache_path is None else cache_path).rstrip('/')
+    ttl_days = STAGE_CACHE_TTL_DAYS if ttl_days is None else ttl_days
+    if not cache_path:
+        return 0
+    cutoff = (time.time() if now is None else now) - ttl_days * 86400
+
+    # Newest modification time per {stage}/{key} folder; a folder expires as a whole
+    newest = {}
+    if is_s3_path(cache_path):
+        bucket, prefix = parse_s3_path(cache_path + '/')
+        files = {}
+        for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                folder = obj['Key'][len(prefix):].rsplit('/', 1)[0]
+                files.setdefault(folder, []).append(obj['Key'])
+                newest[folder] = max(newest.get(folder, 0), obj['LastModified'].timestamp())
+        expired = [key for folder, modified in newest.items() if modified < cutoff for key in files[folder]]
+        for start in range(0, len(expired), DELETE_BATCH_SIZE):
+            s3_client.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': key} for key in expired[start:start + DELETE_BATCH_SIZE]], 'Quiet': True})
+    elif os.path.isdir(cache_path):
+        for stage in os.listdir(cache_path):
+            for key in os.listdir(os.path.join(cache_path, stage)):
+                folder = os.path.join(cache_path, stage, key)
+                newest[folder] = max((os.path.getmtime(os.path.join(folder, name)) for name in os.listdir(folder)),
+                                     default=0)
+        for folder, modified in newest.items():
+            if modified < cutoff:
+                shutil.rmtree(folder)
+    removed = sum(1 for modified in newest.values() if modified < cutoff)
+    if removed:
+        logger.info(f"Expired {removed} stage cache entries older than {ttl_days} days")
+    return removed
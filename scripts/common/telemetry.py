@@ -0,0 +1,234 @@
+# Per-stage performance telemetry shared by the containers and Lambdas. A stage records how long
+# it spent reading, parsing, processing and writing, the bytes and rows it took in and put out,
+# and its peak memory. At the end it prints them as one CloudWatch Embedded Metric Format (EMF)
+# record. When the state machine passes a TASK_TOKEN, the metrics are also sent back as the task
+# output, or the failure as the task error, and heartbeats are sent while the stage runs.
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "EcommercePipeline")
+# Set by the .waitForTaskToken states; empty when the stage is run on its own
+TASK_TOKEN = os.environ.get("TASK_TOKEN", "")
+# Seconds between SendTaskHeartbeat calls while a task is running; keep it well below the states'
+# HeartbeatSeconds. 0 sends none.
+TASK_HEARTBEAT_SECONDS = float(os.environ.get("TASK_HEARTBEAT_SECONDS", "60"))
+
+PHASES = ('read', 'parse', 'process', 'write')
+COUNTERS = ('bytes_in', 'bytes_out', 'rows_in', 'rows_out')
+UNITS = {
+    **{f'{phase}_seconds': 'Seconds' for phase in PHASES},
+    'total_seconds': 'Seconds',
+    'bytes_in': 'Bytes',
+    'bytes_out': 'Bytes',
+    'rows_in': 'Count',
+    'rows_out': 'Count',
+    'rows_per_second': 'Count/Second',
+    'peak_rss_mb': 'Megabytes',
+    # Micro-batch flushes: files folded, files rejected by validation and seconds from file arrival to KPI update
+    'files': 'Count',
+    'rejected_files': 'Count',
+    'latency_p50_seconds': 'Seconds',
+    'latency_p95_seconds': 'Seconds',
+    'latency_max_seconds': 'Seconds',
+    # Rows validation set aside in quarantine mode
+    'rows_quarantined': 'Count',
+    # Size of the merged CSV text, whatever it was compressed to
+    'merged_bytes': 'Bytes',
+}
+# Step Functions rejects a failure cause longer than this
+MAX_CAUSE_LENGTH = 32768
+
+# The stage being measured in this process, see start_stage()
+_current = None
+# Heartbeat thread of this process and the event that stops it once the task token is answered
+_heartbeat = None
+_heartbeat_stop = threading.Event()
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def file_size(path):
+    """Size in bytes of a local file or s3:// object, or None if it cannot be found"""
+    try:
+        if path.startswith('s3://'):
+            import fsspec
+            fs, fs_path = fsspec.core.url_to_fs(path)
+            return fs.size(fs_path)
+        return os.path.getsize(path)
+    except Exception:
+        return None
+
+class StageTelemetry:
+    """Durations, counters and properties collected for one stage run"""
+
+    def __init__(self, stage, marker=None, **properties):
+        self.stage = stage
+        # Status line prefix, e.g. VALIDATION for VALIDATION_SUCCESS/VALIDATION_FAILED
+        self.marker = marker or stage.upper()
+        self.properties = properties
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        # Extra metrics named in UNITS, set with record()
+        self.values = {}
+        self.started = time.perf_counter()
+        self.finished = False
+        # Metrics of the emitted record, and whether the task token has been answered
+        self.final_metrics = None
+        self.reported = False
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to a phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            if value is not None:
+                self.counts[name] += int(value)
+
+    def metrics(self):
+        total = time.perf_counter() - self.started
+        metrics = {f'{phase}_seconds': round(seconds, 4) for phase, seconds in self.seconds.items()}
+        metrics.update(self.counts)
+        metrics.update(self.values)
+        metrics['total_seconds'] = round(total, 4)
+        metrics['rows_per_second'] = round(self.counts['rows_in'] / total) if total else 0
+        metrics['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        return metrics
+
+    def emf_record(self, metrics, status):
+        """EMF document: the metrics as top-level values, declared under the Stage dimension"""
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Stage']],
+                    'Metrics': [{'Name': name, 'Unit': UNITS[name]} for name in metrics],
+                }],
+            },
+            'Stage': self.stage,
+            'status': status,
+            **self.properties,
+            **metrics,
+        }
+
+def start_stage(stage, marker=None, **properties):
+    """Start measuring a stage; later phase()/add() calls in this process record into it"""
+    global _current
+    _current = StageTelemetry(stage, marker, **properties)
+    start_heartbeat()
+    return _current
+
+def start_heartbeat():
+    """Send a task heartbeat every TASK_HEARTBEAT_SECONDS until the task token is answered.
+
+    The ECS states set HeartbeatSeconds, so a task that stopped without reporting fails after a
+    few minutes instead of at the end of TimeoutSeconds, while a long stage that is still working
+    keeps its state alive. One thread per process, however many stages it starts.
+    """
+    global _heartbeat
+    if not TASK_TOKEN or TASK_HEARTBEAT_SECONDS <= 0 or _heartbeat is not None:
+        return
+    _heartbeat = threading.Thread(target=_send_heartbeats, name='task-heartbeat', daemon=True)
+    _heartbeat.start()
+
+def _send_heartbeats():
+    import boto3
+    # A session of its own: the default session is not safe to use from several threads
+    stepfunctions = boto3.session.Session().client('stepfunctions')
+    while not _heartbeat_stop.wait(TASK_HEARTBEAT_SECONDS):
+        try:
+            stepfunctions.send_task_heartbeat(taskToken=TASK_TOKEN)
+        except Exception as e:
+            # A missed heartbeat only matters if the next ones fail too; the stage keeps running
+            print(f"Could not send a task heartbeat: {e}", file=sys.stderr, flush=True)
+
+def current():
+    return _current
+
+@contextmanager
+def phase(name):
+    """Time a block as one of PHASES for the current stage (a no-op when no stage is measured)"""
+    if _current is None:
+        yield
+        return
+    with _current.phase(name):
+        yield
+
+def add(**counts):
+    """Add to the current stage's byte and row counters"""
+    if _current is not None:
+        _current.add(**counts)
+
+def record(**values):
+    """Set extra metrics on the current stage; each name must be listed in UNITS"""
+    if _current is not None:
+        _current.values.update(values)
+
+def annotate(**properties):
+    """Attach extra properties (file type, shard index, ...) to the current stage's record"""
+    if _current is not None:
+        _current.properties.update(properties)
+
+def emit(status):
+    """Print the current stage's EMF record once and return its metrics"""
+    if _current is None or _current.finished:
+        return None
+    _current.finished = True
+    metrics = _current.final_metrics = _current.metrics()
+    print(json.dumps(_current.emf_record(metrics, status)), flush=True)
+    return metrics
+
+def finish(marker, message, output=None):
+    """Print the stage's status line (e.g. TRANSFORM_SUCCESS: ...), emit its metrics and report to Step Functions.
+
+    A marker ending in _SUCCESS reports task success with the message, metrics and any extra
+    output; anything else reports task failure with the marker as the error name.
+    """
+    print(f"{marker}: {message}")
+    success = marker.endswith('_SUCCESS')
+    metrics = emit('success' if success else 'failed')
+    if TASK_TOKEN and _current is not None and not _current.reported:
+        # Only a report that went through counts: if sending it raises, the caller's error path
+        # or the exit hook calls finish() again and reports the failure
+        report_to_step_functions(success, marker, message, _current.final_metrics, output)
+        _current.reported = True
+        _heartbeat_stop.set()
+    return metrics
+
+def report_to_step_functions(success, marker, message, metrics, output=None):
+    import boto3
+    stepfunctions = boto3.client('stepfunctions')
+    if success:
+        result = {'stage': _current.stage, 'message': message, 'metrics': metrics, **(output or {})}
+        stepfunctions.send_task_success(taskToken=TASK_TOKEN, output=json.dumps(result))
+    else:
+        stepfunctions.send_task_failure(taskToken=TASK_TOKEN, error=marker, cause=message[:MAX_CAUSE_LENGTH])
+
+def _report_unfinished():
+    """Fail the task if the process exits before a result was reported, so the state does not hang"""
+    if _current is not None and (not _current.finished or (TASK_TOKEN and not _current.reported)):
+        finish(f"{_current.marker}_FAILED", f"❌ {_current.stage} stage exited without reporting a result")
+
+atexit.register(_report_unfinished)
@@ -0,0 +1,393 @@
+import sys
+import hashlib
+import logging
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+# The stage scripts and the load Lambda sit next to this file in the image and in sibling folders
+# in the repository
+HERE = os.path.dirname(os.path.abspath(__file__))
+for stage_dir in ('validate', 'transform', 'compute'):
+    sys.path.append(os.path.join(HERE, '..', stage_dir))
+sys.path.append(os.path.join(HERE, '..', '..', 'lambda'))
+sys.path.append(os.path.join(HERE, '..', '..', 'common'))
+
+from validate_data import (ORDERS_RULES, ORDER_ITEMS_RULES, CHUNK_SIZE as VALIDATE_CHUNK_SIZE, VALIDATE_MODE,
+                           quarantine_file, validate_orders, validate_order_items)
+from transform_data import INPUT_COLUMNS, load_products_dimension, read_table, transform_orders, transform_order_items
+import compute_kpis
+from compute_kpis import (KPI_STATE_PATH, batch_partials, fold_partials, is_s3_path, kpis_from_partials,
+                          parse_s3_path, save_states, state_lock, write_table)
+from parts import batch_id_for, iter_part_bytes
+from compression import READ_CHUNK_SIZE, decompress_chunks
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+# Per-file stage logs would drown the one progress line per date
+for stage_logger in ('validate_data', 'transform_data', 'compute_kpis'):
+    logging.getLogger(stage_logger).setLevel(logging.WARNING)
+
+# Manifests as uploaded by the producers: data/<date>/manifest_<date>.json
+MANIFEST_KEY = re.compile(r'^data/(?P<date>[^/]+)/manifest_(?P=date)\.json$')
+CATEGORY_TABLE = os.environ.get("CATEGORY_TABLE", "category-Level-table")
+ORDER_TABLE = os.environ.get("ORDER_TABLE", "order-level-table")
+
+# Each merged file is read once for validation and transformation, so load the columns either one needs
+READ_COLUMNS = {
+    'orders': sorted(set(ORDERS_RULES['required_columns']) | set(INPUT_COLUMNS['orders'])),
+    'order_items': sorted(set(ORDER_ITEMS_RULES['required_columns']) | set(INPUT_COLUMNS['order_items'])),
+}
+VALIDATORS = {
+    'orders': validate_orders,
+    'order_items': validate_order_items,
+}
+
+class BackfillError(Exception):
+    """A date that cannot be processed as it is (missing parts, failed validation)"""
+
+class LocalSource:
+    """Manifests and parts laid out under a local folder exactly as in the bucket"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        return self.root
+
+    def keys(self, prefix):
+        folder = os.path.join(self.root, prefix)
+        for dirpath, _, filenames in os.walk(folder):
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+
+    def read(self, key):
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read()
+
+    def fingerprints(self, prefix, keys):
+        """MD5 and size of each file, the ETag S3 gives it when uploaded in one part; 'missing' if absent"""
+        result = {}
+        for key in keys:
+            digest, size = hashlib.md5(), 0
+            try:
+                for chunk in self.chunks(key):
+                    digest.update(chunk)
+                    size += len(chunk)
+            except BackfillError:
+                result[key] = 'missing'
+                continue
+            result[key] = f"{digest.hexdigest()}-{size}"
+        return result
+
+    def chunks(self, key):
+        try:
+            f = open(os.path.join(self.root, key), 'rb')
+        except FileNotFoundError:
+            raise BackfillError(f"{key} is listed in the manifest but missing")
+        with f:
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+class S3Source:
+    """Manifests and parts in a bucket. The client is created in each worker, unless one is given
+    (a fake for local runs, which then needs the thread executor)."""
+
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        self.client = client
+
+    def __str__(self):
+        return f"s3://{self.bucket}"
+
+    def __getstate__(self):
+        # boto3 clients cannot be pickled; each worker process makes its own
+        return {'bucket': self.bucket, 'client': None}
+
+    def s3(self):
+        if self.client is None:
+            import boto3
+            self.client = boto3.client('s3')
+        return self.client
+
+    def keys(self, prefix):
+        request = {'Bucket': self.bucket, 'Prefix': prefix}
+        while True:
+            response = self.s3().list_objects_v2(**request)
+            for entry in response.get('Contents', []):
+                yield entry['Key']
+            if not response.get('IsTruncated'):
+                break
+            request['ContinuationToken'] = response['NextContinuationToken']
+
+    def read(self, key):
+        return self.s3().get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def fingerprints(self, prefix, keys):
+        """ETag and size of each part from one listing of its folder, as the merge Lambda takes them"""
+        request, listed = {'Bucket': self.bucket, 'Prefix': prefix}, {}
+        while True:
+            response = self.s3().list_objects_v2(**request)
+            for entry in response.get('Contents', []):
+                etag = entry['ETag'].strip('"')
+                listed[entry['Key']] = f"{etag}-{entry['Size']}"
+            if not response.get('IsTruncated'):
+                break
+            request['ContinuationToken'] = response['NextContinuationToken']
+        return {key: listed.get(key, 'missing') for key in keys}
+
+    def chunks(self, key):
+        try:
+            response = self.s3().get_object(Bucket=self.bucket, Key=key)
+        except self.s3().exceptions.NoSuchKey:
+            raise BackfillError(f"{key} is listed in the manifest but missing")
+        yield from response['Body'].iter_chunks(READ_CHUNK_SIZE)
+
+def open_source(location, client=None):
+    """Source for a local folder or an s3://bucket location"""
+    if location.startswith('s3://'):
+        return S3Source(location[len('s3://'):].split('/')[0], client)
+    return LocalSource(location)
+
+def find_manifests(source, date_from='', date_to=''):
+    """Dates between date_from and date_to (inclusive, as in the data/<date>/ folders) that have a manifest"""
+    dates = []
+    for key in source.keys('data/'):
+        match = MANIFEST_KEY.match(key)
+        if match is None:
+            continue
+        date = match.group('date')
+        if (date_from and date < date_from) or (date_to and date > date_to):
+            continue
+        dates.append(date)
+    return sorted(dates)
+
+def merge_parts(source, date, file_type, part_files, merged_file):
+    """Concatenate a manifest's (possibly compressed) parts into one plain local CSV, as the merge Lambda
+    does; returns the bytes written"""
+    written = 0
+    with open(merged_file, 'wb') as out:
+        for index, part_file in enumerate(part_files):
+            chunks = source.chunks(f'data/{date}/{file_type}/{part_file}')
+            for chunk in iter_part_bytes(decompress_chunks(chunks), keep_header=index == 0):
+                out.write(chunk)
+                written += len(chunk)
+    return written
+
+def prepare_date(source, date, products_key, work_dir):
+    """Merge, validate and transform one date's manifest and reduce it to per-date partials.
+
+    Runs in a worker. The partials are folded and written by the caller, one date at a time,
+    so dates that share order_dates never write the same state concurrently.
+    """
+    start = time.perf_counter()
+    manifest_key = f'data/{date}/manifest_{date}.json'
+    manifest = json.loads(source.read(manifest_key))
+    folder = tempfile.mkdtemp(prefix=f'backfill_{date}_', dir=work_dir)
+    try:
+        products_file = os.path.join(folder, 'products.csv')
+        with open(products_file, 'wb') as f:
+            f.write(source.read(products_key))
+
+        merged_bytes = 0
+        frames = {}
+        fingerprints = {}
+        for file_type in ('orders', 'order_items'):
+            part_files = manifest['files'].get(file_type, [])
+            if not part_files:
+                raise BackfillError(f"manifest lists no {file_type} parts")
+            prefix = f'data/{date}/{file_type}/'
+            fingerprints.update(source.fingerprints(prefix, [prefix + part_file for part_file in part_files]))
+            merged_file = os.path.join(folder, f'{file_type}_merged.csv')
+            merged_bytes += merge_parts(source, date, file_type, part_files, merged_file)
+
+            # In quarantine mode failing rows are moved out of the merged file first, so what is read next is clean
+            if VALIDATE_MODE == 'quarantine':
+                result, _ = quarantine_file(merged_file, VALIDATE_CHUNK_SIZE)
+                success, message = result if result is not None else (False, "❌ Unknown file format")
+                if not success:
+                    raise BackfillError(message)
+            df = read_table(merged_file, file_type, columns=READ_COLUMNS[file_type], strict=False)
+            if VALIDATE_MODE != 'quarantine':
+                success, message = VALIDATORS[file_type](df)
+                if not success:
+                    raise BackfillError(message)
+            frames[file_type] = df
+
+        rows = len(frames['orders']) + len(frames['order_items'])
+        orders_df, _ = transform_orders(frames['orders'])
+        order_items_df, _ = transform_order_items(frames['order_items'], load_products_dimension(products_file))
+        partials = batch_partials(order_items_df, orders_df)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return {'partials': partials, 'batch_id': batch_id_for(date, manifest_key, fingerprints), 'rows': rows,
+            'bytes': merged_bytes, 'seconds': time.perf_counter() - start}
+
+class Checkpoint:
+    """Per-date outcome of a backfill, saved after every date so a rerun skips the dates already done.
+
+    The checkpoint is a local file or an s3:// object, written the way the KPI state is, so a
+    task that stops and loses its disk resumes where it was.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dates = {}
+        if is_s3_path(path):
+            bucket, key = parse_s3_path(path)
+            try:
+                body = compute_kpis.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            except compute_kpis.s3_client.exceptions.NoSuchKey:
+                return
+            self.dates = json.loads(body)['dates']
+        elif os.path.exists(path):
+            with open(path) as f:
+                self.dates = json.load(f)['dates']
+
+    def done(self, date):
+        return self.dates.get(date, {}).get('status') == 'done'
+
+    def record(self, date, **entry):
+        self.dates[date] = {**entry, 'finished_at': datetime.now(timezone.utc).isoformat()}
+        body = json.dumps({'dates': self.dates}, indent=1, sort_keys=True)
+        if is_s3_path(self.path):
+            # A put replaces the object whole, so readers never see a truncated checkpoint
+            bucket, key = parse_s3_path(self.path)
+            compute_kpis.s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+            return
+        # Write a new file and swap it in, so a crash never leaves a truncated checkpoint
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        partial = f"{self.path}.tmp"
+        with open(partial, 'w') as f:
+            f.write(body)
+        os.replace(partial, self.path)
+
+def default_checkpoint(source_location, output_path):
+    """Where a run keeps its checkpoint without --checkpoint: next to an output on S3, in the source
+    bucket when only the source is on S3 (the task's disk goes away with it), else next to the output"""
+    if is_s3_path(output_path) or not is_s3_path(source_location):
+        return f"{output_path.rstrip('/')}/_backfill_checkpoint.json"
+    return f"s3://{parse_s3_path(source_location)[0]}/backfill/_backfill_checkpoint.json"
+
+def kpi_outputs(output_path, date):
+    return {
+        'category_kpi_file': f"{output_path.rstrip('/')}/{date}/category_kpis.csv",
+        'order_kpi_file': f"{output_path.rstrip('/')}/{date}/order_kpis.csv",
+    }
+
+def finish_date(date, prepared, output_path, state_path, load):
+    """Fold one date's partials, write its KPI files, save the state and load the tables"""
+    # Daily runs may fold into the same state while the backfill runs, so it is locked until saved
+    with state_lock(state_path):
+        if state_path:
+            # The batch id is built from the manifest and its parts as the merge Lambda builds it, so a
+            # manifest already folded by a daily run or an earlier backfill is not folded again
+            category_kpis, order_kpis, states = fold_partials(prepared['partials'], state_path,
+                                                              batch_id=prepared['batch_id'])
+        else:
+            category_kpis, order_kpis = kpis_from_partials(prepared['partials'])
+            states = {}
+        outputs = kpi_outputs(output_path, date)
+        if not output_path.startswith('s3://'):
+            os.makedirs(os.path.dirname(outputs['category_kpi_file']), exist_ok=True)
+        write_table(category_kpis, outputs['category_kpi_file'])
+        write_table(order_kpis, outputs['order_kpi_file'])
+        # Only persist the new state once the KPI rows are written, so a failed date can be run again
+        save_states(states, state_path)
+    if load:
+        from write_to_dynamodb import load_tables
+        load_tables(outputs['category_kpi_file'], outputs['order_kpi_file'], CATEGORY_TABLE, ORDER_TABLE)
+    return outputs
+
+def run_backfill(source, output_path, date_from='', date_to='', workers=2, checkpoint_path=None,
+                 state_path=None, products_key='data/products.csv', load=False, executor='process', work_dir=None):
+    """Run merge → validate → transform → compute (→ load) for every manifest in a date range.
+
+    Up to `workers` dates are prepared at once, in processes or, with executor='thread', in
+    threads (needed when the source holds an in-process client). Each finished date is recorded
+    in the checkpoint (default_checkpoint unless checkpoint_path is given), and dates already done
+    there are skipped. Returns a summary of the run.
+    """
+    state_path = KPI_STATE_PATH if state_path is None else state_path
+    checkpoint = Checkpoint(checkpoint_path or default_checkpoint(str(source), output_path))
+    dates = find_manifests(source, date_from, date_to)
+    pending = [date for date in dates if not checkpoint.done(date)]
+    logger.info(f"Backfilling {len(pending)} of {len(dates)} dates in {source} "
+                f"({len(dates) - len(pending)} already done), {workers} at a time")
+
+    start = time.perf_counter()
+    done, failed, rows = [], [], 0
+    pool_class = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+    with pool_class(max_workers=workers) as pool:
+        futures = {pool.submit(prepare_date, source, date, products_key, work_dir): date for date in pending}
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                prepared = future.result()
+                outputs = finish_date(date, prepared, output_path, state_path, load)
+            except Exception as e:
+                logger.error(f"[{len(done) + len(failed) + 1}/{len(pending)}] {date} failed: {str(e)}")
+                checkpoint.record(date, status='failed', error=str(e))
+                failed.append(date)
+                continue
+            checkpoint.record(date, status='done', rows=prepared['rows'], bytes=prepared['bytes'],
+                              seconds=round(prepared['seconds'], 3), **outputs)
+            done.append(date)
+            rows += prepared['rows']
+            elapsed = time.perf_counter() - start
+            logger.info(f"[{len(done) + len(failed)}/{len(pending)}] {date}: {prepared['rows']} rows in "
+                        f"{prepared['seconds']:.2f}s, {rows / max(elapsed, 1e-9):.0f} rows/s overall")
+
+    seconds = time.perf_counter() - start
+    summary = {
+        'dates': len(dates),
+        'done': len(done),
+        'skipped': len(dates) - len(pending),
+        'failed': sorted(failed),
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / max(seconds, 1e-9)),
+        'dates_per_minute': round(len(done) / max(seconds, 1e-9) * 60, 2),
+    }
+    logger.info(f"Backfill finished: {summary['done']} dates done, {summary['skipped']} skipped, "
+                f"{len(failed)} failed; {rows} rows in {seconds:.2f}s ({summary['rows_per_second']} rows/s, "
+                f"{summary['dates_per_minute']} dates/min)")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the pipeline over every manifest in a range of dates')
+    parser.add_argument('source', help='local folder or s3://bucket holding data/<date>/manifest_<date>.json')
+    parser.add_argument('--from', dest='date_from', default='', help='first date folder, e.g. 20250401')
+    parser.add_argument('--to', dest='date_to', default='', help='last date folder (inclusive)')
+    parser.add_argument('--output', required=True, help='folder or s3:// prefix for <date>/*_kpis.csv')
+    parser.add_argument('--workers', type=int, default=2, help='dates prepared at the same time')
+    parser.add_argument('--checkpoint', help='checkpoint file or s3:// object (default <output>/_backfill_checkpoint.json, '
+                                             'or s3://<bucket>/backfill/ for an S3 source with a local output)')
+    parser.add_argument('--state-path', help='KPI state to fold into (default KPI_STATE_PATH, empty for none)')
+    parser.add_argument('--products', default='data/products.csv', help='products key in the source')
+    parser.add_argument('--load', action='store_true', help='load each date into CATEGORY_TABLE and ORDER_TABLE')
+    parser.add_argument('--executor', choices=['process', 'thread'], default='process')
+    parser.add_argument('--work-dir', help='local folder for the merged files (default the system temp folder)')
+    args = parser.parse_args()
+
+    summary = run_backfill(open_source(args.source), args.output, args.date_from, args.date_to, args.workers,
+                           args.checkpoint, args.state_path, args.products, args.load, args.executor, args.work_dir)
+    print(json.dumps(summary))
+    sys.exit(1 if summary['failed'] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
 import pandas as pd
+import numpy as np
 import sys
 import logging
 import os
+from contextlib import contextmanager
 from datetime import datetime, timezone
 import boto3
 import io
+import json
+import time
+import uuid
+import hyperloglog
+from hyperloglog import HyperLogLog, grouped_counts, precision_for_error
+
+# Shared modules sit next to this file in the image and in scripts/common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import schema
+from schema import apply_schema, read_csv
+from compression import codec_from_path, write_csv
+from partitions import INDEX_NAME, PARTITION_COLUMN, is_dataset_path, location, read_index, select_partitions
+from stage_cache import input_fingerprints, restore, stage_key, store
+from telemetry import add, finish, phase, start_stage
 
 # Configure logging
 logging.basicConfig(
@@ -17,10 +33,43 @@ logger = logging.getLogger(__name__)
 # Initialize S3 client
 s3_client = boto3.client('s3')
 
+# Only the columns the KPIs need are read from the transformed files
+ORDER_ITEMS_COLUMNS = ['order_date', 'category', 'sale_price', 'status', 'user_id']
+ORDERS_COLUMNS = ['order_date', 'order_id', 'num_of_item', 'status']
+
+# Incremental KPI state (local folder or s3:// prefix); empty recomputes every batch from scratch
+KPI_STATE_PATH = os.environ.get("KPI_STATE_PATH", "")
+# Identifies the batch being folded in so a retried run is not counted twice
+KPI_BATCH_ID = os.environ.get("KPI_BATCH_ID", "")
+# Runs sharing a state path fold one at a time through a lock next to the state. A lock older than
+# KPI_STATE_LOCK_TTL seconds was left by a run that died and is taken over; a run gives up after
+# waiting KPI_STATE_LOCK_WAIT seconds.
+KPI_STATE_LOCK_TTL = int(os.environ.get("KPI_STATE_LOCK_TTL", "900"))
+KPI_STATE_LOCK_WAIT = int(os.environ.get("KPI_STATE_LOCK_WAIT", "600"))
+STATE_LOCK_NAME = '_lock.json'
+STATE_LOCK_POLL_SECONDS = 2
+# Only compute the order_dates in this range (YYYY-MM-DD, inclusive; empty leaves that side open).
+# Partitioned inputs only read the partitions in the range.
+KPI_DATE_FROM = os.environ.get("KPI_DATE_FROM", "")
+KPI_DATE_TO = os.environ.get("KPI_DATE_TO", "")
+
+# 'exact' counts distinct customers/orders exactly, 'hll' uses mergeable HyperLogLog sketches
+DISTINCT_COUNT_MODE = os.environ.get("DISTINCT_COUNT_MODE", "exact")
+# Target relative standard error of the sketches (0.01 = 1%)
+HLL_ERROR = float(os.environ.get("HLL_ERROR", "0.01"))
+
+# Partial aggregates keep revenue as an exact integer number of minor units (cents for 2 decimals),
+# so partials from any number of batches or shards add up to the same total
+REVENUE_DECIMALS = int(os.environ.get("REVENUE_DECIMALS", "2"))
+
 def is_s3_path(path):
     """Check if the path is an S3 path"""
     return path.startswith('s3://')
 
+def is_parquet_path(path):
+    """Check if the path points to a Parquet file"""
+    return path.endswith('.parquet')
+
 def parse_s3_path(s3_path):
     """Extract bucket and key from S3 path"""
     path = s3_path.replace('s3://', '')
@@ -28,13 +77,16 @@ def parse_s3_path(s3_path):
     key = '/'.join(path.split('/')[1:])
     return bucket, key
 
-def read_csv_from_s3(s3_path):
+def read_csv_from_s3(s3_path, schema=None, columns=None):
     """Read CSV file from S3"""
     bucket, key = parse_s3_path(s3_path)
     try:
         logger.debug(f"Reading data from s3://{bucket}/{key}")
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        df = pd.read_csv(io.BytesIO(response['Body'].read()))
+        with phase('read'):
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        add(bytes_in=len(body))
+        with phase('parse'):
+            df = read_csv(body, schema, columns=columns)
         logger.info(f"Successfully read {len(df)} records from S3")
         return df
     except Exception as e:
@@ -46,32 +98,173 @@ def write_csv_to_s3(df, s3_path):
     bucket, key = parse_s3_path(s3_path)
     try:
         logger.debug(f"Writing {len(df)} records to s3://{bucket}/{key}")
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=csv_buffer.getvalue()
-        )
+        with phase('write'):
+            # Compressed as it is written when the key ends in .gz or .zst
+            buffer = io.BytesIO()
+            size = write_csv(df, buffer, codec_from_path(key))
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=buffer.getvalue()
+            )
+        add(bytes_out=size)
         logger.info(f"Successfully wrote data to S3")
     except Exception as e:
         logger.error(f"Failed to write to S3: {str(e)}")
         raise e
 
+def read_parquet_from_s3(s3_path, columns=None):
+    """Read Parquet file from S3"""
+    bucket, key = parse_s3_path(s3_path)
+    try:
+        logger.debug(f"Reading data from s3://{bucket}/{key}")
+        with phase('read'):
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        add(bytes_in=len(body))
+        with phase('parse'):
+            df = pd.read_parquet(io.BytesIO(body), columns=columns)
+        logger.info(f"Successfully read {len(df)} records from S3")
+        return df
+    except Exception as e:
+        logger.error(f"Failed to read from S3: {str(e)}")
+        raise e
+
+def read_table(path, schema=None, columns=None):
+    """Read a CSV or Parquet file (picked from the extension) from S3 or local disk, typed with the declared schema"""
+    if is_parquet_path(path):
+        if is_s3_path(path):
+            df = read_parquet_from_s3(path, columns=columns)
+        else:
+            add(bytes_in=os.path.getsize(path))
+            with phase('parse'):
+                df = pd.read_parquet(path, columns=columns)
+        return apply_schema(df, schema) if schema else df
+    if is_s3_path(path):
+        return read_csv_from_s3(path, schema, columns=columns)
+    add(bytes_in=os.path.getsize(path))
+    with phase('parse'):
+        return read_csv(path, schema, columns=columns)
+
+def read_partitioned(dataset, schema, columns=None, date_from='', date_to='', batch=None):
+    """Read the files of a dataset between date_from and date_to (only the batch's, if given) into one dataframe"""
+    index = read_index(dataset)
+    if index is None:
+        raise FileNotFoundError(f"No partition index in {dataset}")
+    partitions = select_partitions(index, date_from, date_to, batch)
+    logger.info(f"Reading {len(partitions)} files from {len({entry['value'] for entry in partitions})} of "
+                f"{len(index['partitions'])} partitions ({sum(entry['rows'] for entry in partitions)} rows) "
+                f"from {dataset}")
+    frames = [read_table(location(dataset, entry['path']), schema, columns=columns) for entry in partitions]
+    if not frames:
+        return apply_schema(pd.DataFrame({column: pd.Series(dtype=object) for column in columns}), schema)
+    # Each partition has its own categories, so the combined columns are typed again
+    return apply_schema(pd.concat(frames, ignore_index=True), schema)
+
+def read_input(path, schema, columns=None, date_from=None, date_to=None, batch_id=None):
+    """Read a transformed file or dataset, keeping only the order_dates in the KPI date range.
+
+    A dataset is shared by every run: without a date range only the batch's own files are
+    read, while a range reads what every batch wrote for those dates.
+    """
+    date_from = KPI_DATE_FROM if date_from is None else date_from
+    date_to = KPI_DATE_TO if date_to is None else date_to
+    batch_id = KPI_BATCH_ID if batch_id is None else batch_id
+    if is_dataset_path(path):
+        batch = None if date_from or date_to or not batch_id else batch_id
+        return read_partitioned(path, schema, columns, date_from, date_to, batch)
+    df = read_table(path, schema, columns=columns)
+    if date_from or date_to:
+        # Dates compare as YYYY-MM-DD strings; rows without one are outside any range
+        dates = df[PARTITION_COLUMN].astype(str)
+        in_range = df[PARTITION_COLUMN].notna()
+        if date_from:
+            in_range &= dates >= date_from
+        if date_to:
+            in_range &= dates <= date_to
+        df = df[in_range.to_numpy()].reset_index(drop=True)
+    return df
+
+def input_location(path):
+    """What to fingerprint for an input: a dataset's index lists (and dates) every partition"""
+    return location(path, INDEX_NAME) if is_dataset_path(path) else path
+
+def write_table(df, path):
+    """Write a dataframe as CSV to S3 or local disk"""
+    if is_s3_path(path):
+        write_csv_to_s3(df, path)
+    else:
+        with phase('write'):
+            df.to_csv(path, index=False)
+        add(bytes_out=os.path.getsize(path))
+
+def encode_column(values):
+    """Encode a key column as integer codes (-1 for missing), sorted like a groupby key"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Categoricals already hold integer codes; only unused categories and their order need fixing
+        values = values.cat.remove_unused_categories()
+        values = values.cat.reorder_categories(values.cat.categories.sort_values())
+        return values.cat.codes.to_numpy().astype(np.intp), values.cat.categories
+    return pd.factorize(values, sort=True)
+
+def encode_dates(*date_columns):
+    """Encode several order_date columns onto one shared sorted date index"""
+    encoded = [pd.factorize(column) for column in date_columns]
+    dates = pd.Index([])
+    for _, uniques in encoded:
+        # Plain values, so categorical date columns from the declared schema union like any other
+        dates = dates.union(pd.Index(np.asarray(uniques)))
+    dates = dates.sort_values()
+    # Re-map each column's codes through its (small) uniques onto the shared index
+    codes = [np.append(dates.get_indexer(np.asarray(uniques)), -1)[column_codes] for column_codes, uniques in encoded]
+    return codes, dates
+
+def returned_flags(status):
+    """Flag returned rows by comparing integer status codes instead of strings per group"""
+    codes, statuses = pd.factorize(status)
+    returned_code = np.flatnonzero(np.asarray(statuses) == 'returned')
+    if not len(returned_code):
+        return np.zeros(len(codes), dtype=bool)
+    return codes == returned_code[0]
+
+def group_sums(values, group_codes, n_groups):
+    """Per-group float sums via pandas' compensated summation, identical to groupby().sum()"""
+    sums = pd.Series(values).groupby(group_codes, sort=False).sum()
+    result = np.zeros(n_groups)
+    result[sums.index.to_numpy()] = sums.to_numpy()
+    return result
+
+def distinct_counts(group_codes, values, n_groups):
+    """Number of distinct values per group, from the unique (group, value) pairs"""
+    if DISTINCT_COUNT_MODE == 'hll':
+        return grouped_counts(group_codes, values, n_groups, precision_for_error(HLL_ERROR))
+    value_codes, uniques = pd.factorize(values)
+    keep = value_codes >= 0
+    width = max(len(uniques), 1)
+    pairs = pd.unique(group_codes[keep].astype(np.int64) * width + value_codes[keep])
+    return np.bincount(pairs // width, minlength=n_groups)
+
 def compute_category_kpis(order_items_df):
     """Compute Category-Level KPIs."""
-    df = order_items_df[['order_date', 'category', 'sale_price', 'status']]
-    grouped = df.groupby(['category', 'order_date'])
-    
+    category_codes, categories = encode_column(order_items_df['category'])
+    [date_codes], dates = encode_dates(order_items_df['order_date'])
+
+    # One integer key per (category, order_date), rows with a missing key are dropped like groupby does
+    valid = (category_codes >= 0) & (date_codes >= 0)
+    n_groups = len(categories) * len(dates)
+    group = category_codes[valid] * len(dates) + date_codes[valid]
+
+    item_counts = np.bincount(group, minlength=n_groups)
+    returned_counts = np.bincount(group, weights=returned_flags(order_items_df['status'])[valid], minlength=n_groups)
+    revenue = group_sums(order_items_df['sale_price'].to_numpy(dtype=float)[valid], group, n_groups)
+
+    present = np.flatnonzero(item_counts)
     kpis = pd.DataFrame({
-        'daily_revenue': grouped['sale_price'].sum(),
-        'avg_order_value': grouped['sale_price'].mean(),
-        'total_orders': grouped.size(),
-        'returned_orders': grouped['status'].apply(lambda x: (x == 'returned').sum())
-    }).reset_index()
-    
-    kpis['avg_return_rate'] = kpis['returned_orders'] / kpis['total_orders'] * 100
-    kpis = kpis.drop(columns=['total_orders', 'returned_orders'])
+        'category': np.asarray(categories)[present // len(dates)],
+        'order_date': np.asarray(dates)[present % len(dates)],
+        'daily_revenue': revenue[present],
+        'avg_order_value': revenue[present] / item_counts[present],
+        'avg_return_rate': returned_counts[present] / item_counts[present] * 100,
+    })
     kpis['computed_at'] = datetime.now(timezone.utc).isoformat()
     
     logger.debug("Category-level KPIs computed")
@@ -79,62 +272,484 @@ def compute_category_kpis(order_items_df):
 
 def compute_order_kpis(order_items_df, orders_df):
     """Compute Order-Level KPIs."""
-    orders_grouped = orders_df.groupby('order_date')
-    order_kpis = pd.DataFrame({
-        'total_orders': orders_grouped['order_id'].nunique(),
-        'total_items_sold': orders_grouped['num_of_item'].sum(),
-        'returned_orders': orders_grouped['status'].apply(lambda x: (x == 'returned').sum())
-    }).reset_index()
-    
-    items_grouped = order_items_df.groupby('order_date')
-    items_kpis = pd.DataFrame({
-        'total_revenue': items_grouped['sale_price'].sum(),
-        'unique_customers': items_grouped['user_id'].nunique()
-    }).reset_index()
-    
-    kpis = order_kpis.merge(items_kpis, on='order_date', how='outer').fillna(0)
-    kpis['return_rate'] = kpis['returned_orders'] / kpis['total_orders'] * 100
-    kpis = kpis.drop(columns=['returned_orders'])
+    (order_dates, item_dates), dates = encode_dates(orders_df['order_date'], order_items_df['order_date'])
+    n_dates = len(dates)
+
+    # Orders table: one pass over integer date codes
+    valid = order_dates >= 0
+    order_group = order_dates[valid]
+    order_rows = np.bincount(order_group, minlength=n_dates)
+    total_orders = distinct_counts(order_group, orders_df['order_id'].to_numpy()[valid], n_dates)
+    total_items_sold = np.bincount(order_group, weights=orders_df['num_of_item'].to_numpy()[valid],
+                                   minlength=n_dates).astype(np.int64)
+    returned_orders = np.bincount(order_group, weights=returned_flags(orders_df['status'])[valid],
+                                  minlength=n_dates).astype(np.int64)
+
+    # Order items table: one pass over the same date codes
+    valid = item_dates >= 0
+    item_group = item_dates[valid]
+    item_rows = np.bincount(item_group, minlength=n_dates)
+    total_revenue = group_sums(order_items_df['sale_price'].to_numpy(dtype=float)[valid], item_group, n_dates)
+    unique_customers = distinct_counts(item_group, order_items_df['user_id'].to_numpy()[valid], n_dates)
+
+    kpis = pd.DataFrame({
+        'order_date': np.asarray(dates),
+        'total_orders': total_orders,
+        'total_items_sold': total_items_sold,
+        'total_revenue': total_revenue,
+        'unique_customers': unique_customers,
+    })
+    # Dates seen in only one table get zeros for the other one; like the former outer merge +
+    # fillna(0), that side's integer columns become floats
+    if (order_rows == 0).any():
+        kpis[['total_orders', 'total_items_sold']] = kpis[['total_orders', 'total_items_sold']].astype(float)
+        returned_orders = returned_orders.astype(float)
+    if (item_rows == 0).any():
+        kpis['unique_customers'] = kpis['unique_customers'].astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kpis['return_rate'] = returned_orders / kpis['total_orders'].to_numpy() * 100
     kpis['computed_at'] = datetime.now(timezone.utc).isoformat()
     
     logger.debug("Order-level KPIs computed")
     return kpis
 
-def main(order_items_file, orders_file, category_output_file, order_output_file):
+def revenue_units(prices):
+    """Prices as integer minor units, rounded half to even when a price has more than REVENUE_DECIMALS decimals"""
+    scale = 10 ** REVENUE_DECIMALS
+    scaled = np.nan_to_num(np.asarray(prices, dtype=float)) * scale
+    lower = np.floor(scaled)
+    # A decimal tie such as 1.005 scales to 100.49999999999999: anything within float error of
+    # a half is a tie and goes to the even neighbour, like Decimal's ROUND_HALF_EVEN
+    tie = np.abs(scaled - lower - 0.5) <= np.abs(scaled) * 4 * np.finfo(float).eps
+    units = np.where(tie, lower + (lower % 2 == 1), np.rint(scaled))
+    return units.astype(np.int64)
+
+def units_to_amount(units):
+    """Revenue as a float from exact minor units (a single, correctly rounded division)"""
+    return units / 10 ** REVENUE_DECIMALS
+
+def distinct_set(values):
+    """Mergeable distinct-value structure: sorted distinct ids, or a serialized sketch in 'hll' mode"""
+    if DISTINCT_COUNT_MODE == 'hll':
+        return HyperLogLog.from_error(HLL_ERROR).add(np.asarray(values, dtype=np.int64)).to_dict()
+    return sorted({int(value) for value in values})
+
+def _as_sketch(values, precision):
+    if isinstance(values, dict):
+        return HyperLogLog.from_dict(values)
+    return HyperLogLog(precision).add(np.asarray(values, dtype=np.int64))
+
+def merge_distinct(left, right):
+    """Union two distinct-value structures; exact id lists are folded into a sketch if either side is one"""
+    if isinstance(left, dict) or isinstance(right, dict):
+        precision = (left if isinstance(left, dict) else right)['hll']
+        return _as_sketch(left, precision).merge(_as_sketch(right, precision)).to_dict()
+    return sorted(set(left) | set(right))
+
+def union_distinct(structures):
+    """Union any number of distinct-value structures in one pass; exact ids are sorted once, as int64"""
+    structures = list(structures)
+    if any(isinstance(values, dict) for values in structures):
+        result = distinct_set([])
+        for values in structures:
+            result = merge_distinct(result, values)
+        return result
+    ids = [np.asarray(values, dtype=np.int64) for values in structures]
+    return np.unique(np.concatenate(ids)).tolist() if ids else []
+
+def distinct_size(values):
+    """Number of distinct values held by a distinct-value structure"""
+    if isinstance(values, dict):
+        return HyperLogLog.from_dict(values).count()
+    return len(values)
+
+def empty_partial(order_date):
+    """Partial aggregates for one order_date before any batch is folded in"""
+    return {
+        'order_date': order_date,
+        'batches': [],
+        'categories': {},
+        'orders': {
+            'order_ids': distinct_set([]),
+            'items_sold': 0,
+            'returned': 0,
+            'revenue_units': 0,
+            'customers': distinct_set([]),
+        },
+    }
+
+def batch_partials(order_items_df, orders_df):
+    """Reduce a batch to mergeable partial aggregates, one document per order_date"""
+    (order_dates, item_dates), dates = encode_dates(orders_df['order_date'], order_items_df['order_date'])
+    date_names = [str(date) for date in dates]
+    partials = {name: empty_partial(name) for name in date_names}
+
+    # Per (order_date, category): revenue, item count and returned count
+    category_codes, categories = encode_column(order_items_df['category'])
+    valid = (category_codes >= 0) & (item_dates >= 0)
+    groups = pd.DataFrame({
+        'date': item_dates[valid],
+        'category': category_codes[valid],
+        'revenue': revenue_units(order_items_df['sale_price'])[valid],
+        'returned': returned_flags(order_items_df['status'])[valid],
+    }).groupby(['date', 'category'], sort=False)
+    sums = groups.agg(revenue=('revenue', 'sum'), items=('revenue', 'size'), returned=('returned', 'sum'))
+    for (date_code, category_code), row in sums.iterrows():
+        partials[date_names[date_code]]['categories'][str(categories[category_code])] = {
+            'revenue_units': int(row['revenue']),
+            'items': int(row['items']),
+            'returned': int(row['returned']),
+        }
+
+    # Per order_date: distinct orders, items sold and returned orders from the orders table. The order
+    # ids are kept so that a corrected or re-uploaded manifest, folded as a new batch, does not count
+    # its orders again
+    valid = order_dates >= 0
+    orders = pd.DataFrame({
+        'date': order_dates[valid],
+        'order_id': orders_df['order_id'].to_numpy()[valid],
+        'items_sold': orders_df['num_of_item'].to_numpy()[valid],
+        'returned': returned_flags(orders_df['status'])[valid],
+    }).groupby('date', sort=False)
+    order_sums = orders.agg(items_sold=('items_sold', 'sum'), returned=('returned', 'sum'))
+    order_ids = orders['order_id'].unique()
+    for date_code, row in order_sums.iterrows():
+        day = partials[date_names[date_code]]['orders']
+        day['order_ids'] = distinct_set(order_ids[date_code])
+        day['items_sold'] = int(row['items_sold'])
+        day['returned'] = int(row['returned'])
+
+    # Per order_date: revenue and distinct customers from every order item
+    valid = item_dates >= 0
+    items = pd.DataFrame({
+        'date': item_dates[valid],
+        'revenue': revenue_units(order_items_df['sale_price'])[valid],
+        'user_id': order_items_df['user_id'].to_numpy()[valid],
+    }).groupby('date', sort=False)
+    revenue = items['revenue'].sum()
+    item_customers = items['user_id'].unique()
+    for date_code, day_revenue in revenue.items():
+        day = partials[date_names[date_code]]['orders']
+        day['revenue_units'] = int(day_revenue)
+        day['customers'] = distinct_set(item_customers[date_code])
+    return partials
+
+def merge_partials(state, batch):
+    """Fold a batch's partial aggregates for one order_date into the stored state"""
+    for category, part in batch['categories'].items():
+        current = state['categories'].setdefault(category, {'revenue_units': 0, 'items': 0, 'returned': 0})
+        current['revenue_units'] += part['revenue_units']
+        current['items'] += part['items']
+        current['returned'] += part['returned']
+
+    day, part = state['orders'], batch['orders']
+    day['order_ids'] = merge_distinct(day['order_ids'], part['order_ids'])
+    day['items_sold'] += part['items_sold']
+    day['returned'] += part['returned']
+    day['revenue_units'] += part['revenue_units']
+    day['customers'] = merge_distinct(day['customers'], part['customers'])
+    return state
+
+def kpis_from_partials(partials, changed_categories=None):
+    """Finish KPI rows from partial aggregates, optionally only for some (order_date, category) keys"""
+    computed_at = datetime.now(timezone.utc).isoformat()
+    category_rows, order_rows = [], []
+    for order_date in sorted(partials):
+        state = partials[order_date]
+        for category, part in state['categories'].items():
+            if changed_categories is not None and (order_date, category) not in changed_categories:
+                continue
+            revenue = units_to_amount(part['revenue_units'])
+            category_rows.append({
+                'category': category,
+                'order_date': order_date,
+                'daily_revenue': revenue,
+                'avg_order_value': revenue / part['items'],
+                'avg_return_rate': part['returned'] / part['items'] * 100,
+            })
+        day = state['orders']
+        total_orders = day.get('counted_orders', 0) + distinct_size(day['order_ids'])
+        order_rows.append({
+            'order_date': order_date,
+            'total_orders': total_orders,
+            'total_items_sold': day['items_sold'],
+            'total_revenue': units_to_amount(day['revenue_units']),
+            'unique_customers': distinct_size(day['customers']),
+            'return_rate': day['returned'] / total_orders * 100 if total_orders else float('nan'),
+        })
+
+    category_kpis = pd.DataFrame(category_rows, columns=[
+        'category', 'order_date', 'daily_revenue', 'avg_order_value', 'avg_return_rate'])
+    category_kpis = category_kpis.sort_values(['category', 'order_date'], ignore_index=True)
+    category_kpis['computed_at'] = computed_at
+    order_kpis = pd.DataFrame(order_rows, columns=[
+        'order_date', 'total_orders', 'total_items_sold', 'total_revenue', 'unique_customers', 'return_rate'])
+    order_kpis['computed_at'] = computed_at
+    return category_kpis, order_kpis
+
+def state_key(state_path, order_date):
+    """Location of the partial-aggregate document for one order_date"""
+    return f"{state_path.rstrip('/')}/order_date={order_date}.json"
+
+class StateLockTimeout(Exception):
+    pass
+
+def is_conflict(error):
+    """A conditional S3 write lost to another writer"""
+    return error.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict')
+
+def acquire_s3_lock(bucket, key, body):
+    """Create the lock object, or take it over once stale; returns its ETag, or None while held"""
     try:
-        # Read transformed files
-        if is_s3_path(order_items_file):
-            order_items_df = read_csv_from_s3(order_items_file)
-        else:
-            order_items_df = pd.read_csv(order_items_file)
+        return s3_client.put_object(Bucket=bucket, Key=key, Body=body, IfNoneMatch='*')['ETag']
+    except s3_client.exceptions.ClientError as error:
+        if not is_conflict(error):
+            raise
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.ClientError as error:
+        if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    if time.time() - head['LastModified'].timestamp() < KPI_STATE_LOCK_TTL:
+        return None
+    # Writing over the stale lock only succeeds for one of the runs that saw the same ETag
+    try:
+        etag = s3_client.put_object(Bucket=bucket, Key=key, Body=body, IfMatch=head['ETag'])['ETag']
+    except s3_client.exceptions.ClientError as error:
+        if is_conflict(error) or error.response.get('Error', {}).get('Code') == 'NoSuchKey':
+            return None
+        raise
+    logger.warning(f"Took over a KPI state lock older than {KPI_STATE_LOCK_TTL}s at s3://{bucket}/{key}")
+    return etag
 
-        if is_s3_path(orders_file):
-            orders_df = read_csv_from_s3(orders_file)
-        else:
-            orders_df = pd.read_csv(orders_file)
+def acquire_local_lock(path, body):
+    """Create the lock file, or take it over once stale; returns True once held"""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path) >= KPI_STATE_LOCK_TTL:
+                # Only one waiting run can move the stale file away; the others keep waiting
+                stale = f"{path}.{uuid.uuid4().hex}"
+                os.rename(path, stale)
+                os.remove(stale)
+                logger.warning(f"Removed a KPI state lock older than {KPI_STATE_LOCK_TTL}s at {path}")
+        except FileNotFoundError:
+            pass
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(body)
+    return True
 
-        # Compute KPIs
-        category_kpis = compute_category_kpis(order_items_df)
-        order_kpis = compute_order_kpis(order_items_df, orders_df)
+@contextmanager
+def state_lock(state_path=None):
+    """Hold the lock of a KPI state path, so only one run at a time folds into it.
 
-        # Save results
-        if is_s3_path(category_output_file):
-            write_csv_to_s3(category_kpis, category_output_file)
+    Every fold, the KPI files written from it and the save of its states should happen inside,
+    otherwise two runs folding the same order_date would each overwrite the other's batch. The
+    lock is created only if absent (S3 If-None-Match or O_EXCL), so it works across tasks.
+    """
+    state_path = KPI_STATE_PATH if state_path is None else state_path
+    if not state_path:
+        yield
+        return
+    path = f"{state_path.rstrip('/')}/{STATE_LOCK_NAME}"
+    body = json.dumps({'owner': uuid.uuid4().hex, 'acquired_at': datetime.now(timezone.utc).isoformat()})
+    if not is_s3_path(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    deadline = time.time() + KPI_STATE_LOCK_WAIT
+    while True:
+        if is_s3_path(path):
+            bucket, key = parse_s3_path(path)
+            held = acquire_s3_lock(bucket, key, body)
         else:
-            category_kpis.to_csv(category_output_file, index=False)
-
-        if is_s3_path(order_output_file):
-            write_csv_to_s3(order_kpis, order_output_file)
+            held = acquire_local_lock(path, body)
+        if held:
+            break
+        if time.time() >= deadline:
+            raise StateLockTimeout(f"KPI state at {state_path} still locked after {KPI_STATE_LOCK_WAIT}s")
+        time.sleep(STATE_LOCK_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        if is_s3_path(path):
+            # Only remove the lock if it is still ours, not one taken over after it went stale
+            try:
+                s3_client.delete_object(Bucket=bucket, Key=key, IfMatch=held)
+            except s3_client.exceptions.ClientError as error:
+                if not is_conflict(error):
+                    raise
         else:
-            order_kpis.to_csv(order_output_file, index=False)
+            with open(path) as f:
+                mine = f.read() == body
+            if mine:
+                os.remove(path)
+
+def upgrade_state(state):
+    """Convert states written by earlier versions: float revenue sums become minor units and the
+    unused per-category customers are dropped. States that kept only an order count keep it as
+    counted_orders, and the order ids of later batches are counted on top of it."""
+    parts = list(state['categories'].values()) + [state['orders']]
+    for part in parts:
+        if 'revenue' in part:
+            part['revenue_units'] = int(round(part.pop('revenue') * 10 ** REVENUE_DECIMALS))
+    for part in state['categories'].values():
+        part.pop('customers', None)
+    if 'order_ids' not in state['orders']:
+        state['orders']['counted_orders'] = state['orders'].pop('orders', 0)
+        state['orders']['order_ids'] = distinct_set([])
+    return state
+
+def load_state(state_path, order_date):
+    """Load the stored partial aggregates for one order_date, or an empty state"""
+    location = state_key(state_path, order_date)
+    try:
+        if is_s3_path(location):
+            bucket, key = parse_s3_path(location)
+            return upgrade_state(json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()))
+        with open(location) as f:
+            return upgrade_state(json.load(f))
+    except (s3_client.exceptions.NoSuchKey, FileNotFoundError):
+        return empty_partial(order_date)
+
+def save_state(state_path, state):
+    """Persist the partial aggregates for one order_date"""
+    location = state_key(state_path, state['order_date'])
+    body = json.dumps(state)
+    if is_s3_path(location):
+        bucket, key = parse_s3_path(location)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+    else:
+        os.makedirs(os.path.dirname(location) or '.', exist_ok=True)
+        with open(location, 'w') as f:
+            f.write(body)
+
+def fold_batches(batches, state_path):
+    """Fold several batches' per-date partial aggregates into the stored state.
+
+    batches maps a batch id to that batch's partials. Each order_date in them is loaded once,
+    and a batch already recorded for a date is not folded there again (an empty id is never
+    recorded). Returns the KPI rows of every date and category the batches touch, from the
+    current state, and the updated states, which should be saved with save_state once the KPI
+    rows are written. Call it under state_lock.
+    """
+    loaded = {}
+    changed_dates = set()
+    reported_dates = set()
+    changed_categories = set()
+    for batch_id, batch in batches.items():
+        for order_date, partial in batch.items():
+            if order_date not in loaded:
+                loaded[order_date] = load_state(state_path, order_date)
+            state = loaded[order_date]
+            changed_categories.update((order_date, category) for category in partial['categories'])
+            reported_dates.add(order_date)
+            if batch_id and batch_id in state['batches']:
+                # Its rows are reported again from the current state, so a retry whose load failed
+                # repairs the tables without folding the batch twice
+                logger.info(f"Batch {batch_id} already folded into {order_date}, reporting its current KPIs")
+                continue
+            merge_partials(state, partial)
+            if batch_id:
+                state['batches'].append(batch_id)
+            changed_dates.add(order_date)
+
+    category_kpis, order_kpis = kpis_from_partials({order_date: loaded[order_date] for order_date in reported_dates},
+                                                   changed_categories)
+    states = {order_date: loaded[order_date] for order_date in changed_dates}
+    logger.info(f"Incremental KPIs: {len(states)} dates changed, {len(reported_dates)} dates and "
+                f"{len(category_kpis)} category rows reported")
+    return category_kpis, order_kpis, states
+
+def fold_partials(batch, state_path, batch_id=''):
+    """Fold a batch's per-date partial aggregates into the stored state.
+
+    Only the order_dates present in the batch are read and written, so the cost follows the
+    batch size rather than the history. Returns the KPI rows the batch changed and the updated
+    states, which should be saved with save_state once the KPI rows are written.
+    """
+    return fold_batches({batch_id: batch}, state_path)
+
+def compute_incremental_kpis(order_items_df, orders_df, state_path, batch_id=''):
+    """Fold a batch into the stored per-date state and return only the KPI rows it changed"""
+    return fold_partials(batch_partials(order_items_df, orders_df), state_path, batch_id)
+
+def compute_all_kpis(order_items_df, orders_df, state_path=None, batch_id=None):
+    """Compute both KPI tables, folded into the stored state when a state path is configured.
+
+    Returns the category and order KPI frames plus the states to save after the KPIs are written.
+    """
+    state_path = KPI_STATE_PATH if state_path is None else state_path
+    batch_id = KPI_BATCH_ID if batch_id is None else batch_id
+    if state_path:
+        return compute_incremental_kpis(order_items_df, orders_df, state_path, batch_id)
+    return compute_category_kpis(order_items_df), compute_order_kpis(order_items_df, orders_df), {}
+
+def save_states(states, state_path=None):
+    """Persist every updated per-date state"""
+    state_path = KPI_STATE_PATH if state_path is None else state_path
+    for state in states.values():
+        save_state(state_path, state)
+
+def kpi_settings(category_output_file, order_output_file):
+    """Settings that change the KPI files, for the stage cache key"""
+    return {
+        'formats': [os.path.splitext(path)[1] for path in (category_output_file, order_output_file)],
+        'kpi_state_path': KPI_STATE_PATH,
+        'kpi_batch_id': KPI_BATCH_ID,
+        'kpi_date_range': [KPI_DATE_FROM, KPI_DATE_TO],
+        'distinct_count_mode': DISTINCT_COUNT_MODE,
+        'hll_error': HLL_ERROR,
+        'revenue_decimals': REVENUE_DECIMALS,
+    }
+
+def main(order_items_file, orders_file, category_output_file, order_output_file):
+    start_stage('compute', 'COMPUTE')
+    try:
+        # The same transformed files were already computed with these settings: copy those KPIs into place.
+        # With KPI_STATE_PATH the cached rows may be older than the state, so a retried batch is folded
+        # again instead and reports its dates from the current state.
+        cache_key = None
+        if not KPI_STATE_PATH:
+            cache_key = stage_key('compute', input_fingerprints({'order_items': input_location(order_items_file),
+                                                                 'orders': input_location(orders_file)}),
+                                  params=kpi_settings(category_output_file, order_output_file),
+                                  code=[__file__, schema.__file__, hyperloglog.__file__])
+        outputs = {'category_kpis': category_output_file, 'order_kpis': order_output_file}
+        cached = restore('compute', cache_key, outputs)
+        if cached is not None:
+            finish("COMPUTE_SUCCESS", cached['message'])
+            sys.exit(0)
+
+        # Read transformed files or datasets, projecting only the columns the KPIs use
+        order_items_df = read_input(order_items_file, 'order_items_transformed', columns=ORDER_ITEMS_COLUMNS)
+        orders_df = read_input(orders_file, 'orders_transformed', columns=ORDERS_COLUMNS)
+        add(rows_in=len(order_items_df) + len(orders_df))
+
+        # Compute KPIs, either folded into the stored state or from this batch alone.
+        # Other runs wait for the state until this one has saved it.
+        with state_lock():
+            with phase('process'):
+                category_kpis, order_kpis, states = compute_all_kpis(order_items_df, orders_df)
+
+            # Save results
+            write_table(category_kpis, category_output_file)
+            write_table(order_kpis, order_output_file)
+            add(rows_out=len(category_kpis) + len(order_kpis))
+
+            # Only persist the new state once the KPI rows are written, so a failed run can be retried
+            with phase('write'):
+                save_states(states)
+        store('compute', cache_key, {'message': "✔️ All KPIs computed and saved"}, outputs)
 
         logger.info("All KPIs saved successfully")
-        print("COMPUTE_SUCCESS: ✔️ All KPIs computed and saved")
+        finish("COMPUTE_SUCCESS", "✔️ All KPIs computed and saved")
         sys.exit(0)
 
     except Exception as e:
         logger.error(f"Error computing KPIs: {str(e)}")
-        print(f"COMPUTE_FAILED: ❌ Error computing KPIs - {str(e)}")
+        finish("COMPUTE_FAILED", f"❌ Error computing KPIs - {str(e)}")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -146,7 +761,16 @@ if __name__ == "__main__":
     
     if not all([order_items_file, orders_file, category_output_file, order_output_file]):
         logger.error("Required environment variables missing (ORDER_ITEMS_FILE, ORDERS_FILE, CATEGORY_OUTPUT_FILE, ORDER_OUTPUT_FILE)")
-        print("COMPUTE_FAILED: ❌ Please provide ORDER_ITEMS_FILE, ORDERS_FILE, CATEGORY_OUTPUT_FILE, and ORDER_OUTPUT_FILE environment variables")
+        start_stage('compute', 'COMPUTE')
+        finish("COMPUTE_FAILED", "❌ Please provide ORDER_ITEMS_FILE, ORDERS_FILE, CATEGORY_OUTPUT_FILE, and ORDER_OUTPUT_FILE environment variables")
+        sys.exit(1)
+    
+    # A range reads every batch written for its dates, and folding those rows into the state again
+    # would count each batch twice, whatever the KPI_BATCH_ID
+    if KPI_STATE_PATH and (KPI_DATE_FROM or KPI_DATE_TO):
+        logger.error("KPI_DATE_FROM/KPI_DATE_TO cannot be combined with KPI_STATE_PATH")
+        start_stage('compute', 'COMPUTE')
+        finish("COMPUTE_FAILED", "❌ KPI_DATE_FROM/KPI_DATE_TO cannot be used with KPI_STATE_PATH; recompute a date range without state")
         sys.exit(1)
     
     main(order_items_file, orders_file, category_output_file, order_output_file)
\ No newline at end of file
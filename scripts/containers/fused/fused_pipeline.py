@@ -0,0 +1,159 @@
+import sys
+import logging
+import os
+
+# The stage scripts sit next to this file in the image and in sibling folders in the repository
+HERE = os.path.dirname(os.path.abspath(__file__))
+for stage_dir in ('validate', 'transform', 'compute'):
+    sys.path.append(os.path.join(HERE, '..', stage_dir))
+
+import compute_kpis
+import hyperloglog
+import schema
+import transform_data
+import validate_data
+from validate_data import (ORDERS_RULES, ORDER_ITEMS_RULES, CHUNK_SIZE as VALIDATE_CHUNK_SIZE, QUARANTINE_MAX_FRACTION,
+                           QUARANTINE_MAX_ROWS, VALIDATE_MODE, quarantine_file, validate_orders,
+                           validate_order_items)
+from transform_data import INPUT_COLUMNS, load_products_dimension, read_table, transform_parallel, write_datasets
+from compute_kpis import compute_all_kpis, kpi_settings, save_states, state_lock, write_table
+from stage_cache import input_fingerprints, restore, stage_key, store
+from telemetry import add, finish, phase, start_stage
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+# Status marker prefix for each stage, matching the standalone containers
+STAGE_MARKERS = {
+    'validate': 'VALIDATION',
+    'transform': 'TRANSFORM',
+    'compute': 'COMPUTE',
+}
+
+# Each file is read once for both validation and transformation, so load the columns either one needs
+ORDERS_COLUMNS = sorted(set(ORDERS_RULES['required_columns']) | set(INPUT_COLUMNS['orders']))
+ORDER_ITEMS_COLUMNS = sorted(set(ORDER_ITEMS_RULES['required_columns']) | set(INPUT_COLUMNS['order_items']))
+
+# Source files whose code decides the KPI files, for the stage cache key
+CACHE_CODE = [__file__] + [module.__file__ for module in (validate_data, transform_data, compute_kpis, hyperloglog,
+                                                          schema)]
+
+def run_validate(orders_df, order_items_df):
+    """Validate both files in memory, printing one status line per file"""
+    for label, validate, df in (("orders", validate_orders, orders_df),
+                                ("order items", validate_order_items, order_items_df)):
+        success, message = validate(df)
+        if not success:
+            logger.error(f"Validation failed for {label}: {message}")
+            finish("VALIDATION_FAILED", message)
+            return False
+        print(f"VALIDATION_SUCCESS: {message}")
+    return True
+
+def run_quarantine(orders_file, order_items_file):
+    """Set the failing rows of both inputs aside before they are read, printing one status line per file"""
+    for label, path in (("orders", orders_file), ("order items", order_items_file)):
+        result, _ = quarantine_file(path, VALIDATE_CHUNK_SIZE)
+        success, message = result if result is not None else (False, "❌ Unknown file format")
+        if not success:
+            logger.error(f"Validation failed for {label}: {message}")
+            finish("VALIDATION_FAILED", message)
+            return False
+        print(f"VALIDATION_SUCCESS: {message}")
+    return True
+
+def run_transform(orders_df, order_items_df, products_dimension):
+    """Transform both files in memory, on TRANSFORM_WORKERS processes, printing one status line per file"""
+    orders_df, message = transform_parallel(orders_df, 'orders')
+    print(f"TRANSFORM_SUCCESS: {message}")
+    order_items_df, message = transform_parallel(order_items_df, 'order_items', products_dimension)
+    print(f"TRANSFORM_SUCCESS: {message}")
+    return orders_df, order_items_df
+
+def run_compute(orders_df, order_items_df):
+    """Compute both KPI tables from the in-memory transformed frames"""
+    return compute_all_kpis(order_items_df, orders_df)
+
+def main(orders_file, order_items_file, products_file, category_output_file, order_output_file):
+    stage = 'validate'
+    start_stage('fused', STAGE_MARKERS[stage])
+    try:
+        logger.info("Starting fused validate → transform → compute run")
+
+        # The same inputs already went through every stage with this code and these settings.
+        # With KPI_STATE_PATH a retry folds again instead, to report its dates from the current state.
+        cache_key = None
+        if not compute_kpis.KPI_STATE_PATH:
+            cache_key = stage_key('fused', input_fingerprints({'orders': orders_file, 'order_items': order_items_file,
+                                                               'products': products_file}),
+                                  params={**kpi_settings(category_output_file, order_output_file),
+                                          'validate_mode': VALIDATE_MODE,
+                                          'quarantine_limits': [QUARANTINE_MAX_FRACTION, QUARANTINE_MAX_ROWS]},
+                                  code=CACHE_CODE)
+        outputs = {'category_kpis': category_output_file, 'order_kpis': order_output_file}
+        cached = restore('fused', cache_key, outputs)
+        if cached is not None:
+            finish("COMPUTE_SUCCESS", cached['message'])
+            sys.exit(0)
+
+        # In quarantine mode failing rows are moved out of the inputs first, so what is read next is clean
+        if VALIDATE_MODE == 'quarantine' and not run_quarantine(orders_file, order_items_file):
+            sys.exit(1)
+
+        # Each input is downloaded and parsed exactly once; values are converted after validation
+        orders_df = read_table(orders_file, 'orders', columns=ORDERS_COLUMNS, strict=False)
+        order_items_df = read_table(order_items_file, 'order_items', columns=ORDER_ITEMS_COLUMNS, strict=False)
+        add(rows_in=len(orders_df) + len(order_items_df))
+
+        if VALIDATE_MODE != 'quarantine':
+            with phase('process'):
+                valid = run_validate(orders_df, order_items_df)
+            if not valid:
+                sys.exit(1)
+
+        stage = 'transform'
+        products_dimension = load_products_dimension(products_file)
+        with phase('process'):
+            orders_df, order_items_df = run_transform(orders_df, order_items_df, products_dimension)
+        write_datasets(orders_df, order_items_df)
+
+        stage = 'compute'
+        with state_lock():
+            with phase('process'):
+                category_kpis, order_kpis, states = run_compute(orders_df, order_items_df)
+            write_table(category_kpis, category_output_file)
+            write_table(order_kpis, order_output_file)
+            add(rows_out=len(category_kpis) + len(order_kpis))
+            with phase('write'):
+                save_states(states)
+        store('fused', cache_key, {'message': "✔️ All KPIs computed and saved"}, outputs)
+
+        logger.info("All KPIs saved successfully")
+        finish("COMPUTE_SUCCESS", "✔️ All KPIs computed and saved")
+        sys.exit(0)
+
+    except Exception as e:
+        logger.error(f"Error in fused {stage} stage: {str(e)}")
+        finish(f"{STAGE_MARKERS[stage]}_FAILED", f"❌ Error in {stage} stage - {str(e)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    # Get file paths from environment variables, same names as the standalone containers
+    orders_file = os.environ.get("ORDERS_FILE")
+    order_items_file = os.environ.get("ORDER_ITEMS_FILE")
+    products_file = os.environ.get("PRODUCTS_FILE")
+    category_output_file = os.environ.get("CATEGORY_OUTPUT_FILE")
+    order_output_file = os.environ.get("ORDER_OUTPUT_FILE")
+
+    if not all([orders_file, order_items_file, products_file, category_output_file, order_output_file]):
+        logger.error("Required environment variables missing (ORDERS_FILE, ORDER_ITEMS_FILE, PRODUCTS_FILE, CATEGORY_OUTPUT_FILE, ORDER_OUTPUT_FILE)")
+        start_stage('fused', STAGE_MARKERS['validate'])
+        finish("VALIDATION_FAILED", "❌ Please provide ORDERS_FILE, ORDER_ITEMS_FILE, PRODUCTS_FILE, CATEGORY_OUTPUT_FILE and ORDER_OUTPUT_FILE environment variables")
+        sys.exit(1)
+
+    main(orders_file, order_items_file, products_file, category_output_file, order_output_file)
@@ -0,0 +1,237 @@
+import sys
+import logging
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# The stage scripts sit next to this file in the image and in sibling folders in the repository
+HERE = os.path.dirname(os.path.abspath(__file__))
+for stage_dir in ('transform', 'compute'):
+    sys.path.append(os.path.join(HERE, '..', stage_dir))
+
+from transform_data import (INPUT_COLUMNS, is_s3_path, load_products_dimension, parse_s3_path, read_table,
+                            s3_client, transform_orders, transform_order_items, write_datasets)
+from compute_kpis import (KPI_BATCH_ID, KPI_STATE_PATH, batch_partials, empty_partial, fold_partials,
+                          kpis_from_partials, merge_partials, save_states, state_lock, union_distinct, write_table)
+from schema import read_csv
+from telemetry import add, annotate, finish, phase, start_stage
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+# Rows read at a time while partitioning, so the merged files never have to fit in memory
+PARTITION_CHUNK_SIZE = int(os.environ.get("PARTITION_CHUNK_SIZE", "200000"))
+
+# Distinct-value structures of a day's partial, unioned across shards instead of merged pairwise
+DISTINCT_FIELDS = ('order_ids', 'customers')
+
+# Status marker prefix for each stage: partition and aggregate stand in for transform, combine for compute
+STAGE_MARKERS = {
+    'partition': 'TRANSFORM',
+    'aggregate': 'TRANSFORM',
+    'combine': 'COMPUTE',
+}
+
+def shard_path(prefix, kind, index, extension='csv'):
+    """Location of one shard's file: {prefix}/{kind}/shard=0003.csv"""
+    return f"{prefix.rstrip('/')}/{kind}/shard={index:04d}.{extension}"
+
+def shard_of(order_ids, shard_count):
+    """Shard of each row from a stable hash of its order_id, so an order and its items land together"""
+    hashes = pd.util.hash_array(np.asarray(order_ids, dtype=np.int64), categorize=False)
+    return (hashes % np.uint64(shard_count)).astype(np.int64)
+
+def download_file(path, local_path):
+    """Copy an S3 object or local file to a local path"""
+    with phase('read'):
+        if is_s3_path(path):
+            bucket, key = parse_s3_path(path)
+            s3_client.download_file(bucket, key, local_path)
+        else:
+            shutil.copyfile(path, local_path)
+    add(bytes_in=os.path.getsize(local_path))
+
+def upload_file(local_path, path):
+    """Copy a local file to S3 or another local path"""
+    with phase('write'):
+        if is_s3_path(path):
+            bucket, key = parse_s3_path(path)
+            s3_client.upload_file(local_path, bucket, key)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            shutil.copyfile(local_path, path)
+    add(bytes_out=os.path.getsize(local_path))
+
+def read_json(path):
+    with phase('read'):
+        if is_s3_path(path):
+            bucket, key = parse_s3_path(path)
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        else:
+            with open(path, 'rb') as f:
+                body = f.read()
+    add(bytes_in=len(body))
+    with phase('parse'):
+        return json.loads(body)
+
+def write_json(data, path):
+    body = json.dumps(data)
+    with phase('write'):
+        if is_s3_path(path):
+            bucket, key = parse_s3_path(path)
+            s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(body)
+    add(bytes_out=len(body.encode('utf-8')))
+
+def partition_file(input_file, file_type, prefix, shard_count, chunk_size=PARTITION_CHUNK_SIZE):
+    """Split a merged file into shard_count CSVs by hash of order_id, reading it in chunks.
+
+    Only the columns the transformation uses are kept. Every shard gets a file, with just the
+    header if no rows hash to it. Returns the row count per shard.
+    """
+    rows = np.zeros(shard_count, dtype=np.int64)
+    with tempfile.TemporaryDirectory() as folder:
+        local_input = os.path.join(folder, 'input.csv')
+        download_file(input_file, local_input)
+        local_shards = [os.path.join(folder, f'shard={index:04d}.csv') for index in range(shard_count)]
+        handles = [open(path, 'w', newline='') for path in local_shards]
+        columns = None
+        try:
+            chunks = read_csv(local_input, file_type, columns=INPUT_COLUMNS[file_type], strict=False,
+                              chunksize=chunk_size)
+            while True:
+                with phase('parse'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                columns = chunk.columns
+                with phase('process'):
+                    for index, part in chunk.groupby(shard_of(chunk['order_id'], shard_count), sort=False):
+                        part.to_csv(handles[index], index=False, header=bool(rows[index] == 0))
+                        rows[index] += len(part)
+            for index in np.flatnonzero(rows == 0):
+                pd.DataFrame(columns=columns).to_csv(handles[index], index=False)
+        finally:
+            for handle in handles:
+                handle.close()
+        for index, local_path in enumerate(local_shards):
+            upload_file(local_path, shard_path(prefix, file_type, index))
+    add(rows_in=rows.sum(), rows_out=rows.sum())
+    logger.info(f"Partitioned {file_type} into {shard_count} shards ({rows.min()}-{rows.max()} rows each)")
+    return rows
+
+def aggregate_shard(prefix, index, products_file):
+    """Transform one shard and reduce it to per-date partial aggregates"""
+    orders_df = read_table(shard_path(prefix, 'orders', index), 'orders', columns=INPUT_COLUMNS['orders'])
+    order_items_df = read_table(shard_path(prefix, 'order_items', index), 'order_items',
+                                columns=INPUT_COLUMNS['order_items'])
+    products_dimension = load_products_dimension(products_file)
+    add(rows_in=len(orders_df) + len(order_items_df))
+    with phase('process'):
+        orders_df, _ = transform_orders(orders_df)
+        order_items_df, message = transform_order_items(order_items_df, products_dimension)
+        partials = batch_partials(order_items_df, orders_df)
+    # Each shard is its own batch in the shared datasets, so shards never replace each other's files
+    write_datasets(orders_df, order_items_df, '-'.join(filter(None, [KPI_BATCH_ID, f"shard{index:04d}"])))
+    logger.info(f"Shard {index}: {message}")
+    write_json(partials, shard_path(prefix, 'partials', index, 'json'))
+    add(rows_out=len(partials))
+    return partials
+
+def combine_partials(shard_partials):
+    """Merge per-shard partial aggregates into one partial per order_date.
+
+    Revenue is in exact integer minor units and item and returned counts are integers, so the
+    result does not depend on how rows were split. Each day's order and customer ids are kept as
+    int64 arrays and unioned once at the end.
+    """
+    combined = {}
+    distinct = {}
+    for partials in shard_partials:
+        with phase('process'):
+            for order_date, partial in partials.items():
+                for field in DISTINCT_FIELDS:
+                    values = partial['orders'].pop(field)
+                    if not isinstance(values, dict):
+                        values = np.asarray(values, dtype=np.int64)
+                    distinct.setdefault((order_date, field), []).append(values)
+                    partial['orders'][field] = []
+                merge_partials(combined.setdefault(order_date, empty_partial(order_date)), partial)
+    with phase('process'):
+        for (order_date, field), values in distinct.items():
+            combined[order_date]['orders'][field] = union_distinct(values)
+    return combined
+
+def combine_shards(prefix, shard_count, state_path=None, batch_id=None):
+    """Combine every shard's partials into the KPI tables, folded into the stored state if configured"""
+    state_path = KPI_STATE_PATH if state_path is None else state_path
+    batch_id = KPI_BATCH_ID if batch_id is None else batch_id
+
+    def shard_partials():
+        # One shard's document is parsed at a time and folded in before the next is read
+        for index in range(shard_count):
+            partials = read_json(shard_path(prefix, 'partials', index, 'json'))
+            add(rows_in=len(partials))
+            yield partials
+
+    combined = combine_partials(shard_partials())
+    with phase('process'):
+        if state_path:
+            return fold_partials(combined, state_path, batch_id)
+        category_kpis, order_kpis = kpis_from_partials(combined)
+    return category_kpis, order_kpis, {}
+
+def main(stage):
+    start_stage(f'shard_{stage}', STAGE_MARKERS[stage])
+    try:
+        prefix = os.environ["SHARD_PREFIX"]
+        shard_count = int(os.environ["SHARD_COUNT"])
+        annotate(shard_count=shard_count)
+        if stage == 'partition':
+            for file_type, variable in (('orders', 'ORDERS_FILE'), ('order_items', 'ORDER_ITEMS_FILE')):
+                partition_file(os.environ[variable], file_type, prefix, shard_count)
+            finish("TRANSFORM_SUCCESS", f"✔️ Inputs split into {shard_count} shards")
+        elif stage == 'aggregate':
+            index = int(os.environ["SHARD_INDEX"])
+            annotate(shard_index=index)
+            aggregate_shard(prefix, index, os.environ["PRODUCTS_FILE"])
+            finish("TRANSFORM_SUCCESS", f"✔️ Shard {index} transformed and aggregated")
+        else:
+            with state_lock():
+                category_kpis, order_kpis, states = combine_shards(prefix, shard_count)
+                write_table(category_kpis, os.environ["CATEGORY_OUTPUT_FILE"])
+                write_table(order_kpis, os.environ["ORDER_OUTPUT_FILE"])
+                add(rows_out=len(category_kpis) + len(order_kpis))
+                with phase('write'):
+                    save_states(states)
+            finish("COMPUTE_SUCCESS", f"✔️ KPIs combined from {shard_count} shards")
+        sys.exit(0)
+
+    except Exception as e:
+        logger.error(f"Error in shard {stage} stage: {str(e)}")
+        finish(f"{STAGE_MARKERS[stage]}_FAILED", f"❌ Error in shard {stage} stage - {str(e)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    # SHARD_STAGE picks the step; SHARD_PREFIX and SHARD_COUNT are needed by all of them, then
+    # partition: ORDERS_FILE, ORDER_ITEMS_FILE; aggregate: SHARD_INDEX, PRODUCTS_FILE;
+    # combine: CATEGORY_OUTPUT_FILE, ORDER_OUTPUT_FILE
+    stage = os.environ.get("SHARD_STAGE")
+    if stage not in STAGE_MARKERS:
+        logger.error("SHARD_STAGE must be one of partition, aggregate or combine")
+        start_stage('shard', 'TRANSFORM')
+        finish("TRANSFORM_FAILED", "❌ Please set SHARD_STAGE to partition, aggregate or combine")
+        sys.exit(1)
+    main(stage)
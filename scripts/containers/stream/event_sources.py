@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from urllib.parse import unquote_plus
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+from compression import CODEC_EXTENSIONS, codec_from_path
+
+logger = logging.getLogger(__name__)
+
+# Part files as uploaded by the producers: data/<date>/orders/... or data/<date>/order_items/...,
+# plain or compressed (.csv.gz, .csv.zst)
+PART_KEY = re.compile(r'(?:^|/)data/(?P<date>[^/]+)/(?P<kind>orders|order_items)/[^/]+\.csv(?:'
+                      + '|'.join(re.escape(extension) for extension in CODEC_EXTENSIONS.values()) + r')?$')
+# SQS returns at most 10 messages per call and long-polls for at most 20 seconds
+SQS_MAX_MESSAGES = 10
+SQS_MAX_WAIT_SECONDS = 20
+
+
+class FileEvent:
+    """One part file that has landed: where it is, what it holds and when it arrived"""
+
+    def __init__(self, path, kind, date, arrived_at, receipt=None):
+        self.path = path
+        self.kind = kind
+        self.date = date
+        # gzip or zstd for a compressed part, None for a plain one
+        self.codec = codec_from_path(path)
+        # Epoch seconds at which the file landed, the start of its end-to-end latency
+        self.arrived_at = arrived_at
+        # What the source needs to acknowledge the event (an SQS receipt handle)
+        self.receipt = receipt
+
+    def __repr__(self):
+        return f"FileEvent({self.path!r})"
+
+
+def file_event(path, arrived_at, receipt=None):
+    """FileEvent for a part file path, or None for anything else (manifests, products, ...)"""
+    match = PART_KEY.search(path)
+    if match is None:
+        return None
+    return FileEvent(path, match.group('kind'), match.group('date'), arrived_at, receipt)
+
+
+class LocalQueueSource:
+    """In-process queue of part file paths, for local runs, tests and benchmarks"""
+
+    def __init__(self, max_batch=100):
+        self.queue = asyncio.Queue()
+        self.max_batch = max_batch
+        self.closed = False
+        self.acked = []
+
+    def put(self, path, arrived_at=None):
+        """Announce a file; paths that are not part files are ignored"""
+        event = file_event(path, time.time() if arrived_at is None else arrived_at)
+        if event is not None:
+            self.queue.put_nowait(event)
+        return event
+
+    def close(self):
+        """No more files: the consumer flushes what it has and stops"""
+        self.queue.put_nowait(None)
+
+    async def receive(self, timeout=None):
+        """Events that have arrived, waiting up to timeout seconds for the first; None once closed"""
+        if self.closed:
+            return None
+        try:
+            first = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        events = [first]
+        while len(events) < self.max_batch and not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        if None in events:
+            self.closed = True
+            events = events[:events.index(None)]
+            return events or None
+        return events
+
+    async def ack(self, events):
+        self.acked.extend(events)
+
+
+class SqsSource:
+    """S3 object-created notifications delivered to an SQS queue.
+
+    Messages are deleted only when their files are acknowledged, so a consumer that stops
+    before folding a file gets it again after the queue's visibility timeout.
+    """
+
+    def __init__(self, queue_url, sqs=None):
+        import boto3
+        self.queue_url = queue_url
+        self.sqs = sqs or boto3.client('sqs')
+
+    async def receive(self, timeout=None):
+        wait = SQS_MAX_WAIT_SECONDS if timeout is None else int(min(SQS_MAX_WAIT_SECONDS, max(0, timeout)))
+        response = await asyncio.to_thread(self.sqs.receive_message, QueueUrl=self.queue_url,
+                                           MaxNumberOfMessages=SQS_MAX_MESSAGES, WaitTimeSeconds=wait)
+        events, ignored = [], []
+        for message in response.get('Messages', []):
+            message_events = [event for event in self.parse(message) if event is not None]
+            if message_events:
+                events.extend(message_events)
+            else:
+                # s3:TestEvent, manifests and other keys: nothing to fold
+                ignored.append(message['ReceiptHandle'])
+        if ignored:
+            await self.delete(ignored)
+        return events
+
+    def parse(self, message):
+        body = json.loads(message['Body'])
+        for record in body.get('Records', []):
+            if not record.get('eventName', '').startswith('ObjectCreated'):
+                continue
+            bucket = record['s3']['bucket']['name']
+            key = unquote_plus(record['s3']['object']['key'])
+            arrived_at = datetime.fromisoformat(record['eventTime'].replace('Z', '+00:00')).timestamp()
+            yield file_event(f"s3://{bucket}/{key}", arrived_at, message['ReceiptHandle'])
+
+    async def ack(self, events):
+        await self.delete(sorted({event.receipt for event in events}))
+
+    async def delete(self, receipts):
+        # DeleteMessageBatch takes at most 10 entries
+        for start in range(0, len(receipts), SQS_MAX_MESSAGES):
+            entries = [{'Id': str(index), 'ReceiptHandle': receipt}
+                       for index, receipt in enumerate(receipts[start:start + SQS_MAX_MESSAGES])]
+            response = await asyncio.to_thread(self.sqs.delete_message_batch, QueueUrl=self.queue_url,
+                                               Entries=entries)
+            for failure in response.get('Failed', []):
+                logger.warning(f"Could not delete SQS message: {failure.get('Message')}")
@@ -0,0 +1,288 @@
+import sys
+import logging
+import os
+import json
+import time
+import asyncio
+import shutil
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+# The stage scripts sit next to this file in the image and in sibling folders in the repository
+HERE = os.path.dirname(os.path.abspath(__file__))
+for stage_dir in ('validate', 'transform', 'compute'):
+    sys.path.append(os.path.join(HERE, '..', stage_dir))
+
+from validate_data import ORDERS_RULES, ORDER_ITEMS_RULES, validate_orders, validate_order_items
+from transform_data import (INPUT_COLUMNS, is_s3_path, load_products_dimension, parse_s3_path, read_table, s3_client,
+                            transform_orders, transform_order_items)
+from compute_kpis import (KPI_STATE_PATH, ORDERS_COLUMNS as KPI_ORDERS_COLUMNS,
+                          ORDER_ITEMS_COLUMNS as KPI_ORDER_ITEMS_COLUMNS, batch_partials, fold_batches,
+                          save_states, state_lock, write_table)
+from event_sources import SqsSource
+from telemetry import add, emit, phase, record, start_stage
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+# A micro-batch is folded once it is this old or has this many transformed rows, whichever comes first
+STREAM_FLUSH_SECONDS = float(os.environ.get("STREAM_FLUSH_SECONDS", "30"))
+STREAM_FLUSH_ROWS = int(os.environ.get("STREAM_FLUSH_ROWS", "100000"))
+# Part files validated and transformed at the same time
+STREAM_WORKERS = int(os.environ.get("STREAM_WORKERS", "2"))
+# Running per-day aggregates; without KPI_STATE_PATH they are kept in a local folder
+STREAM_STATE_PATH = KPI_STATE_PATH or os.environ.get("STREAM_STATE_PATH", "/tmp/stream_state")
+# Folder or s3:// prefix that receives the KPI rows changed by each flush
+STREAM_OUTPUT_PATH = os.environ.get("STREAM_OUTPUT_PATH", "")
+# write_to_dynamodb function invoked (asynchronously) with each flush's KPI files; empty skips the load
+STREAM_LOAD_FUNCTION = os.environ.get("STREAM_LOAD_FUNCTION", "")
+# Folder or s3:// prefix that receives a copy of every rejected part under <date>/stream/; empty uses
+# errors/ in the part's own bucket (local parts are then only logged)
+STREAM_ERROR_PATH = os.environ.get("STREAM_ERROR_PATH", "")
+CATEGORY_TABLE = os.environ.get("CATEGORY_TABLE", "category-Level-table")
+ORDER_TABLE = os.environ.get("ORDER_TABLE", "order-level-table")
+
+# Each part is read once for validation and transformation, so load the columns either one needs
+READ_COLUMNS = {
+    'orders': sorted(set(ORDERS_RULES['required_columns']) | set(INPUT_COLUMNS['orders'])),
+    'order_items': sorted(set(ORDER_ITEMS_RULES['required_columns']) | set(INPUT_COLUMNS['order_items'])),
+}
+VALIDATORS = {
+    'orders': validate_orders,
+    'order_items': validate_order_items,
+}
+
+class PreparedFile:
+    """A validated and transformed part file, reduced to per-date partial aggregates"""
+
+    def __init__(self, event, partials, rows):
+        self.event = event
+        self.partials = partials
+        self.rows = rows
+
+def prepare_file(event, products_file):
+    """Validate and transform one part file and reduce it to partials.
+
+    Returns a PreparedFile, or the validation message if the file is rejected. An orders part
+    only adds to the order counts and an order items part to revenue, categories and customers,
+    so the two kinds can arrive in any order.
+    """
+    df = read_table(event.path, event.kind, columns=READ_COLUMNS[event.kind], strict=False)
+    success, message = VALIDATORS[event.kind](df)
+    if not success:
+        return message
+    if event.kind == 'orders':
+        orders_df, _ = transform_orders(df)
+        order_items_df = pd.DataFrame({column: [] for column in KPI_ORDER_ITEMS_COLUMNS})
+    else:
+        order_items_df, _ = transform_order_items(df, load_products_dimension(products_file))
+        orders_df = pd.DataFrame({column: [] for column in KPI_ORDERS_COLUMNS})
+    return PreparedFile(event, batch_partials(order_items_df, orders_df), len(df))
+
+def rejected_location(event, error_path=None):
+    """Where a rejected part is copied: {error folder}/{date}/stream/{file name}, or None to only log it"""
+    error_path = STREAM_ERROR_PATH if error_path is None else error_path
+    if not error_path:
+        if not is_s3_path(event.path):
+            return None
+        error_path = f"s3://{parse_s3_path(event.path)[0]}/errors"
+    return f"{error_path.rstrip('/')}/{event.date}/stream/{event.path.rsplit('/', 1)[-1]}"
+
+def archive_rejected(event, error_path=None):
+    """Copy a rejected part to the error folder, so it is kept for inspection and replay. Returns its copy's location"""
+    location = rejected_location(event, error_path)
+    if location is None:
+        return None
+    if is_s3_path(location):
+        bucket, key = parse_s3_path(location)
+        if is_s3_path(event.path):
+            source_bucket, source_key = parse_s3_path(event.path)
+            s3_client.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': source_bucket, 'Key': source_key})
+        else:
+            s3_client.upload_file(event.path, bucket, key)
+    else:
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        if is_s3_path(event.path):
+            s3_client.download_file(*parse_s3_path(event.path), location)
+        else:
+            shutil.copyfile(event.path, location)
+    return location
+
+def fold_files(prepared, state_path=None, output_path=None, load_function=None):
+    """Fold prepared files into the running per-day aggregates and write the KPI rows that changed.
+
+    Every file is recorded under its path in the per-day state, so a file delivered twice is
+    only counted once. Returns the KPI files written (None when nothing changed).
+    """
+    state_path = STREAM_STATE_PATH if state_path is None else state_path
+    output_path = STREAM_OUTPUT_PATH if output_path is None else output_path
+    load_function = STREAM_LOAD_FUNCTION if load_function is None else load_function
+    # The daily pipeline may fold into the same state, so the flush holds its lock until saved
+    with state_lock(state_path):
+        with phase('process'):
+            category_kpis, order_kpis, states = fold_batches({item.event.path: item.partials for item in prepared},
+                                                             state_path)
+        if not states:
+            return None
+
+        outputs = None
+        if output_path:
+            stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+            outputs = {
+                'category_kpi_file': f"{output_path.rstrip('/')}/category_kpis_{stamp}.csv",
+                'order_kpi_file': f"{output_path.rstrip('/')}/order_kpis_{stamp}.csv",
+            }
+            if not output_path.startswith('s3://'):
+                os.makedirs(output_path, exist_ok=True)
+            write_table(category_kpis, outputs['category_kpi_file'])
+            write_table(order_kpis, outputs['order_kpi_file'])
+        add(rows_out=len(category_kpis) + len(order_kpis))
+
+        # Only persist the new state once the KPI rows are written, so a failed flush can be retried
+        with phase('write'):
+            save_states(states, state_path)
+    if outputs and load_function:
+        invoke_load(load_function, outputs)
+    return outputs
+
+def invoke_load(function_name, outputs):
+    """Start the DynamoDB load of one flush's KPI files without waiting for it"""
+    import boto3
+    payload = {**outputs, 'category_table': CATEGORY_TABLE, 'order_table': ORDER_TABLE}
+    boto3.client('lambda').invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(payload))
+
+def latency_summary(latencies):
+    """p50, p95 and max of a list of latencies in seconds"""
+    if not latencies:
+        return {}
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return {
+        'latency_p50_seconds': round(float(p50), 3),
+        'latency_p95_seconds': round(float(p95), 3),
+        'latency_max_seconds': round(float(max(latencies)), 3),
+    }
+
+class MicroBatchConsumer:
+    """Fold part files into the running per-day KPIs as they arrive.
+
+    Files are validated and transformed as soon as they are received, on up to `workers`
+    threads, while the event loop keeps receiving. Their partials are folded in one go when
+    the micro-batch is flush_seconds old or holds flush_rows rows, and the source is only
+    acknowledged once the fold is saved.
+    """
+
+    def __init__(self, source, products_file, flush_seconds=STREAM_FLUSH_SECONDS, flush_rows=STREAM_FLUSH_ROWS,
+                 workers=STREAM_WORKERS, state_path=None, output_path=None, load_function=None, error_path=None):
+        self.source = source
+        self.products_file = products_file
+        self.flush_seconds = flush_seconds
+        self.flush_rows = flush_rows
+        self.workers = asyncio.Semaphore(workers)
+        self.state_path = state_path
+        self.output_path = output_path
+        self.load_function = load_function
+        self.error_path = error_path
+        self.tasks = []
+        self.prepared = []
+        self.rejected = []
+        self.rows = 0
+        self.batch_started = None
+        # Seconds from arrival to KPI update of every file folded so far, and one summary per flush
+        self.latencies = []
+        self.flushes = []
+
+    async def run(self):
+        while True:
+            events = await self.source.receive(self.time_to_flush())
+            if events is None:
+                break
+            for event in events:
+                if self.batch_started is None:
+                    self.batch_started = time.monotonic()
+                self.tasks.append(asyncio.create_task(self.prepare(event)))
+            if self.flush_due():
+                await self.flush()
+        await self.flush()
+
+    def time_to_flush(self):
+        if self.batch_started is None:
+            return None
+        return max(0.0, self.batch_started + self.flush_seconds - time.monotonic())
+
+    def flush_due(self):
+        return self.batch_started is not None and (self.rows >= self.flush_rows or self.time_to_flush() == 0)
+
+    async def prepare(self, event):
+        async with self.workers:
+            try:
+                result = await asyncio.to_thread(prepare_file, event, self.products_file)
+            except Exception as e:
+                # Not acknowledged, so a queue delivers the file again later
+                logger.error(f"Error preparing {event.path}: {str(e)}")
+                return
+        if isinstance(result, PreparedFile):
+            self.prepared.append(result)
+            self.rows += result.rows
+            return
+        try:
+            location = await asyncio.to_thread(archive_rejected, event, self.error_path)
+        except Exception as e:
+            # Not acknowledged either, so the part is not lost before its copy exists
+            logger.error(f"VALIDATION_FAILED: {event.path}: {result} (could not copy it to the error folder, "
+                         f"it will be delivered again: {str(e)})")
+            return
+        logger.error(f"VALIDATION_FAILED: {event.path}: {result}" + (f", copied to {location}" if location else ""))
+        self.rejected.append(event)
+
+    async def flush(self):
+        """Fold every file received so far and acknowledge it"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        prepared, rejected = self.prepared, self.rejected
+        self.tasks, self.prepared, self.rejected, self.rows, self.batch_started = [], [], [], 0, None
+        if not prepared and not rejected:
+            return
+
+        start_stage('stream_flush', 'COMPUTE')
+        add(rows_in=sum(item.rows for item in prepared))
+        record(rejected_files=len(rejected))
+        try:
+            if prepared:
+                outputs = await asyncio.to_thread(fold_files, prepared, self.state_path, self.output_path,
+                                                  self.load_function)
+            else:
+                outputs = None
+        except Exception as e:
+            logger.error(f"Error folding {len(prepared)} files, they will be delivered again: {str(e)}")
+            emit('failed')
+            await self.source.ack(rejected)
+            return
+        folded_at = time.time()
+        latencies = [folded_at - item.event.arrived_at for item in prepared]
+        self.latencies.extend(latencies)
+        summary = {'files': len(prepared), 'rejected': len(rejected), **latency_summary(latencies)}
+        self.flushes.append(summary)
+        record(files=len(prepared), **latency_summary(latencies))
+        await self.source.ack([item.event for item in prepared] + rejected)
+        logger.info(f"Folded {len(prepared)} files ({len(rejected)} rejected) into the running KPIs"
+                    + (f", KPI rows in {outputs['category_kpi_file']}" if outputs else ""))
+        emit('success')
+
+def main():
+    queue_url = os.environ.get("STREAM_QUEUE_URL")
+    products_file = os.environ.get("PRODUCTS_FILE")
+    if not queue_url or not products_file:
+        logger.error("Required environment variables missing (STREAM_QUEUE_URL, PRODUCTS_FILE)")
+        sys.exit(1)
+    logger.info(f"Folding part files from {queue_url} every {STREAM_FLUSH_SECONDS}s or {STREAM_FLUSH_ROWS} rows")
+    asyncio.run(MicroBatchConsumer(SqsSource(queue_url), products_file).run())
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,22 @@
 import pandas as pd
+import numpy as np
 import sys
 import logging
 import os
 from datetime import datetime, timezone
 import boto3
 import io
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared modules sit next to this file in the image and in scripts/common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import schema
+from schema import apply_schema, read_csv
+from compression import codec_from_path, write_csv
+from partitions import (PARTITION_COLUMN, PARTITION_FORMAT, is_dataset_path, location, partition_file,
+                        record_partition, split_partitions, update_index)
+from stage_cache import input_fingerprints, restore, stage_key, store
+from telemetry import add, finish, phase, start_stage
 
 # Configure logging
 logging.basicConfig(
@@ -17,10 +29,42 @@ logger = logging.getLogger(__name__)
 # Initialize S3 client
 s3_client = boto3.client('s3')
 
+# Intermediate files ending in .parquet are written as compressed Parquet, anything else as CSV
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+
+# Batch whose files a dataset output holds (the run's KPI batch id); each batch writes its own file per order_date
+BATCH_ID = os.environ.get("KPI_BATCH_ID", "")
+
+# The fused and sharded pipelines transform in memory; with these set they also write the transformed rows
+# into the shared datasets the staged transform writes, so later range recomputes find every day
+ORDERS_DATASET = os.environ.get("ORDERS_DATASET", "")
+ORDER_ITEMS_DATASET = os.environ.get("ORDER_ITEMS_DATASET", "")
+
+# Raw input columns each transformation uses; everything else (shipped_at, delivered_at, ...) is not loaded
+INPUT_COLUMNS = {
+    'order_items': ['order_id', 'user_id', 'product_id', 'status', 'created_at', 'sale_price', 'returned_at'],
+    'orders': ['order_id', 'user_id', 'status', 'created_at', 'num_of_item', 'returned_at'],
+}
+PRODUCTS_COLUMNS = ['id', 'category']
+
+# Persistent products dimension cache (local path or s3:// URI of an .npz file, empty disables it)
+PRODUCTS_CACHE_PATH = os.environ.get("PRODUCTS_CACHE_PATH", "")
+# Dimensions already loaded by this process, keyed by products file and fingerprint
+_products_dimensions = {}
+
+# Parallel mode: with more than one worker, orders and order items are transformed in row chunks of at
+# most TRANSFORM_CHUNK_ROWS rows on a process pool; the output is the same as the serial transform's
+TRANSFORM_WORKERS = int(os.environ.get("TRANSFORM_WORKERS", "1"))
+TRANSFORM_CHUNK_ROWS = int(os.environ.get("TRANSFORM_CHUNK_ROWS", "500000"))
+
 def is_s3_path(path):
     """Check if the path is an S3 path"""
     return path.startswith('s3://')
 
+def is_parquet_path(path):
+    """Check if the path points to a Parquet file"""
+    return path.endswith('.parquet')
+
 def parse_s3_path(s3_path):
     """Extract bucket and key from S3 path"""
     path = s3_path.replace('s3://', '')
@@ -28,13 +72,16 @@ def parse_s3_path(s3_path):
     key = '/'.join(path.split('/')[1:])
     return bucket, key
 
-def read_csv_from_s3(s3_path):
+def read_csv_from_s3(s3_path, schema=None, columns=None, strict=True):
     """Read CSV file from S3"""
     bucket, key = parse_s3_path(s3_path)
     try:
         logger.info(f"Reading data from s3://{bucket}/{key}")
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        df = pd.read_csv(io.BytesIO(response['Body'].read()))
+        with phase('read'):
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        add(bytes_in=len(body))
+        with phase('parse'):
+            df = read_csv(body, schema, columns=columns, strict=strict)
         logger.info(f"Successfully read {len(df)} records from S3")
         return df
     except Exception as e:
@@ -46,53 +93,253 @@ def write_csv_to_s3(df, s3_path):
     bucket, key = parse_s3_path(s3_path)
     try:
         logger.info(f"Writing {len(df)} records to s3://{bucket}/{key}")
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=csv_buffer.getvalue()
-        )
+        with phase('write'):
+            # Compressed as it is written when the key ends in .gz or .zst
+            buffer = io.BytesIO()
+            size = write_csv(df, buffer, codec_from_path(key))
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=buffer.getvalue()
+            )
+        add(bytes_out=size)
         logger.info(f"Successfully wrote data to S3")
-        return True
+        return size
     except Exception as e:
         logger.error(f"Failed to write to S3: {str(e)}")
         raise e
 
-def transform_order_items(df, products_df):
-    """Transform order items data"""
+def read_parquet_from_s3(s3_path, columns=None):
+    """Read Parquet file from S3"""
+    bucket, key = parse_s3_path(s3_path)
+    try:
+        logger.info(f"Reading data from s3://{bucket}/{key}")
+        with phase('read'):
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        add(bytes_in=len(body))
+        with phase('parse'):
+            df = pd.read_parquet(io.BytesIO(body), columns=columns)
+        logger.info(f"Successfully read {len(df)} records from S3")
+        return df
+    except Exception as e:
+        logger.error(f"Failed to read from S3: {str(e)}")
+        raise e
+
+def write_parquet_to_s3(df, s3_path):
+    """Write dataframe to Parquet in S3"""
+    bucket, key = parse_s3_path(s3_path)
+    try:
+        logger.info(f"Writing {len(df)} records to s3://{bucket}/{key}")
+        with phase('write'):
+            parquet_buffer = io.BytesIO()
+            df.to_parquet(parquet_buffer, index=False, compression=PARQUET_COMPRESSION)
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=parquet_buffer.getvalue()
+            )
+        add(bytes_out=parquet_buffer.getbuffer().nbytes)
+        logger.info("Successfully wrote data to S3")
+        return parquet_buffer.getbuffer().nbytes
+    except Exception as e:
+        logger.error(f"Failed to write to S3: {str(e)}")
+        raise e
+
+def read_table(path, schema=None, columns=None, strict=True):
+    """Read a CSV or Parquet file (picked from the extension) from S3 or local disk.
+
+    CSV files are typed with the declared schema (detected from the header when not given);
+    columns is a list, or a dict of lists keyed by schema name. strict=False leaves values
+    unconverted for validation. Parquet files keep their types.
+    """
+    if is_parquet_path(path):
+        columns = columns.get(schema) if isinstance(columns, dict) else columns
+        if is_s3_path(path):
+            df = read_parquet_from_s3(path, columns=columns)
+        else:
+            add(bytes_in=os.path.getsize(path))
+            with phase('parse'):
+                df = pd.read_parquet(path, columns=columns)
+        return apply_schema(df, schema) if schema and strict else df
+    if is_s3_path(path):
+        return read_csv_from_s3(path, schema, columns=columns, strict=strict)
+    logger.info(f"Reading data from local file: {path}")
+    add(bytes_in=os.path.getsize(path))
+    with phase('parse'):
+        df = read_csv(path, schema, columns=columns, strict=strict)
+    logger.info(f"Successfully read {len(df)} records from local file")
+    return df
+
+def write_table(df, path):
+    """Write a dataframe as CSV or Parquet (picked from the extension) to S3 or local disk; returns the bytes written"""
+    if is_s3_path(path):
+        if is_parquet_path(path):
+            return write_parquet_to_s3(df, path)
+        return write_csv_to_s3(df, path)
+    logger.info(f"Writing {len(df)} records to local file: {path}")
+    with phase('write'):
+        if is_parquet_path(path):
+            df.to_parquet(path, index=False, compression=PARQUET_COMPRESSION)
+        else:
+            df.to_csv(path, index=False)
+    size = os.path.getsize(path)
+    add(bytes_out=size)
+    logger.info("Successfully wrote data to local file")
+    return size
+
+def write_partitioned(df, dataset, batch=None):
+    """Write a transformed dataframe into dataset as one file per order_date for the batch, and index them.
+
+    The dataset is shared by every run: other batches' files are kept, and a batch written
+    again replaces its own earlier files, so a retried run does not add its rows twice.
+    Returns the index entries of the files written, by order_date.
+    """
+    batch = BATCH_ID if batch is None else batch
+    if PARTITION_COLUMN not in df.columns:
+        raise ValueError(f"Only data with an {PARTITION_COLUMN} column can be written as a partitioned dataset")
+    written = {}
+    for value, rows in split_partitions(df):
+        relative_path = partition_file(value, PARTITION_FORMAT, batch)
+        path = location(dataset, relative_path)
+        if not is_s3_path(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        written[value] = {'path': relative_path, 'rows': len(rows), 'bytes': write_table(rows, path)}
+    # The index is updated last, so readers never see a file that is only half written
+    index_partitions(dataset, written, batch)
+    logger.info(f"Wrote {len(written)} {PARTITION_COLUMN} partitions of batch '{batch}' to {dataset}")
+    return written
+
+def write_datasets(orders_df, order_items_df, batch=None):
+    """Write transformed orders and order items into ORDERS_DATASET and ORDER_ITEMS_DATASET, where set"""
+    for df, dataset in ((orders_df, ORDERS_DATASET), (order_items_df, ORDER_ITEMS_DATASET)):
+        if dataset:
+            write_partitioned(df, dataset, batch)
+
+def dataset_outputs(dataset, partitions):
+    """Stage cache outputs for the partition files a run wrote into a dataset, named by order_date"""
+    return {f"partition_{value}": location(dataset, entry['path']) for value, entry in partitions.items()}
+
+def index_partitions(dataset, partitions, batch=None):
+    """Record a batch's partition files (freshly written or put back from the stage cache) in the dataset's index"""
+    batch = BATCH_ID if batch is None else batch
+
+    def apply(index):
+        for value, entry in partitions.items():
+            record_partition(index, value, entry['path'], entry['rows'], entry['bytes'], batch)
+
+    with phase('write'):
+        update_index(dataset, apply)
+
+def products_fingerprint(products_file):
+    """Identify the current version of the products file by S3 ETag or local mtime and size"""
+    if is_s3_path(products_file):
+        bucket, key = parse_s3_path(products_file)
+        return s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+    stat = os.stat(products_file)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def build_products_dimension(products_df, fingerprint=''):
+    """Encode products as a dense array mapping product_id to a category code"""
+    products_df.columns = [col.lower().replace(' ', '_') for col in products_df.columns]
+    if 'id' not in products_df.columns:
+        logger.error("Products dataframe missing 'id' column")
+        raise ValueError("Products dataframe missing 'id' column")
+
+    product_ids = products_df['id'].to_numpy(dtype=np.int64)
+    codes, categories = pd.factorize(products_df['category'], sort=True)
+    # Index = product_id, value = category code, -1 = unknown product
+    lookup = np.full(product_ids.max() + 1 if len(product_ids) else 0, -1, dtype=np.int32)
+    lookup[product_ids] = codes
+    return {
+        'lookup': lookup,
+        'categories': np.asarray(categories, dtype=str),
+        'fingerprint': fingerprint,
+    }
+
+def read_products_cache(cache_path):
+    """Load a cached products dimension, or None if there is no cache yet"""
+    try:
+        if is_s3_path(cache_path):
+            bucket, key = parse_s3_path(cache_path)
+            data = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        else:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+    except (s3_client.exceptions.NoSuchKey, FileNotFoundError):
+        return None
+    with np.load(io.BytesIO(data), allow_pickle=False) as cached:
+        return {
+            'lookup': cached['lookup'],
+            'categories': cached['categories'],
+            'fingerprint': str(cached['fingerprint']),
+        }
+
+def write_products_cache(dimension, cache_path):
+    """Persist the products dimension so later runs can skip parsing products.csv"""
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **dimension)
+    if is_s3_path(cache_path):
+        bucket, key = parse_s3_path(cache_path)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+    else:
+        with open(cache_path, 'wb') as f:
+            f.write(buffer.getvalue())
+    logger.info(f"Products dimension cached at {cache_path}")
+
+def load_products_dimension(products_file, cache_path=None):
+    """Return the products dimension, rebuilding it only when the products file changed"""
+    cache_path = PRODUCTS_CACHE_PATH if cache_path is None else cache_path
+    fingerprint = products_fingerprint(products_file)
+    memo_key = (products_file, fingerprint)
+    if memo_key in _products_dimensions:
+        return _products_dimensions[memo_key]
+
+    dimension = read_products_cache(cache_path) if cache_path else None
+    if dimension is not None and dimension['fingerprint'] == fingerprint:
+        logger.info(f"Using cached products dimension ({len(dimension['categories'])} categories)")
+    else:
+        logger.info("Products changed or not cached, rebuilding products dimension")
+        dimension = build_products_dimension(read_table(products_file, 'products', PRODUCTS_COLUMNS), fingerprint)
+        if cache_path:
+            write_products_cache(dimension, cache_path)
+    _products_dimensions[memo_key] = dimension
+    return dimension
+
+def lookup_categories(product_ids, dimension):
+    """Map product ids to categories by array index; returns a categorical and the unknown count"""
+    lookup = dimension['lookup']
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+    known = (product_ids >= 0) & (product_ids < len(lookup))
+    codes = np.full(len(product_ids), -1, dtype=np.int32)
+    codes[known] = lookup[product_ids[known]]
+    # Code -1 is a missing value, so unknown products stay NaN as they did with the left merge
+    labels = pd.Categorical.from_codes(codes, categories=dimension['categories'].astype(object))
+    return labels, int((codes == -1).sum())
+
+def transform_order_items(df, products, transformed_at=None):
+    """Transform order items data
+
+    products is either a products dataframe or a dimension from load_products_dimension.
+    transformed_at defaults to the current time.
+    """
     logger.info(f"Starting order items transformation process")
     
     # Standardize column names
     df.columns = [col.lower().replace(' ', '_') for col in df.columns]
-    products_df.columns = [col.lower().replace(' ', '_') for col in products_df.columns]
+    if isinstance(products, pd.DataFrame):
+        products = build_products_dimension(products)
     
-    # Convert timestamps to datetime
-    time_cols = ['created_at', 'shipped_at', 'delivered_at', 'returned_at']
-    for col in time_cols:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce')
+    # Parse timestamps with the fixed raw format and use the declared compact types
+    df = apply_schema(df, 'order_items')
     
-    # Convert sale_price to float
-    df['sale_price'] = df['sale_price'].astype(float)
+    # Add order_date for KPI grouping (a handful of distinct days, so categorical)
+    df['order_date'] = df['created_at'].dt.date.astype('category')
     
-    # Add order_date for KPI grouping
-    df['order_date'] = df['created_at'].dt.date
-    
-    # Join with products to get category
-    if 'id' not in products_df.columns:
-        logger.error("Products dataframe missing 'id' column")
-        raise ValueError("Products dataframe missing 'id' column")
-    
-    logger.info("Joining order items with product data")
-    df = df.merge(products_df[['id', 'category']], 
-                  left_on='product_id', 
-                  right_on='id', 
-                  how='left')
-    
-    # Handle column renaming due to merge
-    if 'id_x' in df.columns and 'id_y' in df.columns:
-        df = df.rename(columns={'id_x': 'id'}).drop(columns=['id_y'])
+    # Attach category with a dense array lookup instead of a merge on product_id
+    logger.info("Looking up product categories")
+    df['category'], unknown_products = lookup_categories(df['product_id'], products)
+    if unknown_products:
+        logger.warning(f"{unknown_products} order items reference unknown product ids")
     
     # Keep only relevant columns for KPIs
     keep_cols = ['order_id', 'user_id', 'product_id', 'status', 'created_at', 'order_date', 
@@ -102,29 +349,29 @@ def transform_order_items(df, products_df):
     df = df[keep_cols]
     
     # Add transformed_at timestamp (timezone-aware UTC)
-    df.loc[:, 'transformed_at'] = datetime.now(timezone.utc).isoformat()
+    df.loc[:, 'transformed_at'] = transformed_at or datetime.now(timezone.utc).isoformat()
     
     logger.info(f"Order items transformation completed successfully: {len(df)} records processed")
-    return df, "✔️ Order items transformation completed"
+    return df, order_items_message(unknown_products)
 
-def transform_orders(df):
-    """Transform orders data"""
+def order_items_message(unknown_products):
+    message = "✔️ Order items transformation completed"
+    if unknown_products:
+        message += f" ({unknown_products} items with unknown product ids)"
+    return message
+
+def transform_orders(df, transformed_at=None):
+    """Transform orders data; transformed_at defaults to the current time"""
     logger.info(f"Starting orders transformation process")
     
     # Standardize column names
     df.columns = [col.lower().replace(' ', '_') for col in df.columns]
     
-    # Convert timestamps to datetime
-    time_cols = ['created_at', 'shipped_at', 'delivered_at', 'returned_at']
-    for col in time_cols:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce')
-    
-    # Convert num_of_item to integer
-    df['num_of_item'] = df['num_of_item'].astype(int)
+    # Parse timestamps with the fixed raw format and narrow num_of_item and the ids to their declared types
+    df = apply_schema(df, 'orders')
     
-    # Add order_date for KPI grouping
-    df['order_date'] = df['created_at'].dt.date
+    # Add order_date for KPI grouping (a handful of distinct days, so categorical)
+    df['order_date'] = df['created_at'].dt.date.astype('category')
     
     # Keep only relevant columns for KPIs
     keep_cols = ['order_id', 'user_id', 'status', 'created_at', 'order_date', 'num_of_item', 'returned_at']
@@ -133,11 +380,49 @@ def transform_orders(df):
     df = df[keep_cols]
     
     # Add transformed_at timestamp (timezone-aware UTC)
-    df.loc[:, 'transformed_at'] = datetime.now(timezone.utc).isoformat()
+    df.loc[:, 'transformed_at'] = transformed_at or datetime.now(timezone.utc).isoformat()
     
     logger.info(f"Orders transformation completed successfully: {len(df)} records processed")
     return df, "✔️ Orders transformation completed"
 
+def transform_chunk(file_type, chunk, products, transformed_at):
+    """Transform one row chunk in a pool worker"""
+    if file_type == 'order_items':
+        return transform_order_items(chunk, products, transformed_at)
+    return transform_orders(chunk, transformed_at)
+
+def transform_parallel(df, file_type, products=None, workers=None, chunk_rows=None):
+    """Transform orders or order items in row chunks on a process pool.
+
+    The chunks share one transformed_at and are put back together in their original order,
+    so the result is identical to the serial transform's. df may still hold unconverted
+    values (read with strict=False), so the timestamp parsing is spread over the workers too.
+    With one worker this is the serial transform.
+    """
+    workers = TRANSFORM_WORKERS if workers is None else workers
+    chunk_rows = TRANSFORM_CHUNK_ROWS if chunk_rows is None else chunk_rows
+    transformed_at = datetime.now(timezone.utc).isoformat()
+    if isinstance(products, pd.DataFrame):
+        products = build_products_dimension(products)
+    if workers <= 1 or len(df) < 2:
+        return transform_chunk(file_type, df, products, transformed_at)
+
+    chunk_rows = max(1, min(chunk_rows, -(-len(df) // workers)))
+    chunks = [df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows)]
+    logger.info(f"Transforming {len(df)} {file_type} rows in {len(chunks)} chunks on {workers} workers")
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        results = [result for result, _ in pool.map(transform_chunk, [file_type] * len(chunks), chunks,
+                                                      [products] * len(chunks), [transformed_at] * len(chunks))]
+    transformed = pd.concat(results, ignore_index=True)
+    # Chunks with different order_dates come back with different categories; restore the serial categoricals
+    for column, dtype in results[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and not isinstance(transformed[column].dtype, pd.CategoricalDtype):
+            transformed[column] = transformed[column].astype('category')
+    if file_type == 'order_items':
+        # Unknown product ids are the rows left without a category
+        return transformed, order_items_message(int(transformed['category'].isna().sum()))
+    return transformed, "✔️ Orders transformation completed"
+
 def transform_products(df):
     """Transform products data"""
     logger.info(f"Starting products transformation process")
@@ -160,62 +445,78 @@ def transform_products(df):
     return df, "✔️ Products transformation completed"
 
 def main(input_file, products_file, output_file):
+    start_stage('transform', 'TRANSFORM', input=input_file)
     try:
         logger.info(f"Starting transformation process")
         logger.info(f"Input file: {input_file}")
         logger.info(f"Products file: {products_file}")
         logger.info(f"Output file: {output_file}")
-        
-        # Read CSV file(s) based on path type
-        if is_s3_path(input_file):
-            df = read_csv_from_s3(input_file)
+
+        # Identical input and products files were already transformed by this code: copy that output into place.
+        # A dataset's partitions are only known from the cached result, and are indexed once copied back.
+        dataset = is_dataset_path(output_file)
+        output_format = f'{PARTITION_FORMAT} dataset' if dataset else os.path.splitext(output_file)[1]
+        cache_key = stage_key('transform', input_fingerprints({'input': input_file, 'products': products_file}),
+                              params={'format': output_format, 'batch': BATCH_ID if dataset else '',
+                                      'parquet_compression': PARQUET_COMPRESSION},
+                              code=[__file__, schema.__file__])
+        if dataset:
+            cached = restore('transform', cache_key, lambda result: dataset_outputs(output_file, result['partitions']))
+            if cached is not None:
+                index_partitions(output_file, cached['partitions'])
         else:
-            logger.info(f"Reading data from local file: {input_file}")
-            df = pd.read_csv(input_file)
-            logger.info(f"Successfully read {len(df)} records from local file")
+            cached = restore('transform', cache_key, {'output': output_file})
+        if cached is not None:
+            finish("TRANSFORM_SUCCESS", cached['message'])
+            sys.exit(0)
+        
+        # Read input file(s) based on path type and extension, loading only the columns the transformation uses.
+        # In parallel mode values are converted by the pool workers, chunk by chunk.
+        df = read_table(input_file, columns=INPUT_COLUMNS, strict=TRANSFORM_WORKERS <= 1)
+        add(rows_in=len(df))
         
-        # Read products file if provided
-        products_df = None
+        # Load the products dimension if a products file is provided
+        products_dimension = None
         if products_file:
-            if is_s3_path(products_file):
-                products_df = read_csv_from_s3(products_file)
-            else:
-                logger.info(f"Reading products data from local file: {products_file}")
-                products_df = pd.read_csv(products_file)
-                logger.info(f"Successfully read {len(products_df)} records from local file")
+            products_dimension = load_products_dimension(products_file)
         
         # Transform based on file type
         if 'product_id' in df.columns and 'sale_price' in df.columns:
-            if products_df is None:
+            if products_dimension is None:
                 logger.error("Products file required for order_items transformation")
-                print("TRANSFORM_FAILED: ❌ Products file required for order_items transformation")
+                finish("TRANSFORM_FAILED", "❌ Products file required for order_items transformation")
                 sys.exit(1)
-            transformed_df, message = transform_order_items(df, products_df)
+            with phase('process'):
+                transformed_df, message = transform_parallel(df, 'order_items', products_dimension)
         elif 'num_of_item' in df.columns:
-            transformed_df, message = transform_orders(df)
+            with phase('process'):
+                transformed_df, message = transform_parallel(df, 'orders')
         elif 'sku' in df.columns:
-            transformed_df, message = transform_products(df)
+            with phase('process'):
+                transformed_df, message = transform_products(df)
         else:
             logger.error("Unable to determine file type from columns")
-            print("TRANSFORM_FAILED: ❌ Unknown file format")
+            finish("TRANSFORM_FAILED", "❌ Unknown file format")
             sys.exit(1)
         
-        # Save transformed data
-        if is_s3_path(output_file):
-            write_csv_to_s3(transformed_df, output_file)
+        # Save transformed data (Parquet keeps the dtypes for the compute stage), one file per order_date for a dataset
+        if dataset:
+            partitions = write_partitioned(transformed_df, output_file)
+            store('transform', cache_key, {'message': message, 'partitions': partitions},
+                  dataset_outputs(output_file, partitions))
         else:
-            logger.info(f"Writing {len(transformed_df)} records to local file: {output_file}")
-            transformed_df.to_csv(output_file, index=False)
-            logger.info("Successfully wrote data to local file")
+            write_table(transformed_df, output_file)
+            store('transform', cache_key, {'message': message}, {'output': output_file})
+        add(rows_out=len(transformed_df))
         
         # Output result for Step Functions
         logger.info(f"Transformation completed successfully: {message}")
-        print(f"TRANSFORM_SUCCESS: {message}")
+        finish("TRANSFORM_SUCCESS", message)
         sys.exit(0)
     
     except Exception as e:
         logger.error(f"Error in transformation process: {str(e)}")
-        print(f"TRANSFORM_FAILED: ❌ Error transforming file - {str(e)}")
+        finish("TRANSFORM_FAILED", f"❌ Error transforming file - {str(e)}")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -226,7 +527,8 @@ if __name__ == "__main__":
     
     if not input_file or not output_file:  # products_file can be optional
         logger.error("Required environment variables missing (INPUT_FILE and OUTPUT_FILE are mandatory)")
-        print("TRANSFORM_FAILED: ❌ Please provide INPUT_FILE and OUTPUT_FILE environment variables")
+        start_stage('transform', 'TRANSFORM')
+        finish("TRANSFORM_FAILED", "❌ Please provide INPUT_FILE and OUTPUT_FILE environment variables")
         sys.exit(1)
     
     # Handle 'none' case for products_file
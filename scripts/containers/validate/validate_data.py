@@ -1,9 +1,22 @@
 import pandas as pd
+import numpy as np
 import sys
+import json
 import logging
 import os
+import shutil
+import tempfile
 from datetime import datetime
 
+# Shared modules sit next to this file in the image and in scripts/common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import schema
+from schema import TIMESTAMP_FORMAT, read_csv
+from compression import (codec_from_path, compress_chunks, iter_stream, pandas_compression, with_codec,
+                         without_codec)
+from stage_cache import input_fingerprints, restore, stage_key, store
+from telemetry import add, file_size, finish, phase, record, start_stage
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -12,108 +25,336 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+VALID_STATUSES = ['delivered', 'returned', 'shipped', 'pending']
+# Number of offending row numbers kept per rule in the report
+SAMPLE_ROWS = 5
+# Rows per chunk for streaming validation (0 reads the whole file at once)
+CHUNK_SIZE = int(os.environ.get("VALIDATE_CHUNK_SIZE", "0"))
+# reject fails the whole file on any bad row; quarantine sets bad rows aside and passes the rest on
+VALIDATE_MODE = os.environ.get("VALIDATE_MODE", "reject")
+# Folder or s3:// prefix receiving the quarantined rows of each file
+QUARANTINE_PATH = os.environ.get("QUARANTINE_PATH", "")
+# The whole file still fails when more rows than this would be quarantined (0 rows = no limit)
+QUARANTINE_MAX_FRACTION = float(os.environ.get("QUARANTINE_MAX_FRACTION", "0.01"))
+QUARANTINE_MAX_ROWS = int(os.environ.get("QUARANTINE_MAX_ROWS", "0"))
+
+# Rules are (kind, column, argument) and are evaluated as vectorized boolean masks
+ORDER_ITEMS_RULES = {
+    'schema': 'order_items',
+    'required_columns': ['id', 'order_id', 'user_id', 'product_id', 'status', 'created_at', 'sale_price'],
+    'checks': [
+        ('not_null', 'id', None),
+        ('not_null', 'order_id', None),
+        ('not_null', 'user_id', None),
+        ('not_null', 'product_id', None),
+        ('not_null', 'status', None),
+        ('not_null', 'created_at', None),
+        ('enum', 'status', VALID_STATUSES),
+        ('timestamp', 'created_at', TIMESTAMP_FORMAT),
+        ('min_value', 'sale_price', 0),
+    ],
+}
+
+ORDERS_RULES = {
+    'schema': 'orders',
+    'required_columns': ['order_id', 'user_id', 'status', 'created_at', 'num_of_item'],
+    'checks': [
+        ('not_null', 'order_id', None),
+        ('not_null', 'user_id', None),
+        ('not_null', 'status', None),
+        ('not_null', 'created_at', None),
+        ('enum', 'status', VALID_STATUSES),
+        ('timestamp', 'created_at', TIMESTAMP_FORMAT),
+        ('greater_than', 'num_of_item', 0),
+    ],
+}
+
+RULE_DESCRIPTIONS = {
+    'not_null': 'null values in {column}',
+    'enum': 'invalid {column} values',
+    'timestamp': 'invalid timestamp format in {column}',
+    'min_value': '{column} values that are non-numeric or below {argument}',
+    'greater_than': '{column} values that are non-numeric or not above {argument}',
+}
+
+def rule_mask(series, kind, argument):
+    """Return a boolean mask of the rows that break a rule"""
+    if kind == 'not_null':
+        return series.isnull()
+    present = series.notnull()
+    if kind == 'enum':
+        return present & ~series.isin(argument)
+    if kind == 'timestamp':
+        # One fixed-format parse of the whole column instead of strptime per row
+        parsed = pd.to_datetime(series.astype('string'), format=argument, errors='coerce')
+        return present & parsed.isnull()
+    if kind in ('min_value', 'greater_than'):
+        values = pd.to_numeric(series, errors='coerce')
+        out_of_range = values < argument if kind == 'min_value' else values <= argument
+        return (present & values.isnull()) | out_of_range
+    raise ValueError(f"Unknown rule kind: {kind}")
+
+def evaluate_rules(df, rules, row_offset=0, masks=None):
+    """Evaluate every rule against a dataframe and return a structured report.
+
+    Sample rows are 1-based data row numbers (the header is not counted),
+    shifted by row_offset when the dataframe is a slice of a larger file.
+    When masks is a dict, each rule's boolean mask is stored in it by rule name.
+    """
+    missing_cols = [col for col in rules['required_columns'] if col not in df.columns]
+    report = {'rows': len(df), 'missing_columns': missing_cols, 'rules': []}
+    for kind, column, argument in rules['checks']:
+        if column in missing_cols:
+            continue
+        mask = rule_mask(df[column], kind, argument).to_numpy(dtype=bool)
+        failed_rows = np.flatnonzero(mask)
+        if masks is not None:
+            masks[f"{kind}:{column}"] = mask
+        report['rules'].append({
+            'rule': f"{kind}:{column}",
+            'kind': kind,
+            'column': column,
+            'argument': argument,
+            'failed': int(len(failed_rows)),
+            'sample_rows': (failed_rows[:SAMPLE_ROWS] + row_offset + 1).tolist(),
+        })
+    report['passed'] = not missing_cols and all(rule['failed'] == 0 for rule in report['rules'])
+    return report
+
+def summarize_report(report, label):
+    """Turn a validation report into the (success, message) pair used for Step Functions"""
+    if report['passed']:
+        logger.info(f"{label} validation passed")
+        return True, f"✔️ {label} validation passed"
+
+    logger.error(f"{label} validation report: {json.dumps(report)}")
+    return False, f"❌ {describe_problems(report)}"
+
+def describe_problems(report):
+    """One readable line listing the missing columns and every failed rule"""
+    problems = []
+    if report['missing_columns']:
+        problems.append(f"Missing columns: {report['missing_columns']}")
+    for rule in report['rules']:
+        if rule['failed']:
+            description = RULE_DESCRIPTIONS[rule['kind']].format(column=rule['column'], argument=rule['argument'])
+            rows = ', '.join(str(row) for row in rule['sample_rows'])
+            problems.append(f"{rule['failed']} {description} (rows {rows})")
+    return '; '.join(problems)
+
+def merge_reports(total, report):
+    """Fold the report of one chunk into the running report for the whole file"""
+    total['rows'] += report['rows']
+    for total_rule, rule in zip(total['rules'], report['rules']):
+        total_rule['failed'] += rule['failed']
+        room = SAMPLE_ROWS - len(total_rule['sample_rows'])
+        if room > 0:
+            total_rule['sample_rows'].extend(rule['sample_rows'][:room])
+    total['passed'] = total['passed'] and report['passed']
+    return total
+
+def detect_file_type(columns):
+    """Pick the rule set and label for a file from its header"""
+    if 'product_id' in columns and 'sale_price' in columns:
+        return ORDER_ITEMS_RULES, "Order items"
+    if 'num_of_item' in columns:
+        return ORDERS_RULES, "Orders"
+    return None, None
+
+def validate_in_chunks(file_path, chunk_size):
+    """Validate a CSV chunk by chunk so peak memory does not grow with the file"""
+    with phase('parse'):
+        header = pd.read_csv(file_path, nrows=0, compression=pandas_compression(file_path)).columns
+    rules, label = detect_file_type(header)
+    if rules is None:
+        return None
+
+    # Only load the columns the rules look at, with the schema's categorical types
+    report = evaluate_rules(pd.DataFrame(columns=header), rules)
+    row_offset = 0
+    chunks = read_csv(file_path, rules['schema'], columns=rules['required_columns'], strict=False,
+                      chunksize=chunk_size)
+    while True:
+        with phase('parse'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with phase('process'):
+            merge_reports(report, evaluate_rules(chunk, rules, row_offset=row_offset))
+        row_offset += len(chunk)
+    add(rows_in=row_offset)
+    return summarize_report(report, label)
+
+def split_rows(df, rules, row_offset=0):
+    """Evaluate the rules and split a dataframe into its clean rows and its failing rows.
+
+    Failing rows gain a 1-based source_row and a violations column listing the rules they
+    break, separated by ';'. Returns (report, clean, failing).
+    """
+    masks = {}
+    report = evaluate_rules(df, rules, row_offset=row_offset, masks=masks)
+    bad = np.zeros(len(df), dtype=bool)
+    for mask in masks.values():
+        bad |= mask
+    failed_rows = np.flatnonzero(bad)
+    failing = df.iloc[failed_rows].copy()
+    failing.insert(0, 'source_row', failed_rows + row_offset + 1)
+    failing['violations'] = [';'.join(rule for rule, mask in masks.items() if mask[row]) for row in failed_rows]
+    return report, df[~bad], failing
+
+def within_quarantine_limits(failed, rows):
+    """Whether failed rows out of rows are few enough to quarantine instead of failing the file"""
+    if QUARANTINE_MAX_ROWS and failed > QUARANTINE_MAX_ROWS:
+        return False
+    return rows == 0 or failed / rows <= QUARANTINE_MAX_FRACTION
+
+def quarantine_location(file_path):
+    """Where a file's quarantined rows go: {QUARANTINE_PATH}/{name}_{timestamp}.csv"""
+    name = os.path.splitext(os.path.basename(without_codec(file_path)))[0]
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return f"{QUARANTINE_PATH.rstrip('/')}/{name}_{timestamp}.csv"
+
+def put_file(local_path, path):
+    """Copy a local file to S3 or another local path"""
+    if path.startswith('s3://'):
+        import fsspec
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        fs.put_file(local_path, fs_path)
+    else:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        shutil.copyfile(local_path, path)
+    add(bytes_out=os.path.getsize(local_path))
+
+def compress_file(local_path, codec):
+    """Compress a local file next to itself with codec (None leaves it as it is); returns the path to upload"""
+    if codec is None:
+        return local_path
+    compressed_path = with_codec(local_path, codec)
+    with open(local_path, 'rb') as source, open(compressed_path, 'wb') as target:
+        for data in compress_chunks(iter_stream(source), codec):
+            target.write(data)
+    return compressed_path
+
+def quarantine_file(file_path, chunk_size=0):
+    """Validate a CSV row by row, setting failing rows aside instead of failing the whole file.
+
+    The failing rows are written to QUARANTINE_PATH with their violations, then file_path is
+    rewritten with only the clean rows, so the next stages read it unchanged. The file still
+    fails when a column is missing or more rows fail than the QUARANTINE_MAX_* limits allow.
+    Returns ((success, message), rows quarantined), or (None, 0) for an unknown file.
+    """
+    if not QUARANTINE_PATH:
+        raise ValueError("QUARANTINE_PATH must be set when VALIDATE_MODE is quarantine")
+    with phase('parse'):
+        header = pd.read_csv(file_path, nrows=0, compression=pandas_compression(file_path)).columns
+    rules, label = detect_file_type(header)
+    if rules is None:
+        return None, 0
+    report = evaluate_rules(pd.DataFrame(columns=header), rules)
+    if report['missing_columns']:
+        return summarize_report(report, label), 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        clean_path = os.path.join(folder, 'clean.csv')
+        failing_path = os.path.join(folder, 'quarantine.csv')
+        # Clean rows are written back as they were read, so every column is loaded as text
+        chunks = pd.read_csv(file_path, dtype=str, chunksize=chunk_size or None,
+                             compression=pandas_compression(file_path))
+        if not chunk_size:
+            chunks = iter([chunks])
+        rows = quarantined = 0
+        with open(clean_path, 'w', newline='') as clean, open(failing_path, 'w', newline='') as failing:
+            while True:
+                with phase('parse'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with phase('process'):
+                    chunk_report, clean_rows, failing_rows = split_rows(chunk, rules, row_offset=rows)
+                    merge_reports(report, chunk_report)
+                    clean_rows.to_csv(clean, index=False, header=clean.tell() == 0)
+                    if len(failing_rows):
+                        failing_rows.to_csv(failing, index=False, header=failing.tell() == 0)
+                rows += len(chunk)
+                quarantined += len(failing_rows)
+        add(rows_in=rows)
+        if not quarantined:
+            return summarize_report(report, label), 0
+
+        logger.warning(f"{label} validation report: {json.dumps(report)}")
+        problems = describe_problems(report)
+        if not within_quarantine_limits(quarantined, rows):
+            return (False, f"❌ {quarantined} of {rows} rows failed, over the quarantine limit: {problems}"), 0
+
+        # Quarantined rows are saved before the input is replaced, so no row is ever lost
+        location = quarantine_location(file_path)
+        with phase('write'):
+            put_file(failing_path, location)
+            put_file(compress_file(clean_path, codec_from_path(file_path)), file_path)
+        add(rows_out=rows - quarantined)
+        record(rows_quarantined=quarantined)
+    return (True, f"✔️ {label} validation passed, {quarantined} of {rows} rows quarantined to {location}: "
+                  f"{problems}"), quarantined
+
 def validate_order_items(df):
-    required_columns = ['id', 'order_id', 'user_id', 'product_id', 'status', 'created_at', 'sale_price']
-    
-    # Check for missing columns
-    missing_cols = [col for col in required_columns if col not in df.columns]
-    if missing_cols:
-        logger.error(f"Missing columns: {missing_cols}")
-        return False, f"❌ Missing columns: {missing_cols}"
-    
-    # Check for missing values in critical fields
-    critical_fields = ['id', 'order_id', 'user_id', 'product_id', 'status', 'created_at']
-    for col in critical_fields:
-        if df[col].isnull().any():
-            logger.error(f"Null values found in {col}")
-            return False, f"❌ Null values found in {col}"
-    
-    # Validate status values
-    valid_statuses = ['delivered', 'returned', 'shipped', 'pending']
-    if not df['status'].isin(valid_statuses).all():
-        logger.error("Invalid status values found")
-        return False, "❌ Invalid status values found"
-    
-    # Validate timestamp format
-    try:
-        df['created_at'].apply(lambda x: datetime.strptime(x, '%Y-%m-%dT%H:%M:%S'))
-    except (ValueError, TypeError):
-        logger.error("Invalid timestamp format in created_at")
-        return False, "❌ Invalid timestamp format in created_at"
-    
-    # Check sale_price is numeric and non-negative
-    if not pd.api.types.is_numeric_dtype(df['sale_price']) or (df['sale_price'] < 0).any():
-        logger.error("Sale_price must be numeric and non-negative")
-        return False, "❌ Sale_price must be numeric and non-negative"
-    
-    logger.info("Order items validation passed")
-    return True, "✔️ Order items validation passed"
+    return summarize_report(evaluate_rules(df, ORDER_ITEMS_RULES), "Order items")
 
 def validate_orders(df):
-    required_columns = ['order_id', 'user_id', 'status', 'created_at', 'num_of_item']
-    
-    # Check for missing columns
-    missing_cols = [col for col in required_columns if col not in df.columns]
-    if missing_cols:
-        logger.error(f"Missing columns: {missing_cols}")
-        return False, f"❌ Missing columns: {missing_cols}"
-    
-    # Check for missing values in critical fields
-    critical_fields = ['order_id', 'user_id', 'status', 'created_at']
-    for col in critical_fields:
-        if df[col].isnull().any():
-            logger.error(f"Null values found in {col}")
-            return False, f"❌ Null values found in {col}"
-    
-    # Validate status values
-    valid_statuses = ['delivered', 'returned', 'shipped', 'pending']
-    if not df['status'].isin(valid_statuses).all():
-        logger.error("Invalid status values found")
-        return False, "❌ Invalid status values found"
-    
-    # Validate timestamp format
-    try:
-        df['created_at'].apply(lambda x: datetime.strptime(x, '%Y-%m-%dT%H:%M:%S'))
-    except (ValueError, TypeError):
-        logger.error("Invalid timestamp format in created_at")
-        return False, "❌ Invalid timestamp format in created_at"
-    
-    # Check num_of_item is numeric and positive
-    if not pd.api.types.is_numeric_dtype(df['num_of_item']) or (df['num_of_item'] <= 0).any():
-        logger.error("num_of_item must be numeric and positive")
-        return False, "❌ num_of_item must be numeric and positive"
-    
-    logger.info("Orders validation passed")
-    return True, "✔️ Orders validation passed"
+    return summarize_report(evaluate_rules(df, ORDERS_RULES), "Orders")
 
 def main(file_path):
+    start_stage('validate', 'VALIDATION', input=file_path)
     try:
-        # Read the CSV file
-        df = pd.read_csv(file_path)
-        
-        # Determine file type and validate
-        if 'product_id' in df.columns and 'sale_price' in df.columns:
-            success, message = validate_order_items(df)
-        elif 'num_of_item' in df.columns:
-            success, message = validate_orders(df)
+        # The same file has already passed with these rules, so report that instead of reading it again
+        cache_key = stage_key('validate', input_fingerprints({'input': file_path}), code=[__file__, schema.__file__])
+        cached = restore('validate', cache_key)
+        if cached is not None:
+            finish("VALIDATION_SUCCESS", cached['message'])
+            sys.exit(0)
+
+        add(bytes_in=file_size(file_path))
+        quarantined = 0
+        if VALIDATE_MODE == 'quarantine':
+            result, quarantined = quarantine_file(file_path, CHUNK_SIZE)
+        elif VALIDATE_MODE != 'reject':
+            raise ValueError(f"Unknown VALIDATE_MODE: {VALIDATE_MODE}")
+        elif CHUNK_SIZE > 0:
+            result = validate_in_chunks(file_path, CHUNK_SIZE)
         else:
+            # Pick the rules from the header, then read only the columns they check
+            with phase('parse'):
+                header = pd.read_csv(file_path, nrows=0, compression=pandas_compression(file_path)).columns
+                rules, label = detect_file_type(header)
+            result = None
+            if rules is not None:
+                with phase('parse'):
+                    df = read_csv(file_path, rules['schema'], columns=rules['required_columns'], strict=False)
+                with phase('process'):
+                    result = summarize_report(evaluate_rules(df, rules), label)
+                add(rows_in=len(df))
+
+        if result is None:
             logger.error("Unknown file format")
-            print("VALIDATION_FAILED: ❌ Unknown file format")
+            finish("VALIDATION_FAILED", "❌ Unknown file format")
             sys.exit(1)
+        success, message = result
         
         # Output result for Step Functions
         if success:
             logger.info(message)
-            print(f"VALIDATION_SUCCESS: {message}")
+            # A run that quarantined rows has rewritten its input, so only clean passes are cached
+            if not quarantined:
+                store('validate', cache_key, {'message': message})
+            finish("VALIDATION_SUCCESS", message)
             sys.exit(0)
         else:
             logger.error(message)
-            print(f"VALIDATION_FAILED: {message}")
+            finish("VALIDATION_FAILED", message)
             sys.exit(1)
     
     except Exception as e:
         logger.error(f"Error processing file: {str(e)}")
-        print(f"VALIDATION_FAILED: ❌ Error processing file - {str(e)}")
+        finish("VALIDATION_FAILED", f"❌ Error processing file - {str(e)}")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -121,6 +362,7 @@ if __name__ == "__main__":
     file_path = os.environ.get("FILE_PATH")
     if not file_path:
         logger.error("Please provide a file path via FILE_PATH environment variable")
-        print("VALIDATION_FAILED: ❌ Please provide a file path via FILE_PATH environment variable")
+        start_stage('validate', 'VALIDATION')
+        finish("VALIDATION_FAILED", "❌ Please provide a file path via FILE_PATH environment variable")
         sys.exit(1)
     main(file_path)
\ No newline at end of file
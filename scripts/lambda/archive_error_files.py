@@ -14,10 +14,14 @@ def lambda_handler(event, context):
     
     # Move each processed file to the errors folder
     for file_key in processed_files.values():
-        # Extract the file name from the S3 URI
-        file_name = file_key.split('/')[-1]
-        # Define the new S3 key for the errors folder
-        new_key = os.path.join(error_folder, file_name)
+        # Processed files are passed as S3 URIs; copy and delete need the bare key
+        if file_key.startswith('s3://'):
+            file_key = file_key.split('/', 3)[3]
+        # Keep the <date>/<run id>/ folders of processed/ so runs do not overwrite each other's files
+        if file_key.startswith('processed/'):
+            new_key = os.path.join(error_folder, file_key[len('processed/'):])
+        else:
+            new_key = os.path.join(error_folder, file_key.split('/')[-1])
         
         # Copy the file to the new location
         s3.copy_object(
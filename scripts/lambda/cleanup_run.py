@@ -0,0 +1,35 @@
+import json
+import boto3
+
+s3 = boto3.client('s3')
+
+# DeleteObjects takes at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+def lambda_handler(event, context):
+    # Bucket and the run's temp/<date>/<run id>/ prefix, as passed by the state machine
+    bucket = event['bucket']
+    prefix = event['prefix']
+    if prefix.startswith('s3://'):
+        prefix = prefix.split('/', 3)[3]
+
+    # Only ever delete inside a run folder, never the whole temp/ prefix
+    if not prefix.startswith('temp/') or len(prefix.rstrip('/').split('/')) < 3:
+        raise ValueError(f"Refusing to clean up {prefix}: not a temp/<date>/<run id>/ prefix")
+
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]], 'Quiet': True}
+        )
+
+    print(f"🧹 Deleted {len(keys)} intermediate files under s3://{bucket}/{prefix}")
+    return {
+        'statusCode': 200,
+        'deleted': len(keys),
+        'body': json.dumps(f'Intermediate files of {prefix} deleted.')
+    }
@@ -3,12 +3,355 @@ import boto3
 import csv
 from io import StringIO
 import datetime
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared modules are packaged next to this file and sit in scripts/common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from compression import (check_codec, codec_from_path, compress_chunks, compressor, decompress_chunks,
+                         with_codec)
+from parts import batch_id_for, iter_part_bytes
+from stage_cache import STAGE_CACHE_PATH, expire_entries, restore, stage_key, store
+from telemetry import add, emit, phase, record, start_stage
 
 # Initialize S3 client and Step Functions client
 s3 = boto3.client('s3')
 step_functions = boto3.client('stepfunctions')
 
+# 'stream' pipes part bytes straight into a multipart upload, 'buffered' merges in memory
+MERGE_MODE = os.environ.get('MERGE_MODE', 'stream')
+# S3 requires every multipart part except the last one to be at least 5 MiB
+MULTIPART_PART_SIZE = max(int(os.environ.get('MULTIPART_PART_SIZE', 8 * 1024 * 1024)), 5 * 1024 * 1024)
+READ_CHUNK_SIZE = 1024 * 1024
+# Parallel part fetching (1 worker keeps the sequential streaming read)
+MERGE_WORKERS = int(os.environ.get('MERGE_WORKERS', 4))
+MERGE_MAX_INFLIGHT_BYTES = int(os.environ.get('MERGE_MAX_INFLIGHT_BYTES', 64 * 1024 * 1024))
+# Days whose merged files total less than this run in the single fused task (0 always uses the staged tasks)
+FUSED_MAX_BYTES = int(os.environ.get('FUSED_MAX_BYTES', 100 * 1024 * 1024))
+# Days at least this large are split by order_id and transformed/aggregated in parallel shards (0 disables it)
+SHARDED_MIN_BYTES = int(os.environ.get('SHARDED_MIN_BYTES', 1024 * 1024 * 1024))
+# Merged bytes each shard should get, and the most shards one day is split into
+SHARD_TARGET_BYTES = int(os.environ.get('SHARD_TARGET_BYTES', 256 * 1024 * 1024))
+MAX_SHARDS = int(os.environ.get('MAX_SHARDS', 32))
+# Every run keeps its files under <prefix>/<date>/<run id>/; intermediates left behind by failed runs and
+# the merged inputs and KPI files of every run are deleted after this many days (0 keeps them)
+RUN_TEMP_TTL_DAYS = float(os.environ.get('RUN_TEMP_TTL_DAYS', 3))
+RUN_OUTPUT_TTL_DAYS = float(os.environ.get('RUN_OUTPUT_TTL_DAYS', 30))
+# Run ids are ProcessingRun-<date>-<start time>; expiry only touches folders named like this and dates
+# them by that start time (Lambda clocks are UTC)
+RUN_ID_TIME_FORMAT = '%Y%m%d%H%M%S'
+RUN_FOLDER = re.compile(r'ProcessingRun-.+-(\d{14})/$')
+# DeleteObjects takes at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+# Codec of the merged files and KPI files of a run: '' (plain CSV), 'gzip' or 'zstd'. The stages pick it
+# up from the file names; parts uploaded compressed are recognised and decompressed whatever this is set to
+CSV_COMPRESSION = check_codec(os.environ.get('CSV_COMPRESSION', ''))
+
+
+class MultipartUploadWriter:
+    """Buffer merged bytes and flush them to S3 as multipart upload parts"""
+
+    def __init__(self, bucket, key, part_size=MULTIPART_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            upload = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = upload['UploadId']
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+            Body=body
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        if self.upload_id is None:
+            # Merges smaller than one part never start a multipart upload
+            s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts}
+            )
+        self.buffer = bytearray()
+
+    def abort(self):
+        if self.upload_id is not None:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        self.buffer = bytearray()
+
+
+class ByteBudget:
+    """Cap the bytes held by fetched but not yet merged parts, granting space in manifest order"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.next_ticket = 0
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def acquire(self, ticket, nbytes):
+        with self.condition:
+            # Later parts queue behind earlier ones, so the part the writer needs next is never starved.
+            # A part larger than the whole budget is let through once nothing else is in flight.
+            while not self.cancelled and (
+                ticket != self.next_ticket
+                or (self.in_flight and self.in_flight + nbytes > self.limit)
+            ):
+                self.condition.wait()
+            if self.cancelled:
+                raise RuntimeError("Part fetch cancelled")
+            self.in_flight += nbytes
+            self.next_ticket += 1
+            self.condition.notify_all()
+
+    def release(self, nbytes):
+        with self.condition:
+            self.in_flight -= nbytes
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+
+def fetch_parts_sequentially(bucket, part_keys):
+    """Yield a chunk iterator per existing part, streaming each body as it is merged"""
+    for part_key in part_keys:
+        try:
+            part_obj = s3.get_object(Bucket=bucket, Key=part_key)
+        except s3.exceptions.NoSuchKey:
+            print(f"❌ File not found: {part_key}")
+            continue
+        print(f"📄 Merging {part_key}")
+        add(bytes_in=part_obj.get('ContentLength'))
+        yield part_obj['Body'].iter_chunks(READ_CHUNK_SIZE)
+
+
+def fetch_parts_concurrently(bucket, part_keys, workers, max_inflight_bytes):
+    """Fetch parts on a thread pool and yield them in manifest order with bounded bytes in flight"""
+    budget = ByteBudget(max_inflight_bytes)
+
+    def fetch(ticket, part_key):
+        reserved = False
+        try:
+            part_obj = s3.get_object(Bucket=bucket, Key=part_key)
+            size = part_obj.get('ContentLength', 0)
+            budget.acquire(ticket, size)
+            reserved = True
+            return part_obj['Body'].read(), size
+        except s3.exceptions.NoSuchKey:
+            budget.acquire(ticket, 0)
+            return None, 0
+        except Exception:
+            # Hand the ticket on so later parts are not left waiting behind a failed one
+            if not reserved:
+                budget.acquire(ticket, 0)
+            raise
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(fetch, ticket, part_key) for ticket, part_key in enumerate(part_keys)]
+        for part_key, future in zip(part_keys, futures):
+            data, size = future.result()
+            if data is None:
+                print(f"❌ File not found: {part_key}")
+                continue
+            print(f"📄 Merging {part_key}")
+            add(bytes_in=size)
+            yield [data]
+            del data
+            budget.release(size)
+    finally:
+        budget.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def merge_parts_streaming(bucket, part_keys, merged_key, workers=MERGE_WORKERS,
+                          max_inflight_bytes=MERGE_MAX_INFLIGHT_BYTES):
+    """Merge CSV parts into one object, in manifest order, with bounded memory.
+
+    Compressed parts are decompressed as they stream in, and the merged object is compressed on
+    the way out when merged_key ends in .gz or .zst. Returns the size of the merged CSV text.
+    """
+    writer = MultipartUploadWriter(bucket, merged_key)
+    stream = compressor(codec_from_path(merged_key))
+    if workers > 1:
+        parts = fetch_parts_concurrently(bucket, part_keys, workers, max_inflight_bytes)
+    else:
+        parts = fetch_parts_sequentially(bucket, part_keys)
+    header_written = False
+    merged_bytes = 0
+    try:
+        for chunks in parts:
+            # Keep the header from the first file only, later headers are dropped unparsed
+            for data in iter_part_bytes(decompress_chunks(chunks), not header_written):
+                merged_bytes += len(data)
+                writer.write(stream.compress(data))
+            header_written = True
+        writer.write(stream.flush())
+        writer.close()
+    except Exception:
+        parts.close()
+        writer.abort()
+        raise
+    add(bytes_out=writer.bytes_written)
+    return merged_bytes
+
+
+def merge_parts_buffered(bucket, part_keys, merged_key):
+    """Merge CSV parts in memory and upload them with a single put_object"""
+    # Prepare to merge CSV content
+    merged_content = StringIO()
+    csv_writer = csv.writer(merged_content)
+    header_written = False
+    
+    # Fetch and merge each part
+    for part_key in part_keys:
+        print(f"📄 Merging {part_key}")
+        try:
+            part_obj = s3.get_object(Bucket=bucket, Key=part_key)
+            part_content = b''.join(decompress_chunks([part_obj['Body'].read()])).decode('utf-8').splitlines()
+            add(bytes_in=part_obj.get('ContentLength'))
+        except s3.exceptions.NoSuchKey:
+            print(f"❌ File not found: {part_key}")
+            continue
+        
+        # Read CSV rows
+        csv_reader = csv.reader(part_content)
+        header = next(csv_reader)  # First row is header
+        
+        if not header_written:
+            # Write header from first file only
+            csv_writer.writerow(header)
+            header_written = True
+        
+        # Write all data rows (skip header if not first file)
+        for row in csv_reader:
+            csv_writer.writerow(row)
+    
+    # Upload merged content to S3, compressed when the key names a codec
+    body = merged_content.getvalue().encode('utf-8')
+    compressed = b''.join(compress_chunks([body], codec_from_path(merged_key)))
+    s3.put_object(
+        Bucket=bucket,
+        Key=merged_key,
+        Body=compressed
+    )
+    add(bytes_out=len(compressed))
+    return len(body)
+
+def part_fingerprints(bucket, prefix, part_keys):
+    """ETag and size of each part from one listing of its folder; parts not found are marked missing"""
+    listed = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            etag = obj['ETag'].strip('"')
+            listed[obj['Key']] = f"{etag}-{obj['Size']}"
+    return {part_key: listed.get(part_key, 'missing') for part_key in part_keys}
+
+def select_execution_mode(merged_bytes):
+    """'fused' for small days, 'sharded' for very large ones and 'staged' in between"""
+    if merged_bytes < FUSED_MAX_BYTES:
+        return 'fused'
+    if SHARDED_MIN_BYTES and merged_bytes >= SHARDED_MIN_BYTES:
+        return 'sharded'
+    return 'staged'
+
+
+def shard_count_for(merged_bytes):
+    """Enough shards for about SHARD_TARGET_BYTES each, between 2 and MAX_SHARDS"""
+    return min(MAX_SHARDS, max(2, -(-merged_bytes // SHARD_TARGET_BYTES)))
+
+
+def run_paths(bucket, date, run_id):
+    """Intermediate and output locations of one run, so runs never overwrite each other's files"""
+    temp = f's3://{bucket}/temp/{date}/{run_id}'
+    output = f's3://{bucket}/output/{date}/{run_id}'
+    return {
+        'temp': f'{temp}/',
+        # Trailing '/': datasets partitioned by order_date, shared by every run (each writes its own batch's
+        # files) and kept outside temp/, so cleanup never deletes them and later range recomputes can read them
+        'ordersTransformed': f's3://{bucket}/transformed/orders/',
+        'orderItemsTransformed': f's3://{bucket}/transformed/order_items/',
+        'shards': f'{temp}/shards',
+        'categoryKpis': with_codec(f'{output}/category_kpis.csv', CSV_COMPRESSION),
+        'orderKpis': with_codec(f'{output}/order_kpis.csv', CSV_COMPRESSION),
+    }
+
+
+def run_folders(bucket, prefix):
+    """Yield (folder, start time) of every <prefix><date>/ProcessingRun-.../ folder.
+
+    Only folder names are listed, one date at a time, so files of older layouts such as
+    processed/<date>/orders_merged.csv are never listed or mistaken for runs.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for date_folder in page.get('CommonPrefixes', []):
+            for run_page in paginator.paginate(Bucket=bucket, Prefix=f"{date_folder['Prefix']}ProcessingRun-",
+                                               Delimiter='/'):
+                for run_folder in run_page.get('CommonPrefixes', []):
+                    match = RUN_FOLDER.search(run_folder['Prefix'])
+                    if match:
+                        started = datetime.datetime.strptime(match.group(1), RUN_ID_TIME_FORMAT)
+                        yield run_folder['Prefix'], started.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def expire_runs(bucket, prefix, ttl_days, now=None):
+    """Delete the <prefix><date>/<run id>/ folders of runs started more than ttl_days ago; returns how many"""
+    if not ttl_days:
+        return 0
+    cutoff = (time.time() if now is None else now) - ttl_days * 86400
+    expired = [folder for folder, started in run_folders(bucket, prefix) if started < cutoff]
+    for folder in expired:
+        keys = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=folder):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            s3.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]], 'Quiet': True})
+    if expired:
+        print(f"📄 Deleted {len(expired)} runs under {prefix} older than {ttl_days} days")
+    return len(expired)
+
+
 def lambda_handler(event, context):
+    start_stage('merge')
+    # Drop stage cache entries past their TTL; a failure here must not hold up the merge
+    try:
+        expire_entries()
+    except Exception as e:
+        print(f"❌ Could not expire stage cache entries: {str(e)}")
+
     # Extract bucket and manifest key from the S3 event
     bucket = event['Records'][0]['s3']['bucket']['name']
     manifest_key = event['Records'][0]['s3']['object']['key']
@@ -16,9 +359,20 @@ def lambda_handler(event, context):
     # Parse date and base path from manifest key (e.g., 'data/20250409/manifest_20250409.json')
     date = manifest_key.split('/')[1]  # e.g., '20250409'
     base_path = f'data/{date}/'
+
+    # The execution name doubles as the run id that keeps this run's files apart from every other run's
+    run_id = f'ProcessingRun-{date}-{datetime.datetime.now(datetime.timezone.utc).strftime(RUN_ID_TIME_FORMAT)}'
+    try:
+        expire_runs(bucket, 'temp/', RUN_TEMP_TTL_DAYS)
+        for prefix in ('processed/', 'output/'):
+            expire_runs(bucket, prefix, RUN_OUTPUT_TTL_DAYS)
+    except Exception as e:
+        print(f"❌ Could not expire old runs: {str(e)}")
     
     # Dictionary to store processed file paths
     processed_files = {}
+    merged_bytes = 0
+    fingerprints = {}
     
     # Fetch and read the manifest file
     manifest_obj = s3.get_object(Bucket=bucket, Key=manifest_key)
@@ -32,54 +386,63 @@ def lambda_handler(event, context):
             continue  # Skip if no files for this type
         print(f"📄 Processing {file_type} for {date}")
 
-        # Prepare to merge CSV content
-        merged_content = StringIO()
-        csv_writer = csv.writer(merged_content)
-        header_written = False
-        
-        # Fetch and merge each part
-        for part_file in file_parts:
-            part_key = f'{base_path}{file_type}/{part_file}'
-            print(f"📄 Merging {part_key}")
-            try:
-                part_obj = s3.get_object(Bucket=bucket, Key=part_key)
-                part_content = part_obj['Body'].read().decode('utf-8').splitlines()
-            except s3.exceptions.NoSuchKey:
-                print(f"❌ File not found: {part_key}")
-                continue
-            
-            # Read CSV rows
-            csv_reader = csv.reader(part_content)
-            header = next(csv_reader)  # First row is header
-            
-            if not header_written:
-                # Write header from first file only
-                csv_writer.writerow(header)
-                header_written = True
-            
-            # Write all data rows (skip header if not first file)
-            for row in csv_reader:
-                csv_writer.writerow(row)
-        
-        # Generate merged file key (e.g., 'processed/20250409/orders_merged.csv')
-        merged_key = f'processed/{date}/{file_type}_merged.csv'
-        
-        # Upload merged content to S3
-        s3.put_object(
-            Bucket=bucket,
-            Key=merged_key,
-            Body=merged_content.getvalue()
-        )
+        part_keys = [f'{base_path}{file_type}/{part_file}' for part_file in file_parts]
+
+        # Generate merged file key (e.g., 'processed/20250409/ProcessingRun-20250409-20250410061500/orders_merged.csv')
+        merged_key = with_codec(f'processed/{date}/{run_id}/{file_type}_merged.csv', CSV_COMPRESSION)
+        merged_file = f's3://{bucket}/{merged_key}'
+
+        # The parts' ETags identify the KPI batch, and parts with the same ETags were already
+        # merged in this order when the cache has them: put that merge in place instead
+        part_etags = part_fingerprints(bucket, f'{base_path}{file_type}/', part_keys)
+        fingerprints.update(part_etags)
+        cache_key = None
+        if STAGE_CACHE_PATH:
+            cache_key = stage_key('merge', part_etags,
+                                  params={'parts': part_keys, 'merge_mode': MERGE_MODE,
+                                          'csv_compression': CSV_COMPRESSION}, code=[__file__])
+        cached = restore('merge', cache_key, {'merged': merged_file})
+        if cached is not None:
+            print(f"📄 Reusing the cached merge of {file_type} for {date}")
+            merged_bytes += cached['bytes']
+        else:
+            with phase('process'):
+                if MERGE_MODE == 'buffered':
+                    file_bytes = merge_parts_buffered(bucket, part_keys, merged_key)
+                else:
+                    file_bytes = merge_parts_streaming(bucket, part_keys, merged_key)
+            merged_bytes += file_bytes
+            store('merge', cache_key, {'bytes': file_bytes}, {'merged': merged_file})
         
         # Store S3 URI of processed file
-        processed_files[file_type] = f's3://{bucket}/{merged_key}'
+        processed_files[file_type] = merged_file
     
+    # Small and medium days skip the per-stage tasks and run in one fused task, very large ones are sharded
+    execution_mode = select_execution_mode(merged_bytes)
+    print(f"📄 Merged {merged_bytes} bytes, running in {execution_mode} mode")
+
     # Start Step Function with the processed file paths
     step_function_input = {
         'date': date,
         'bucket': bucket,
-        'processedFiles': processed_files
+        'runId': run_id,
+        # Folded into the KPI state under this id, so the same parts are never counted twice
+        'batchId': batch_id_for(date, manifest_key, fingerprints),
+        'processedFiles': processed_files,
+        'paths': run_paths(bucket, date, run_id),
+        'executionMode': execution_mode
     }
+    if execution_mode == 'sharded':
+        shard_count = shard_count_for(merged_bytes)
+        # ECS environment values are strings; the Map state runs one aggregate task per entry of 'shards'
+        step_function_input['shardCount'] = str(shard_count)
+        step_function_input['shards'] = [str(index) for index in range(shard_count)]
+        print(f"📄 Splitting into {shard_count} shards")
+
+    # The merge metrics travel with the execution so every stage's numbers end up in one output.
+    # bytes_out counts what was uploaded (compressed, if CSV_COMPRESSION is set), merged_bytes the CSV text
+    record(merged_bytes=merged_bytes)
+    step_function_input['metrics'] = {'merge': emit('success')}
     
     # Replace with your actual state machine ARN
     state_machine_arn = 'arn:aws:states:your-region:123456789:stateMachine:EcommerceValidationPipeline'
@@ -87,14 +450,14 @@ def lambda_handler(event, context):
     # Execute Step Function
     response = step_functions.start_execution(
         stateMachineArn=state_machine_arn,
-        name=f'ProcessingRun-{date}-{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}',
+        name=run_id,
         input=json.dumps(step_function_input)
     )
     
     return {
         'statusCode': 200,
         'body': json.dumps({
-            'message': f'Merged files for {date} successfully placed in processed/',
+            'message': f'Merged files for {date} successfully placed in processed/{date}/{run_id}/',
             'stepFunctionExecution': response['executionArn'],
             'processedFiles': processed_files
         })
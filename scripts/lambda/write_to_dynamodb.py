@@ -1,13 +1,71 @@
+import codecs
+import csv
+import hashlib
 import json
 import boto3
-import pandas as pd
-import io
+import os
+import random
+import sys
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
+# Shared modules are packaged next to this file and sit in scripts/common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from compression import open_decompressed
+from stage_cache import input_fingerprints, restore, stage_key, store
+from telemetry import add, emit, phase, start_stage
+
 s3_client = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 
+# Parallel BatchWriteItem workers shared by both tables, and the retry policy for unprocessed items
+WRITE_WORKERS = int(os.environ.get('WRITE_WORKERS', 8))
+WRITE_MAX_RETRIES = int(os.environ.get('WRITE_MAX_RETRIES', 8))
+WRITE_BASE_BACKOFF_SECONDS = float(os.environ.get('WRITE_BASE_BACKOFF_SECONDS', 0.05))
+# DynamoDB accepts at most 25 put requests per BatchWriteItem call
+BATCH_SIZE = 25
+# Delta mode: when set (s3:// prefix, or a local folder for local runs such as the backfill), content hashes
+# from the last successful load are kept here, one file per table and order_date, and rows whose KPI
+# values did not change are not written again
+LOAD_STATE_PATH = os.environ.get('LOAD_STATE_PATH')
+# Hash file of rows without an order_date
+DEFAULT_HASH_DATE = '__HIVE_DEFAULT_PARTITION__'
+# Loads running at once save the hashes with conditional writes, retried this many times on a conflict
+HASH_SAVE_ATTEMPTS = int(os.environ.get('HASH_SAVE_ATTEMPTS', 5))
+# Set to the compute tasks' KPI_STATE_PATH when they fold into a state: a retried run then reports
+# the current totals of its dates, and those rows are always written instead of served from the cache
+KPI_STATE_PATH = os.environ.get('KPI_STATE_PATH', '')
+# Columns that change on every run without the KPIs changing
+DELTA_IGNORE_COLUMNS = {name.strip() for name in os.environ.get('DELTA_IGNORE_COLUMNS', 'computed_at').split(',') if name.strip()}
+
+def to_count(text):
+    """Integer counts; a float-formatted value such as '12.0' stays an exact Decimal"""
+    return int(text) if text.lstrip('-').isdigit() else Decimal(text)
+
+# Attribute types of the KPI columns written by the compute stage; other columns are stored as strings.
+# Decimal(text) keeps the exact digits written in the CSV (no binary floating-point artifacts).
+KPI_SCHEMA = {
+    # Category-level table
+    'category': str,
+    'order_date': str,
+    'daily_revenue': Decimal,
+    'avg_order_value': Decimal,
+    'avg_return_rate': Decimal,
+    # Order-level table
+    'total_orders': to_count,
+    'total_items_sold': to_count,
+    'total_revenue': Decimal,
+    'unique_customers': to_count,
+    'return_rate': Decimal,
+    'computed_at': str,
+}
+
+def is_s3_path(path):
+    return path.startswith('s3://')
+
 def parse_s3_path(s3_path):
     """Extract bucket and key from S3 path"""
     path = s3_path.replace('s3://', '')
@@ -15,62 +73,257 @@ def parse_s3_path(s3_path):
     key = '/'.join(path.split('/')[1:])
     return bucket, key
 
-def read_csv_from_s3(s3_path):
-    """Read CSV file from S3"""
-    bucket, key = parse_s3_path(s3_path)
+def open_kpi_file(path):
+    """Binary stream of a KPI CSV on S3 or, for local runs such as the backfill, on disk.
+
+    gzip and zstd files are decompressed as they are read.
+    """
+    if not is_s3_path(path):
+        add(bytes_in=os.path.getsize(path))
+        return open_decompressed(open(path, 'rb'))
+    bucket, key = parse_s3_path(path)
     response = s3_client.get_object(Bucket=bucket, Key=key)
-    df = pd.read_csv(io.BytesIO(response['Body'].read()))
-    return df
+    add(bytes_in=response.get('ContentLength'))
+    return open_decompressed(response['Body'])
+
+def read_kpi_items(s3_path):
+    """Stream the rows of a KPI CSV on S3 as DynamoDB items, typed from KPI_SCHEMA.
 
-def write_to_dynamodb(df, table_name):
-    """Write dataframe to DynamoDB table, converting floats to Decimal."""
-    table = dynamodb.Table(table_name)
-    records = df.to_dict('records')
+    Rows are decoded as the body downloads, so the file is never held whole; empty
+    fields are left out of the item.
+    """
+    reader = csv.reader(codecs.getreader('utf-8')(open_kpi_file(s3_path)))
+    header = next(reader, [])
+    converters = [KPI_SCHEMA.get(name, str) for name in header]
+    rows = 0
+    for row in reader:
+        rows += 1
+        yield {name: convert(value) for name, convert, value in zip(header, converters, row) if value != ''}
+    add(rows_in=rows)
 
-    with table.batch_writer() as batch:
-        for record in records:
-            # 1) Convert any floats (including numpy.float64) to Decimal
-            for k, v in record.items():
-                # catch both built‑in floats and numpy floats
-                if isinstance(v, float) or (hasattr(v, "dtype") and v.dtype.kind == "f"):
-                    # Decimal(str()) is safest to avoid binary floating‑point artifacts
-                    record[k] = Decimal(str(v))
+def iter_batches(items, size=BATCH_SIZE):
+    """Group an item stream into lists of at most `size` items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-            # 2) Now push the fully Decimal‑ized item
-            batch.put_item(Item=record)
+def write_batch(table_name, items):
+    """Write one batch of items, retrying unprocessed items with exponential backoff and full jitter"""
+    client = dynamodb.meta.client
+    request = {table_name: [{'PutRequest': {'Item': item}} for item in items]}
+    for attempt in range(WRITE_MAX_RETRIES + 1):
+        response = client.batch_write_item(RequestItems=request)
+        request = response.get('UnprocessedItems') or {}
+        if not request:
+            return len(items)
+        if attempt < WRITE_MAX_RETRIES:
+            time.sleep(random.uniform(0, WRITE_BASE_BACKOFF_SECONDS * (2 ** attempt)))
+    remaining = sum(len(requests) for requests in request.values())
+    raise RuntimeError(f"{remaining} items still unprocessed in {table_name} after {WRITE_MAX_RETRIES} retries")
 
-    return len(records)
+def write_tables(tables, workers=WRITE_WORKERS):
+    """Write several tables at once; tables maps table name to an iterable of items.
+
+    Batches are taken from every table in turn and share one pool of workers, so the
+    tables load concurrently. Items may be a stream: at most two batches per worker are
+    queued, so reading keeps pace with writing instead of buffering the input.
+    Returns the number of items written per table.
+    """
+    slots = threading.BoundedSemaphore(workers * 2)
+    futures = {table_name: [] for table_name in tables}
+    streams = {table_name: iter_batches(items) for table_name, items in tables.items()}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while streams:
+            for table_name in list(streams):
+                batch = next(streams[table_name], None)
+                if batch is None:
+                    del streams[table_name]
+                    continue
+                slots.acquire()
+                future = executor.submit(write_batch, table_name, batch)
+                future.add_done_callback(lambda _: slots.release())
+                futures[table_name].append(future)
+    return {table_name: sum(future.result() for future in batches) for table_name, batches in futures.items()}
+
+def table_key_names(table_name):
+    """Primary key attribute names from the table's key schema"""
+    return [key['AttributeName'] for key in dynamodb.Table(table_name).key_schema]
+
+def item_key(item, key_names):
+    """Stable string form of an item's primary key"""
+    return json.dumps([str(item[name]) for name in key_names])
+
+def item_hash(item):
+    """Content hash of an item's values, leaving out DELTA_IGNORE_COLUMNS"""
+    content = json.dumps({name: str(value) for name, value in item.items() if name not in DELTA_IGNORE_COLUMNS},
+                         sort_keys=True)
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+def hash_state_path(table_name, order_date):
+    return f"{LOAD_STATE_PATH.rstrip('/')}/{table_name}/order_date={order_date}.json"
+
+def load_hashes(table_name, order_date):
+    """Content hashes per primary key of one order_date from the last successful load of a table,
+    and the ETag they were read at (None when no load recorded any yet, or for a local file)"""
+    path = hash_state_path(table_name, order_date)
+    if not is_s3_path(path):
+        try:
+            with open(path) as f:
+                return json.load(f), None
+        except FileNotFoundError:
+            return {}, None
+    bucket, key = parse_s3_path(path)
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return {}, None
+    return json.loads(response['Body'].read()), response['ETag']
+
+def is_conflict(error):
+    """A conditional write lost to another load that saved the same hashes first"""
+    return error.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict',
+                                                           'NoSuchKey')
+
+def save_hashes(table_name, order_date, changes, hashes, etag):
+    """Record the hashes of the rows of one order_date this load wrote.
+
+    The write only succeeds if the stored hashes are still the ones read at `etag`. When another
+    load saved them in between, its hashes are read again and this load's changes applied on top.
+    A local file has one writer and is replaced as a whole.
+    """
+    path = hash_state_path(table_name, order_date)
+    if not is_s3_path(path):
+        hashes.update(changes)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, 'w') as f:
+            json.dump(hashes, f)
+        os.replace(partial, path)
+        return
+    bucket, key = parse_s3_path(path)
+    for attempt in range(HASH_SAVE_ATTEMPTS):
+        hashes.update(changes)
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(hashes).encode('utf-8'),
+                                 ContentType='application/json', **condition)
+            return
+        except s3_client.exceptions.ClientError as error:
+            if not is_conflict(error):
+                raise
+        print(f"Hashes of {table_name} {order_date} saved by another load, merging "
+              f"({attempt + 1}/{HASH_SAVE_ATTEMPTS})")
+        hashes, etag = load_hashes(table_name, order_date)
+    raise RuntimeError(f"Could not save the hashes of {table_name} {order_date} after {HASH_SAVE_ATTEMPTS} "
+                       f"conflicting writes")
+
+def select_changed(table_name, items, stored, changes, skipped):
+    """Yield the items whose content differs from the stored hashes.
+
+    A date's hashes are read when its first item arrives and kept in stored[order_date] with
+    their ETag, so a load only reads the dates it contains. New hashes are recorded in
+    changes[order_date] as items pass and unchanged items are counted in skipped[table_name].
+    """
+    key_names = table_key_names(table_name)
+    for item in items:
+        order_date = str(item.get('order_date', DEFAULT_HASH_DATE))
+        if order_date not in stored:
+            stored[order_date] = load_hashes(table_name, order_date)
+        key, digest = item_key(item, key_names), item_hash(item)
+        if stored[order_date][0].get(key) == digest:
+            skipped[table_name] += 1
+        else:
+            changes.setdefault(order_date, {})[key] = digest
+            yield item
+
+def load_tables(category_kpi_file, order_kpi_file, category_table, order_table):
+    """Write both KPI files to their tables and return the written and skipped counts per table"""
+    # Stream both KPI files from S3, typed from the KPI schema
+    tables = {
+        category_table: read_kpi_items(category_kpi_file),
+        order_table: read_kpi_items(order_kpi_file)
+    }
+    skipped = {table_name: 0 for table_name in tables}
+    stored_hashes = {table_name: {} for table_name in tables}
+    changes = {table_name: {} for table_name in tables}
+    if LOAD_STATE_PATH:
+        # Delta mode: only rows whose KPI values changed since the last load are written
+        for table_name, items in tables.items():
+            tables[table_name] = select_changed(table_name, items, stored_hashes[table_name],
+                                                changes[table_name], skipped)
+
+    # Write both DynamoDB tables concurrently (the files are read and parsed as batches are written)
+    start = time.perf_counter()
+    with phase('write'):
+        counts = write_tables(tables)
+    category_count, order_count = counts[category_table], counts[order_table]
+    add(rows_out=category_count + order_count)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {category_count + order_count} items in {elapsed:.2f}s "
+          f"({(category_count + order_count) / max(elapsed, 1e-9):.0f} items/sec)")
+    if LOAD_STATE_PATH:
+        print(f"Delta mode: skipped {sum(skipped.values())} unchanged items")
+
+    # Hashes are only recorded once their rows are safely written
+    with phase('write'):
+        for table_name, dates in changes.items():
+            for order_date, date_changes in dates.items():
+                hashes, etag = stored_hashes[table_name][order_date]
+                save_hashes(table_name, order_date, date_changes, hashes, etag)
+
+    return {
+        'category_records': category_count,
+        'order_records': order_count,
+        'category_skipped': skipped[category_table],
+        'order_skipped': skipped[order_table],
+    }
 
 def lambda_handler(event, context):
+    start_stage('load')
     try:
         # Extract file paths and table names from event
         category_kpi_file = event['category_kpi_file']
         order_kpi_file = event['order_kpi_file']
         category_table = event['category_table']
         order_table = event['order_table']
-        
-        # Read CSV files from S3
-        category_kpis_df = read_csv_from_s3(category_kpi_file)
-        order_kpis_df = read_csv_from_s3(order_kpi_file)
-        
-        # Write to DynamoDB tables
-        category_count = write_to_dynamodb(category_kpis_df, category_table)
-        order_count = write_to_dynamodb(order_kpis_df, order_table)
-
-        # Send tasktoken
-        client = boto3.client('stepfunctions')
-        client.send_task_success(
-            taskToken=event['taskToken'],
-            output=json.dumps({"status": "completed"})
-        )
+
+        # These exact KPI files were already loaded into these tables: report that load instead of writing again.
+        # With a KPI state the tables may have moved on since, so the load always runs.
+        cache_key = None
+        if not KPI_STATE_PATH:
+            cache_key = stage_key('load', input_fingerprints({'category': category_kpi_file, 'order': order_kpi_file}),
+                                  params={'tables': [category_table, order_table], 'load_state_path': LOAD_STATE_PATH,
+                                          'delta_ignore_columns': sorted(DELTA_IGNORE_COLUMNS)},
+                                  code=[__file__])
+        result = restore('load', cache_key)
+        if result is not None:
+            print(f"Reusing the cached load of {category_kpi_file} and {order_kpi_file}")
+        else:
+            result = load_tables(category_kpi_file, order_kpi_file, category_table, order_table)
+            store('load', cache_key, result)
+
+        # Send tasktoken, with the load metrics as the task output (the stream mode invokes without one)
+        metrics = emit('success')
+        if event.get('taskToken'):
+            client = boto3.client('stepfunctions')
+            client.send_task_success(
+                taskToken=event['taskToken'],
+                output=json.dumps({"status": "completed", "metrics": metrics})
+            )
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Successfully imported KPIs to DynamoDB',
-                'category_records': category_count,
-                'order_records': order_count
+                **result,
+                'metrics': metrics
             })
         }
     except Exception as e:
         print(f"Error: {str(e)}")
+        emit('failed')
         raise e
\ No newline at end of file
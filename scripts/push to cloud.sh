@@ -2,6 +2,10 @@
 aws ecr create-repository --repository-name validate-data --region your-region
 aws ecr create-repository --repository-name transform-data --region your-region
 aws ecr create-repository --repository-name compute-kpis --region your-region
+aws ecr create-repository --repository-name fused-pipeline --region your-region
+aws ecr create-repository --repository-name shard-pipeline --region your-region
+aws ecr create-repository --repository-name stream-pipeline --region your-region
+aws ecr create-repository --repository-name backfill-pipeline --region your-region
 
 # Login to ECR
 aws ecr get-login-password --region your-region \
@@ -19,16 +23,40 @@ docker push 123456789.dkr.ecr.your-region.amazonaws.com/transform-data:latest
 docker tag compute-kpis:latest 123456789.dkr.ecr.your-region.amazonaws.com/compute-kpis:latest
 docker push 123456789.dkr.ecr.your-region.amazonaws.com/compute-kpis:latest
 
+# Fused-pipeline
+docker tag fused-pipeline:latest 123456789.dkr.ecr.your-region.amazonaws.com/fused-pipeline:latest
+docker push 123456789.dkr.ecr.your-region.amazonaws.com/fused-pipeline:latest
+
+# Shard-pipeline
+docker tag shard-pipeline:latest 123456789.dkr.ecr.your-region.amazonaws.com/shard-pipeline:latest
+docker push 123456789.dkr.ecr.your-region.amazonaws.com/shard-pipeline:latest
+
+# Stream-pipeline
+docker tag stream-pipeline:latest 123456789.dkr.ecr.your-region.amazonaws.com/stream-pipeline:latest
+docker push 123456789.dkr.ecr.your-region.amazonaws.com/stream-pipeline:latest
+
+# Backfill-pipeline
+docker tag backfill-pipeline:latest 123456789.dkr.ecr.your-region.amazonaws.com/backfill-pipeline:latest
+docker push 123456789.dkr.ecr.your-region.amazonaws.com/backfill-pipeline:latest
+
 aws ecs create-cluster --cluster-name ecommerce-pipeline-cluster --region your-region
 
 aws logs create-log-group --log-group-name /ecs/validate-task --region your-region
 aws logs create-log-group --log-group-name /ecs/transform-task --region your-region
 aws logs create-log-group --log-group-name /ecs/compute-task --region your-region
+aws logs create-log-group --log-group-name /ecs/fused-task --region your-region
+aws logs create-log-group --log-group-name /ecs/shard-task --region your-region
+aws logs create-log-group --log-group-name /ecs/stream-task --region your-region
+aws logs create-log-group --log-group-name /ecs/backfill-task --region your-region
 
 
 aws ecs register-task-definition --cli-input-json file://validate-task.json --region your-region
 aws ecs register-task-definition --cli-input-json file://transform-task.json --region your-region
 aws ecs register-task-definition --cli-input-json file://compute-task.json --region your-region
+aws ecs register-task-definition --cli-input-json file://fused-task.json --region your-region
+aws ecs register-task-definition --cli-input-json file://shard-task.json --region your-region
+aws ecs register-task-definition --cli-input-json file://stream-task.json --region your-region
+aws ecs register-task-definition --cli-input-json file://backfill-task.json --region your-region
 
 aws ec2 describe-vpcs --region your-region
 aws ec2 describe-subnets --region your-region
@@ -37,6 +65,32 @@ aws ec2 describe-subnets --region your-region
 aws ec2 create-security-group --group-name ecs-sg --description "ECS Security Group" --vpc-id vpc-123456 --region your-region
 aws ec2 authorize-security-group-egress --group-id sg-123456789 --protocol "-1" --port -1 --cidr 0.0.0.0/0 --region your-region
 
+# Stream consumer: a long-running service instead of one task per day
+aws ecs create-service --cluster ecommerce-pipeline-cluster --service-name stream-pipeline --task-definition stream-task --desired-count 1 --launch-type FARGATE --network-configuration "awsvpcConfiguration={subnets=[subnet-123456789,subnet-123456789],securityGroups=[sg-123456789],assignPublicIp=ENABLED}" --region your-region
+
+# Backfill: a one-off task over a range of manifests (the checkpoint defaults to <output>/_backfill_checkpoint.json)
+aws ecs run-task \
+    --cluster ecommerce-pipeline-cluster \
+    --task-definition backfill-task \
+    --launch-type FARGATE \
+    --network-configuration "awsvpcConfiguration={subnets=[subnet-123456789,subnet-123456789],securityGroups=[sg-123456789],assignPublicIp=ENABLED}" \
+    --region your-region \
+    --overrides '{
+        "containerOverrides": [
+            {
+                "name": "backfill-container",
+                "command": [
+                    "s3://your-bucket-name",
+                    "--from", "20250101",
+                    "--to", "20250331",
+                    "--output", "s3://your-bucket-name/output/backfill/",
+                    "--workers", "2",
+                    "--load"
+                ]
+            }
+        ]
+    }'
+
 # Transform (after validate succeeds)
 aws ecs run-task --cluster ecommerce-pipeline-cluster --task-definition transform-task --launch-type FARGATE --network-configuration "awsvpcConfiguration={subnets=[subnet-123456789,subnet-123456789 ],securityGroups=[sg-123456789],assignPublicIp=ENABLED}" --region your-region
 
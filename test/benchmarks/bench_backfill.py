@@ -0,0 +1,163 @@
+# Throughput of the historical backfill for several worker counts. Generated days are laid out as
+# data/<date>/manifest_<date>.json in a local folder (or in a fake S3 bucket with --fake-s3), each
+# setting backfills all of them into a fresh output folder, and every date's KPIs are checked
+# against the same day computed whole. A second pass over the same checkpoint must skip every date.
+# Finally the command line runs once over the local folder with every AWS setting removed, as a
+# backfill on a laptop would.
+#
+#   python test/benchmarks/bench_backfill.py --dates 8 --orders 50000 --workers 1 2 4
+#   python test/benchmarks/bench_backfill.py --fake-s3 --latency 0.02 --workers 1 4
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.append(os.path.join(REPO_ROOT, 'scripts', 'containers', 'backfill'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+# The backfill must fold into the folders given here, not the shell's settings
+for name in ('KPI_STATE_PATH', 'PRODUCTS_CACHE_PATH', 'DISTINCT_COUNT_MODE', 'VALIDATE_MODE', 'STAGE_CACHE_PATH'):
+    os.environ.pop(name, None)
+
+import pandas as pd  # noqa: E402
+from backfill_pipeline import kpi_outputs, open_source, run_backfill  # noqa: E402
+import compute_kpis  # noqa: E402
+from transform_data import read_table, transform_orders, transform_order_items  # noqa: E402
+from compute_kpis import compute_category_kpis, compute_order_kpis  # noqa: E402
+from fake_aws import FakeS3  # noqa: E402
+from generate_data import generate  # noqa: E402
+from bench_stream_latency import same_kpis  # noqa: E402
+
+BUCKET = 'backfill-bench'
+
+
+def generate_dates(root, dates, orders, part_rows, seed):
+    """One manifest per upload date, each covering a few order dates, sharing data/products.csv"""
+    names = [(pd.Timestamp('2025-04-01') + pd.Timedelta(days=index)).strftime('%Y%m%d') for index in range(dates)]
+    for index, date in enumerate(names):
+        folder = os.path.join(root, 'data', date)
+        generate(folder, orders, part_rows=part_rows, days=3, end_date=f"{date[:4]}-{date[4:6]}-{date[6:]}",
+                 seed=seed + index)
+        os.rename(os.path.join(folder, 'manifest.json'), os.path.join(folder, f'manifest_{date}.json'))
+        # Every manifest is transformed with the first day's products, as one products file serves the bucket
+        if index == 0:
+            shutil.move(os.path.join(folder, 'products.csv'), os.path.join(root, 'data', 'products.csv'))
+        else:
+            os.remove(os.path.join(folder, 'products.csv'))
+    return names
+
+
+def upload(root):
+    """The generated folder as objects of a fake bucket"""
+    s3 = FakeS3()
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                s3.objects[(BUCKET, os.path.relpath(path, root).replace(os.sep, '/'))] = f.read()
+    return s3
+
+
+def day_kpis(root, date):
+    """KPIs of one manifest computed whole, as the daily pipeline does"""
+    with open(os.path.join(root, 'data', date, f'manifest_{date}.json')) as f:
+        manifest = json.load(f)
+    frames = {kind: pd.concat([read_table(os.path.join(root, 'data', date, kind, name), kind)
+                               for name in manifest['files'][kind]], ignore_index=True)
+              for kind in ('orders', 'order_items')}
+    orders_df, _ = transform_orders(frames['orders'])
+    order_items_df, _ = transform_order_items(frames['order_items'],
+                                              read_table(os.path.join(root, 'data', 'products.csv'), 'products'))
+    return compute_category_kpis(order_items_df), compute_order_kpis(order_items_df, orders_df)
+
+
+def same_as_daily(expected, output):
+    for date, (category_kpis, order_kpis) in expected.items():
+        files = kpi_outputs(output, date)
+        if not (same_kpis(category_kpis, pd.read_csv(files['category_kpi_file'], dtype={'order_date': str}),
+                          ['category', 'order_date'])
+                and same_kpis(order_kpis, pd.read_csv(files['order_kpi_file'], dtype={'order_date': str}),
+                              ['order_date'])):
+            return False
+    return True
+
+
+def local_run(root, expected, output):
+    """Run backfill_pipeline.py in a fresh interpreter with no AWS region, profile or credentials"""
+    env = {name: value for name, value in os.environ.items() if not name.startswith('AWS_')}
+    env.update(AWS_CONFIG_FILE=os.devnull, AWS_SHARED_CREDENTIALS_FILE=os.devnull)
+    script = os.path.join(REPO_ROOT, 'scripts', 'containers', 'backfill', 'backfill_pipeline.py')
+    result = subprocess.run([sys.executable, script, root, '--output', output, '--state-path', '', '--workers', '1'],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stdout[-2000:] + result.stderr[-2000:])
+        return False
+    return same_as_daily(expected, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill throughput by worker count')
+    parser.add_argument('--dates', type=int, default=6, help='manifests to backfill')
+    parser.add_argument('--orders', type=int, default=30_000, help='orders per manifest')
+    parser.add_argument('--part-rows', type=int, default=5_000, help='rows per part file')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--fake-s3', action='store_true', help='read from a fake bucket on threads')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake S3 seconds per request')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as folder:
+        root = os.path.join(folder, 'source')
+        dates = generate_dates(root, args.dates, args.orders, args.part_rows, args.seed)
+        expected = {date: day_kpis(root, date) for date in dates}
+        if args.fake_s3:
+            s3 = upload(root)
+            s3.latency = args.latency
+            source, executor = open_source(f's3://{BUCKET}', s3), 'thread'
+            # The checkpoint then lives in the fake bucket too, as on ECS
+            compute_kpis.s3_client = s3
+        else:
+            source, executor = open_source(root), 'process'
+        print(f"{len(dates)} manifests of {args.orders} orders from {source} ({executor} workers)")
+        print(f"{'workers':>8} {'wall s':>8} {'rows/s':>10} {'dates/min':>10} {'speedup':>8}  KPIs, resume")
+
+        failed = False
+        baseline = None
+        for workers in args.workers:
+            output = tempfile.mkdtemp(dir=folder)
+            checkpoint = (f's3://{BUCKET}/backfill/{workers}/_backfill_checkpoint.json' if args.fake_s3
+                          else os.path.join(output, '_backfill_checkpoint.json'))
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                summary = run_backfill(source, output, workers=workers, checkpoint_path=checkpoint, state_path='',
+                                       executor=executor)
+                rerun = run_backfill(source, output, workers=workers, checkpoint_path=checkpoint, state_path='',
+                                     executor=executor)
+            wall = time.perf_counter() - start
+            baseline = baseline or summary['seconds']
+            same = summary['done'] == len(dates) and same_as_daily(expected, output)
+            resumed = rerun['skipped'] == len(dates) and rerun['done'] == 0
+            failed = failed or not (same and resumed)
+            print(f"{workers:>8} {summary['seconds']:>8.2f} {summary['rows_per_second']:>10} "
+                  f"{summary['dates_per_minute']:>10.1f} {baseline / summary['seconds']:>7.2f}x  "
+                  f"{'same as daily' if same else 'DIFFERENT from daily'}, "
+                  f"{'all skipped' if resumed else 'NOT skipped'} ({wall:.2f}s with the rerun)")
+
+        local = local_run(root, expected, tempfile.mkdtemp(dir=folder))
+        print(f"\nLocal run without AWS settings: {'same as daily' if local else 'FAILED'}")
+        failed = failed or not local
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Bytes moved and wall time of each CSV codec on the sample data. For every codec the sample parts
+# are compressed and uploaded to a fake S3, merged by the start_pipeline Lambda into a file of the
+# same codec, read back by the stages' CSV reader and written again as the KPI writers do. The
+# merged rows must be the same whatever the codec.
+#
+#   python test/benchmarks/bench_compression.py --latency 0.01 --bandwidth 50e6 --copies 4
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'lambda'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'common'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import pandas as pd  # noqa: E402
+import start_pipeline  # noqa: E402
+from compression import compress_chunks, pandas_compression, with_codec, write_csv  # noqa: E402
+from fake_aws import FakeS3  # noqa: E402
+
+BUCKET = 'bench-bucket'
+FILE_TYPES = ('orders', 'order_items')
+
+
+def sample_parts(file_type, copies):
+    """(name, bytes) of the sample parts of a file type, in part order, repeated `copies` times"""
+    files = sorted(
+        glob.glob(os.path.join(REPO_ROOT, 'data', file_type, '*.csv')),
+        key=lambda path: int(path.rsplit('part', 1)[1].split('.')[0])
+    )
+    parts = []
+    for copy in range(copies):
+        for path in files:
+            with open(path, 'rb') as f:
+                parts.append((f'copy{copy}_{os.path.basename(path)}', f.read()))
+    return parts
+
+
+def run(codec, level, parts, fake_s3):
+    """Time one codec end to end; returns the measurements and the merged frames"""
+    timings = {'compress': 0.0, 'merge': 0.0, 'read': 0.0, 'write': 0.0}
+    sizes = {'parts': 0, 'merged': 0, 'written': 0}
+    frames = {}
+    for file_type in FILE_TYPES:
+        part_keys = []
+        start = time.perf_counter()
+        for name, data in parts[file_type]:
+            key = with_codec(f'data/bench/{codec or "plain"}/{file_type}/{name}', codec)
+            fake_s3.objects[(BUCKET, key)] = b''.join(compress_chunks([data], codec, level))
+            sizes['parts'] += len(fake_s3.objects[(BUCKET, key)])
+            part_keys.append(key)
+        timings['compress'] += time.perf_counter() - start
+
+        merged_key = with_codec(f'processed/bench/{codec or "plain"}/{file_type}_merged.csv', codec)
+        start = time.perf_counter()
+        # Silence the per-part progress prints while timing
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start_pipeline.merge_parts_streaming(BUCKET, part_keys, merged_key)
+        timings['merge'] += time.perf_counter() - start
+        merged = fake_s3.objects[(BUCKET, merged_key)]
+        sizes['merged'] += len(merged)
+
+        start = time.perf_counter()
+        frames[file_type] = pd.read_csv(io.BytesIO(merged), compression=pandas_compression(merged), dtype=str)
+        timings['read'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        sizes['written'] += write_csv(frames[file_type], io.BytesIO(), codec, level)
+        timings['write'] += time.perf_counter() - start
+    return timings, sizes, frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes moved and wall time per CSV codec')
+    parser.add_argument('--codecs', nargs='+', default=['none', 'gzip', 'zstd'])
+    parser.add_argument('--level', type=int, default=None, help='compression level (default per codec)')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every S3 request')
+    parser.add_argument('--bandwidth', type=float, default=50e6, help='per-stream read bandwidth in bytes/sec')
+    parser.add_argument('--copies', type=int, default=1, help='how many times to repeat the sample parts')
+    args = parser.parse_args()
+
+    fake_s3 = FakeS3(latency=args.latency, bandwidth=args.bandwidth)
+    start_pipeline.s3 = fake_s3
+    parts = {file_type: sample_parts(file_type, args.copies) for file_type in FILE_TYPES}
+    plain_bytes = sum(len(data) for file_parts in parts.values() for _, data in file_parts)
+    print(f"{sum(len(p) for p in parts.values())} sample parts, {plain_bytes / 1e6:.2f} MB of CSV, "
+          f"{args.latency * 1000:.0f} ms latency per request\n")
+    print(f"{'codec':<6} {'parts MB':>9} {'merged MB':>10} {'written MB':>11} {'ratio':>6} "
+          f"{'compress s':>11} {'merge s':>8} {'read s':>7} {'write s':>8} {'total s':>8}")
+
+    reference = None
+    mismatched = []
+    for name in args.codecs:
+        codec = None if name == 'none' else name
+        timings, sizes, frames = run(codec, args.level, parts, fake_s3)
+        print(f"{name:<6} {sizes['parts'] / 1e6:>9.2f} {sizes['merged'] / 1e6:>10.2f} "
+              f"{sizes['written'] / 1e6:>11.2f} {plain_bytes / sizes['parts']:>5.1f}x "
+              f"{timings['compress']:>11.3f} {timings['merge']:>8.3f} {timings['read']:>7.3f} "
+              f"{timings['write']:>8.3f} {sum(timings.values()):>8.3f}")
+        # Every codec must merge to the same rows
+        if reference is None:
+            reference = frames
+        elif any(not frames[file_type].equals(reference[file_type]) for file_type in FILE_TYPES):
+            mismatched.append(name)
+
+    print("\nMerged rows identical across codecs" if not mismatched else f"\nMerged rows differ: {mismatched}")
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Compare exact distinct counting with HyperLogLog sketches: memory, speed and accuracy
+#
+#   python test/benchmarks/bench_distinct.py --error 0.01 --shards 8
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'containers', 'compute'))
+
+from hyperloglog import HyperLogLog, precision_for_error  # noqa: E402
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark exact vs sketch-based distinct counts')
+    parser.add_argument('--error', type=float, default=0.01, help='target relative standard error')
+    parser.add_argument('--shards', type=int, default=8, help='partial results merged per measurement')
+    parser.add_argument('--cardinalities', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeats', type=int, default=3, help='rows per distinct value')
+    args = parser.parse_args()
+
+    precision = precision_for_error(args.error)
+    rng = np.random.default_rng(42)
+    print(f"precision {precision} ({1 << precision} registers), {args.shards} shards merged\n")
+    print(f"{'distinct':>10} {'rows':>10} | {'exact s':>8} {'exact KB':>9} | "
+          f"{'hll s':>8} {'hll KB':>7} {'json KB':>8} {'estimate':>10} {'error %':>8}")
+
+    for cardinality in args.cardinalities:
+        # Distinct, scattered ids: a random offset plus a stride keeps them unique
+        ids = rng.integers(0, 10 ** 6) + np.arange(cardinality, dtype=np.int64) * 7919
+        rows = rng.permutation(np.repeat(ids, args.repeats))
+        shards = np.array_split(rows, args.shards)
+
+        # Exact: each shard keeps its distinct ids, the merge is a union
+        def exact():
+            partials = [pd.unique(shard) for shard in shards]
+            return len(pd.unique(np.concatenate(partials))), sum(part.nbytes for part in partials)
+        (exact_count, exact_bytes), exact_seconds = timed(exact)
+
+        # Sketch: each shard keeps a fixed-size sketch, the merge is an element-wise max
+        def sketch():
+            partials = [HyperLogLog(precision).add(shard) for shard in shards]
+            merged = HyperLogLog(precision)
+            for part in partials:
+                merged.merge(part)
+            return merged, partials
+        (merged, partials), sketch_seconds = timed(sketch)
+        serialized = sum(len(part.to_dict()['registers']) for part in partials)
+
+        estimate = merged.count()
+        error = (estimate - exact_count) / exact_count * 100
+        print(f"{exact_count:>10} {len(rows):>10} | {exact_seconds:>8.3f} {exact_bytes / 1024:>9.1f} | "
+              f"{sketch_seconds:>8.3f} {merged.registers.nbytes * args.shards / 1024:>7.1f} "
+              f"{serialized / 1024:>8.1f} {estimate:>10} {error:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
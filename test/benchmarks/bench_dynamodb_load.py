@@ -0,0 +1,156 @@
+# Benchmark the write_to_dynamodb loader against a fake DynamoDB with injected latency and throttling
+#
+#   python test/benchmarks/bench_dynamodb_load.py --days 2000 --latency 0.02 --unprocessed 0.05
+import argparse
+import io
+import os
+import sys
+import time
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import write_to_dynamodb  # noqa: E402
+from fake_aws import FakeDynamoDBClient, FakeDynamoDBResource, FakeS3  # noqa: E402
+
+CATEGORY_TABLE = 'category-kpis'
+ORDER_TABLE = 'order-kpis'
+KEYS = {CATEGORY_TABLE: ['category', 'order_date'], ORDER_TABLE: ['order_date']}
+FILES = {CATEGORY_TABLE: 's3://bench-bucket/kpis/category_kpis.csv', ORDER_TABLE: 's3://bench-bucket/kpis/order_kpis.csv'}
+
+
+def make_kpis(days, seed=42):
+    """Category and order KPI frames shaped like compute_kpis output, one row per category/day and per day"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2000-01-01', periods=days).strftime('%Y-%m-%d')
+    categories = ['Electronics', 'Books', 'Clothing', 'Home', 'Sports', 'Toys']
+    computed_at = '2025-03-31T00:00:00'
+    category_kpis = pd.DataFrame({
+        'category': np.repeat(categories, days),
+        'order_date': np.tile(dates, len(categories)),
+        'daily_revenue': rng.uniform(1e3, 1e5, days * len(categories)).round(2),
+        'avg_order_value': rng.uniform(10, 200, days * len(categories)),
+        'avg_return_rate': rng.uniform(0, 30, days * len(categories)),
+        'computed_at': computed_at,
+    })
+    order_kpis = pd.DataFrame({
+        'order_date': dates,
+        'total_orders': rng.integers(100, 1000, days),
+        'total_items_sold': rng.integers(100, 3000, days),
+        'total_revenue': rng.uniform(1e4, 1e5, days).round(2),
+        'unique_customers': rng.integers(100, 1000, days),
+        'return_rate': rng.uniform(0, 30, days),
+        'computed_at': computed_at,
+    })
+    return category_kpis, order_kpis
+
+
+def legacy_items(s3_path):
+    """The original conversion: pandas read_csv, to_dict('records') and a float check on every cell"""
+    bucket, key = write_to_dynamodb.parse_s3_path(s3_path)
+    body = write_to_dynamodb.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    records = pd.read_csv(io.BytesIO(body.read())).to_dict('records')
+    for record in records:
+        for k, v in record.items():
+            if isinstance(v, float) or (hasattr(v, "dtype") and v.dtype.kind == "f"):
+                record[k] = Decimal(str(v))
+    return records
+
+
+def legacy_write(s3_path, table_name):
+    """The original loader: one sequential batch_writer per table"""
+    records = legacy_items(s3_path)
+    with write_to_dynamodb.dynamodb.Table(table_name).batch_writer() as batch:
+        for record in records:
+            batch.put_item(Item=record)
+    return len(records)
+
+
+def same_items(expected, actual):
+    """Items match exactly, except that Decimals may differ in the last digits.
+
+    pandas' default float parser is not round-trip exact, so the legacy path can be a few
+    ulps off the value written in the CSV; the streaming reader keeps the CSV digits.
+    """
+    if expected.keys() != actual.keys():
+        return False
+    for name, value in expected.items():
+        other = actual[name]
+        if isinstance(value, Decimal) and isinstance(other, Decimal):
+            if abs(value - other) > abs(value) * Decimal('1e-12'):
+                return False
+        elif value != other or type(value) is not type(other):
+            return False
+    return True
+
+
+def same_tables(expected, actual):
+    return expected.keys() == actual.keys() and all(
+        expected[name].keys() == actual[name].keys()
+        and all(same_items(expected[name][key], actual[name][key]) for key in expected[name])
+        for name in expected)
+
+
+def run(label, load, args, total):
+    client = FakeDynamoDBClient(latency=args.latency, unprocessed_rate=args.unprocessed, key_attributes=KEYS)
+    write_to_dynamodb.dynamodb = FakeDynamoDBResource(client)
+    start = time.perf_counter()
+    load()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed:8.3f}s {total / elapsed:12.0f} items/s {client.requests:8d} requests")
+    return client.tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DynamoDB KPI loader')
+    parser.add_argument('--days', type=int, default=2000, help='order dates in the synthetic KPI tables')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every BatchWriteItem call')
+    parser.add_argument('--unprocessed', type=float, default=0.05, help='fraction of items returned unprocessed')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    # Keep retries fast so the measurement reflects request latency rather than sleeps
+    write_to_dynamodb.WRITE_BASE_BACKOFF_SECONDS = args.latency / 4
+    category_kpis, order_kpis = make_kpis(args.days)
+    total = len(category_kpis) + len(order_kpis)
+    print(f"{total} items, {args.latency * 1000:.0f} ms per request, "
+          f"{args.unprocessed:.0%} unprocessed per attempt\n")
+
+    fake_s3 = FakeS3()
+    write_to_dynamodb.s3_client = fake_s3
+    for table_name, df in ((CATEGORY_TABLE, category_kpis), (ORDER_TABLE, order_kpis)):
+        bucket, key = write_to_dynamodb.parse_s3_path(FILES[table_name])
+        fake_s3.objects[(bucket, key)] = df.to_csv(index=False).encode('utf-8')
+
+    start = time.perf_counter()
+    legacy = [legacy_items(FILES[table_name]) for table_name in FILES]
+    legacy_convert = time.perf_counter() - start
+    start = time.perf_counter()
+    items = [list(write_to_dynamodb.read_kpi_items(FILES[table_name])) for table_name in FILES]
+    convert = time.perf_counter() - start
+    print(f"CSV to items: pandas + per-cell Decimal {legacy_convert:.3f}s, streaming csv {convert:.3f}s, "
+          f"{'matching' if all(map(same_items, sum(legacy, []), sum(items, []))) else 'MISMATCH'}\n")
+
+    results = {'legacy': run('legacy batch_writer', lambda: [legacy_write(FILES[table_name], table_name)
+                                                             for table_name in FILES], args, total)}
+    for workers in args.workers:
+        results[workers] = run(f'parallel, {workers} workers', lambda w=workers: write_to_dynamodb.write_tables(
+            {table_name: write_to_dynamodb.read_kpi_items(path) for table_name, path in FILES.items()},
+            workers=w), args, total)
+
+    # Parallel loaders must store identical items, matching the legacy loader
+    reference = results[args.workers[0]]
+    mismatched = [label for label, tables in results.items()
+                  if not (same_tables(tables, reference) if label == 'legacy' else tables == reference)]
+    print("\nStored items match across loaders" if not mismatched else f"\nStored item mismatch: {mismatched}")
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Compare the cold-start import time and peak memory of the DynamoDB load Lambda with the
+# original pandas-based handler. Each measurement runs in a fresh interpreter.
+#
+#   python test/benchmarks/bench_load_cold_start.py --days 20000 --repeats 5
+import argparse
+import importlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+TABLES = ('category-kpis', 'order-kpis')
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB"""
+    # VmHWM starts afresh at exec; ru_maxrss can carry over the parent's peak from the fork
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def child(mode, folder):
+    """Import the handler, then load both KPI files into a fake DynamoDB; print one JSON line"""
+    start = time.perf_counter()
+    import write_to_dynamodb
+    if mode == 'legacy':
+        # The original handler imported pandas at module level
+        importlib.import_module('pandas')
+    import_seconds = time.perf_counter() - start
+    import_rss = peak_rss_mb()
+
+    from fake_aws import FakeDynamoDBClient, FakeDynamoDBResource, FakeS3
+    fake_s3 = FakeS3()
+    write_to_dynamodb.s3_client = fake_s3
+    write_to_dynamodb.dynamodb = FakeDynamoDBResource(FakeDynamoDBClient(store=False))
+    files = {}
+    for table_name in TABLES:
+        with open(os.path.join(folder, f'{table_name}.csv'), 'rb') as f:
+            fake_s3.objects[('bench-bucket', f'{table_name}.csv')] = f.read()
+        files[table_name] = f's3://bench-bucket/{table_name}.csv'
+    loaded_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    if mode == 'legacy':
+        from bench_dynamodb_load import legacy_write
+        count = sum(legacy_write(path, table_name) for table_name, path in files.items())
+    else:
+        counts = write_to_dynamodb.write_tables(
+            {table_name: write_to_dynamodb.read_kpi_items(path) for table_name, path in files.items()})
+        count = sum(counts.values())
+    print(json.dumps({
+        'import_seconds': import_seconds,
+        'load_seconds': time.perf_counter() - start,
+        'import_rss_mb': import_rss,
+        'peak_rss_mb': peak_rss_mb(),
+        # Peak memory used by the load itself, above the imports and the fake S3 copy of the files
+        'load_rss_mb': peak_rss_mb() - loaded_rss,
+        'items': count,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start and memory comparison of the DynamoDB load Lambda')
+    parser.add_argument('--days', type=int, default=20000, help='order dates in the synthetic KPI tables')
+    parser.add_argument('--repeats', type=int, default=5, help='fresh interpreters per mode')
+    parser.add_argument('--child', choices=['legacy', 'stream'], help=argparse.SUPPRESS)
+    parser.add_argument('--folder', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.folder)
+
+    from bench_dynamodb_load import make_kpis
+    with tempfile.TemporaryDirectory() as folder:
+        for table_name, df in zip(TABLES, make_kpis(args.days)):
+            df.to_csv(os.path.join(folder, f'{table_name}.csv'), index=False)
+        size = sum(os.path.getsize(os.path.join(folder, f'{name}.csv')) for name in TABLES)
+        print(f"KPI files: {size / 1e6:.1f} MB, {args.repeats} cold starts per mode\n")
+        print(f"{'handler':<16} {'import s':>9} {'import MB':>10} {'load s':>8} {'load MB':>8} {'peak MB':>8} {'items':>8}")
+        for mode, label in (('legacy', 'pandas'), ('stream', 'streaming csv')):
+            runs = []
+            for _ in range(args.repeats):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode,
+                                         '--folder', folder], check=True, capture_output=True, text=True).stdout
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+            median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            print(f"{label:<16} {median['import_seconds']:>9.3f} {median['import_rss_mb']:>10.1f} "
+                  f"{median['load_seconds']:>8.3f} {median['load_rss_mb']:>8.1f} {median['peak_rss_mb']:>8.1f} "
+                  f"{int(median['items']):>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Benchmark the start_pipeline part merge against a fake S3 with injected latency
+#
+#   python test/benchmarks/bench_merge.py --latency 0.05 --copies 4
+import argparse
+import contextlib
+import glob
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import start_pipeline  # noqa: E402
+from fake_aws import FakeS3  # noqa: E402
+
+BUCKET = 'bench-bucket'
+
+
+def load_parts(fake_s3, copies):
+    """Upload the sample order_items parts (repeated `copies` times) and return their keys in order"""
+    files = sorted(
+        glob.glob(os.path.join(REPO_ROOT, 'data', 'order_items', '*.csv')),
+        key=lambda path: int(path.rsplit('part', 1)[1].split('.')[0])
+    )
+    keys = []
+    for copy in range(copies):
+        for path in files:
+            key = f'data/bench/order_items/copy{copy}_{os.path.basename(path)}'
+            with open(path, 'rb') as f:
+                fake_s3.objects[(BUCKET, key)] = f.read()
+            keys.append(key)
+    # Keep the NoSuchKey skip path in the measurement
+    keys.insert(len(keys) // 2, 'data/bench/order_items/missing.csv')
+    return keys
+
+
+def run(label, merge, fake_s3, merged_key):
+    fake_s3.requests = 0
+    start = time.perf_counter()
+    # Silence the per-part progress prints while timing
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        merge()
+    elapsed = time.perf_counter() - start
+    size = len(fake_s3.objects[(BUCKET, merged_key)])
+    print(f"{label:<28} {elapsed:8.3f}s {size / elapsed / 1e6:9.1f} MB/s {fake_s3.requests:6d} requests")
+    return fake_s3.objects[(BUCKET, merged_key)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the start_pipeline part merge')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every S3 request')
+    parser.add_argument('--bandwidth', type=float, default=50e6, help='per-stream read bandwidth in bytes/sec')
+    parser.add_argument('--copies', type=int, default=2, help='how many times to repeat the sample parts')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8, 16])
+    parser.add_argument('--max-inflight-mb', type=float, default=64)
+    args = parser.parse_args()
+
+    fake_s3 = FakeS3(latency=args.latency, bandwidth=args.bandwidth)
+    start_pipeline.s3 = fake_s3
+    part_keys = load_parts(fake_s3, args.copies)
+    print(f"{len(part_keys)} parts, {args.latency * 1000:.0f} ms latency per request\n")
+
+    runs = [
+        ('buffered', 'out/buffered.csv',
+         lambda key: start_pipeline.merge_parts_buffered(BUCKET, part_keys, key)),
+        ('stream, 1 worker', 'out/stream_1.csv',
+         lambda key: start_pipeline.merge_parts_streaming(BUCKET, part_keys, key, workers=1)),
+    ]
+    for workers in args.workers:
+        runs.append((f'stream, {workers} workers', f'out/stream_{workers}.csv',
+                     lambda key, w=workers: start_pipeline.merge_parts_streaming(
+                         BUCKET, part_keys, key, workers=w,
+                         max_inflight_bytes=int(args.max_inflight_mb * 1024 * 1024))))
+
+    outputs = {}
+    for label, key, merge in runs:
+        outputs[label] = run(label, lambda: merge(key), fake_s3, key)
+
+    # Every streaming variant must produce the same bytes in manifest order
+    reference = outputs['stream, 1 worker']
+    mismatched = [label for label, data in outputs.items() if label.startswith('stream') and data != reference]
+    print("\nOutputs identical across worker counts" if not mismatched else f"\nOutput mismatch: {mismatched}")
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# Run the validate, transform and compute stages on synthetic data of increasing size and compare
+# rows/sec, wall time and peak memory per stage with a stored baseline. Each stage runs its main()
+# on local files in a fresh interpreter, as it would in its container.
+#
+#   python test/benchmarks/bench_pipeline.py --sizes 10000 100000 1000000
+#   python test/benchmarks/bench_pipeline.py --save-baseline      # after an intended change
+#
+# Sizes are order counts; each order has about 3 items. The KPI files are hashed (without
+# computed_at) so a change in results shows up next to a change in speed.
+import argparse
+import csv
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+CONTAINERS = os.path.join(REPO_ROOT, 'scripts', 'containers')
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline_pipeline.json')
+
+# Stage name -> (module, input file kind); compute reads both transformed files
+STAGES = {
+    'validate_orders': ('validate_data', 'orders'),
+    'validate_order_items': ('validate_data', 'order_items'),
+    'transform_orders': ('transform_data', 'orders'),
+    'transform_order_items': ('transform_data', 'order_items'),
+    'compute': ('compute_kpis', 'order_items'),
+}
+# Settings that would otherwise leak in from the shell and change what a stage does
+CLEARED_ENV = ('KPI_STATE_PATH', 'KPI_BATCH_ID', 'PRODUCTS_CACHE_PATH', 'VALIDATE_CHUNK_SIZE',
+               'DISTINCT_COUNT_MODE', 'STAGE_CACHE_PATH', 'VALIDATE_MODE', 'KPI_DATE_FROM', 'KPI_DATE_TO',
+               'TRANSFORM_WORKERS')
+
+
+def stage_paths(folder, extension):
+    return {
+        'orders': os.path.join(folder, 'orders.csv'),
+        'order_items': os.path.join(folder, 'order_items.csv'),
+        'products': os.path.join(folder, 'products.csv'),
+        'orders_transformed': os.path.join(folder, f'orders_transformed.{extension}'),
+        'order_items_transformed': os.path.join(folder, f'order_items_transformed.{extension}'),
+        'category_kpis': os.path.join(folder, 'category_kpis.csv'),
+        'order_kpis': os.path.join(folder, 'order_kpis.csv'),
+    }
+
+
+def child(stage, folder, extension):
+    """Run one stage's main() on the files in folder; print one JSON line"""
+    from bench_load_cold_start import peak_rss_mb
+
+    module_name, _ = STAGES[stage]
+    stage_dir = {'validate_data': 'validate', 'transform_data': 'transform', 'compute_kpis': 'compute'}[module_name]
+    sys.path.insert(0, os.path.join(CONTAINERS, stage_dir))
+    module = __import__(module_name)
+    paths = stage_paths(folder, extension)
+    if stage.startswith('validate'):
+        args = (paths[stage.split('_', 1)[1]],)
+    elif stage.startswith('transform'):
+        kind = stage.split('_', 1)[1]
+        args = (paths[kind], paths['products'], paths[f'{kind}_transformed'])
+    else:
+        args = (paths['order_items_transformed'], paths['orders_transformed'],
+                paths['category_kpis'], paths['order_kpis'])
+
+    # Every stage reports its result through sys.exit, as the state machine expects
+    start = time.perf_counter()
+    try:
+        module.main(*args)
+        code = 0
+    except SystemExit as error:
+        code = error.code or 0
+    seconds = time.perf_counter() - start
+    print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'exit_code': code}))
+
+
+def merge_parts(folder, kind, files, output):
+    """Concatenate the part files in manifest order with one header, as the merge Lambda does"""
+    with open(output, 'wb') as out:
+        for index, name in enumerate(files):
+            with open(os.path.join(folder, kind, name), 'rb') as part:
+                header = part.readline()
+                if index == 0:
+                    out.write(header)
+                shutil.copyfileobj(part, out)
+
+
+def kpi_digest(paths):
+    """Hash of both KPI files, ignoring the computed_at timestamp"""
+    digest = hashlib.sha256()
+    for name in ('category_kpis', 'order_kpis'):
+        with open(paths[name], newline='') as f:
+            rows = csv.reader(f)
+            header = next(rows)
+            keep = [index for index, column in enumerate(header) if column != 'computed_at']
+            for row in [header, *rows]:
+                digest.update(','.join(row[index] for index in keep).encode() + b'\n')
+    return digest.hexdigest()
+
+
+def run_stage(stage, folder, extension):
+    env = {key: value for key, value in os.environ.items() if key not in CLEARED_ENV}
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', stage, '--folder', folder,
+                             '--format', extension], check=True, capture_output=True, text=True, env=env).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    if result['exit_code']:
+        raise RuntimeError(f"{stage} failed:\n{output}")
+    return result
+
+
+def run_size(orders, args):
+    """Generate one dataset, run every stage on it and return the measurements"""
+    from generate_data import generate
+
+    with tempfile.TemporaryDirectory() as folder:
+        manifest = generate(os.path.join(folder, 'parts'), orders, part_rows=args.part_rows,
+                            category_skew=args.category_skew, date_skew=args.date_skew, seed=args.seed)
+        paths = stage_paths(folder, args.format)
+        for kind in ('orders', 'order_items'):
+            merge_parts(os.path.join(folder, 'parts'), kind, manifest['files'][kind], paths[kind])
+        shutil.copyfile(os.path.join(folder, 'parts', 'products.csv'), paths['products'])
+
+        stages = {}
+        for stage, (_, kind) in STAGES.items():
+            runs = [run_stage(stage, folder, args.format) for _ in range(args.repeats)]
+            seconds = statistics.median(run['seconds'] for run in runs)
+            rows = manifest['rows'][kind] + (manifest['rows']['orders'] if stage == 'compute' else 0)
+            stages[stage] = {
+                'rows': rows,
+                'seconds': round(seconds, 4),
+                'rows_per_sec': round(rows / seconds),
+                'peak_rss_mb': round(statistics.median(run['peak_rss_mb'] for run in runs), 1),
+            }
+        return {'rows': manifest['rows'], 'stages': stages, 'kpi_digest': kpi_digest(paths)}
+
+
+def run_key(orders, args):
+    return (f"orders={orders},category_skew={args.category_skew},date_skew={args.date_skew},"
+            f"seed={args.seed},format={args.format}")
+
+
+def compare(key, result, baseline, tolerance):
+    """Print each stage next to its baseline and return the regressions"""
+    previous = baseline.get('runs', {}).get(key)
+    regressions = []
+    print(f"\n{key}: {result['rows']['orders']} orders, {result['rows']['order_items']} items")
+    print(f"{'stage':<22} {'rows':>9} {'seconds':>8} {'rows/s':>10} {'peak MB':>8} | {'base s':>8} {'base MB':>8}")
+    for stage, current in result['stages'].items():
+        line = (f"{stage:<22} {current['rows']:>9} {current['seconds']:>8.3f} {current['rows_per_sec']:>10} "
+                f"{current['peak_rss_mb']:>8.1f}")
+        if previous and stage in previous['stages']:
+            before = previous['stages'][stage]
+            line += f" | {before['seconds']:>8.3f} {before['peak_rss_mb']:>8.1f}"
+            if current['seconds'] > before['seconds'] * (1 + tolerance):
+                regressions.append(f"{stage} {current['seconds'] / before['seconds']:.2f}x slower")
+            if current['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+                regressions.append(f"{stage} {current['peak_rss_mb'] / before['peak_rss_mb']:.2f}x more memory")
+        print(line)
+    if previous is None:
+        print("  (no baseline for this size)")
+    elif previous['kpi_digest'] != result['kpi_digest']:
+        regressions.append("KPI output differs from the baseline")
+    for regression in regressions:
+        print(f"  REGRESSION: {regression}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage throughput and memory on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000], help='orders per run')
+    parser.add_argument('--category-skew', type=float, default=0.0)
+    parser.add_argument('--date-skew', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--part-rows', type=int, default=100_000, help='rows per generated part file')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='transformed file format')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per stage (the median is kept)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown or memory growth')
+    parser.add_argument('--child', choices=list(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument('--folder', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.folder, args.format)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {run_key(orders, args): run_size(orders, args) for orders in args.sizes}
+    regressions = [problem for key, result in results.items() for problem in compare(key, result, baseline,
+                                                                                      args.tolerance)]
+
+    if args.save_baseline:
+        import pandas as pd
+        baseline.setdefault('runs', {}).update(results)
+        baseline['environment'] = {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        }
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nBaseline saved to {args.baseline}")
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
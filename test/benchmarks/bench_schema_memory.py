@@ -0,0 +1,82 @@
+# Per-row memory and read time of each stage's inputs, with and without the declared schema
+#
+#   python test/benchmarks/bench_schema_memory.py --copies 10
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'common'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'containers', 'transform'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts', 'containers', 'compute'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from schema import read_csv  # noqa: E402
+from transform_data import INPUT_COLUMNS, transform_order_items, transform_orders  # noqa: E402
+from compute_kpis import ORDER_ITEMS_COLUMNS, ORDERS_COLUMNS  # noqa: E402
+
+
+def merged_csv(folder, copies):
+    """The sample parts of one type concatenated `copies` times, as CSV bytes"""
+    files = sorted(glob.glob(os.path.join(REPO_ROOT, 'data', folder, '*.csv')),
+                   key=lambda path: int(path.rsplit('part', 1)[1].split('.')[0]))
+    df = pd.concat([pd.read_csv(path) for path in files], ignore_index=True)
+    return pd.concat([df] * copies, ignore_index=True).to_csv(index=False).encode('utf-8')
+
+
+def measure(read):
+    start = time.perf_counter()
+    df = read()
+    elapsed = time.perf_counter() - start
+    return df, df.memory_usage(index=False, deep=True).sum() / max(len(df), 1), elapsed
+
+
+def legacy_raw(data):
+    """What the transform container used to hold: every column, timestamps parsed by inference"""
+    df = pd.read_csv(io.BytesIO(data))
+    for col in ('created_at', 'shipped_at', 'delivered_at', 'returned_at'):
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory per row with and without the declared schema')
+    parser.add_argument('--copies', type=int, default=10, help='how many times to repeat the sample data')
+    args = parser.parse_args()
+
+    products_df = pd.read_csv(os.path.join(REPO_ROOT, 'data', 'products.csv'))
+    print(f"{'file':<26} {'rows':>8} | {'before B/row':>12} {'read s':>7} | {'schema B/row':>12} {'read s':>7} | {'saved':>6}")
+    for name, folder, transform, compute_columns in (
+            ('orders', 'orders', transform_orders, ORDERS_COLUMNS),
+            ('order_items', 'order_items', lambda df: transform_order_items(df, products_df.copy()),
+             ORDER_ITEMS_COLUMNS)):
+        data = merged_csv(folder, args.copies)
+        rows = []
+        # Transform input: raw merged file
+        before, before_bytes, before_seconds = measure(lambda: legacy_raw(data))
+        after, after_bytes, after_seconds = measure(lambda: read_csv(data, name, columns=INPUT_COLUMNS[name]))
+        rows.append((f'{name} (transform in)', len(after), before_bytes, before_seconds, after_bytes, after_seconds))
+
+        # Compute input: transformed file, only the KPI columns
+        before_transformed = transform(before)[0].to_csv(index=False).encode('utf-8')
+        after_transformed = transform(after)[0].to_csv(index=False).encode('utf-8')
+        _, before_bytes, before_seconds = measure(
+            lambda: pd.read_csv(io.BytesIO(before_transformed), usecols=compute_columns))
+        _, after_bytes, after_seconds = measure(
+            lambda: read_csv(after_transformed, f'{name}_transformed', columns=compute_columns))
+        rows.append((f'{name} (compute in)', len(after), before_bytes, before_seconds, after_bytes, after_seconds))
+
+        for label, count, before_bytes, before_seconds, after_bytes, after_seconds in rows:
+            print(f"{label:<26} {count:>8} | {before_bytes:>12.1f} {before_seconds:>7.3f} | "
+                  f"{after_bytes:>12.1f} {after_seconds:>7.3f} | {1 - after_bytes / before_bytes:>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# End-to-end latency of the micro-batch stream mode: part files are announced on the in-process
+# queue at a steady rate, and each file's latency runs from its arrival to the flush that folds it
+# into the running per-day KPIs. Every flush setting is also checked against the KPIs computed from
+# the whole day at once, so a faster setting cannot quietly change the results.
+#
+#   python test/benchmarks/bench_stream_latency.py --orders 50000 --part-rows 2000 --rate 20
+#   python test/benchmarks/bench_stream_latency.py --flush-seconds 0.5 2 10 --flush-rows 1000000
+import argparse
+import asyncio
+import contextlib
+import glob
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.append(os.path.join(REPO_ROOT, 'scripts', 'containers', 'stream'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+# The stream mode must use the folders given here, not the shell's settings
+for name in ('KPI_STATE_PATH', 'STREAM_STATE_PATH', 'STREAM_OUTPUT_PATH', 'STREAM_LOAD_FUNCTION',
+             'PRODUCTS_CACHE_PATH', 'DISTINCT_COUNT_MODE'):
+    os.environ.pop(name, None)
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from stream_pipeline import MicroBatchConsumer, latency_summary  # noqa: E402
+from event_sources import LocalQueueSource  # noqa: E402
+from transform_data import read_table, transform_orders, transform_order_items  # noqa: E402
+from compute_kpis import compute_category_kpis, compute_order_kpis, kpis_from_partials, load_state  # noqa: E402
+from generate_data import generate  # noqa: E402
+
+
+def part_paths(folder, manifest):
+    """Order and order item parts interleaved, the way producers upload them through the day"""
+    orders = [os.path.join(folder, 'orders', name) for name in manifest['files']['orders']]
+    items = [os.path.join(folder, 'order_items', name) for name in manifest['files']['order_items']]
+    paths = []
+    for index in range(max(len(orders), len(items))):
+        paths.extend(kind[index] for kind in (orders, items) if index < len(kind))
+    return paths
+
+
+async def produce(source, paths, rate):
+    """Announce one file every 1/rate seconds, then close the source"""
+    start = time.monotonic()
+    for index, path in enumerate(paths):
+        await asyncio.sleep(max(0.0, start + index / rate - time.monotonic()))
+        source.put(path)
+    source.close()
+
+
+async def stream(paths, products_file, rate, flush_seconds, flush_rows, workers, state_path):
+    source = LocalQueueSource()
+    consumer = MicroBatchConsumer(source, products_file, flush_seconds=flush_seconds, flush_rows=flush_rows,
+                                  workers=workers, state_path=state_path, output_path='')
+    await asyncio.gather(produce(source, paths, rate), consumer.run())
+    return consumer
+
+
+def batch_kpis(folder, manifest, products_file):
+    """KPIs of the whole day computed at once, as the daily pipeline does"""
+    frames = {}
+    for kind in ('orders', 'order_items'):
+        frames[kind] = pd.concat([read_table(os.path.join(folder, kind, name), kind)
+                                  for name in manifest['files'][kind]], ignore_index=True)
+    orders_df, _ = transform_orders(frames['orders'])
+    order_items_df, _ = transform_order_items(frames['order_items'], read_table(products_file, 'products'))
+    return compute_category_kpis(order_items_df), compute_order_kpis(order_items_df, orders_df)
+
+
+def running_kpis(state_path):
+    """KPIs from every per-day state the stream mode has written"""
+    states = {}
+    for path in glob.glob(os.path.join(state_path, 'order_date=*.json')):
+        order_date = os.path.basename(path)[len('order_date='):-len('.json')]
+        states[order_date] = load_state(state_path, order_date)
+    return kpis_from_partials(states)
+
+
+def same_kpis(expected, actual, keys):
+    """Both tables hold the same rows, numbers compared to 1e-9"""
+    expected = expected.drop(columns='computed_at').assign(order_date=lambda df: df['order_date'].astype(str))
+    actual = actual.drop(columns='computed_at')
+    expected = expected.sort_values(keys, ignore_index=True)
+    actual = actual.sort_values(keys, ignore_index=True)
+    if len(expected) != len(actual) or not (expected[keys].to_numpy() == actual[keys].to_numpy()).all():
+        return False
+    values = [column for column in expected.columns if column not in keys]
+    return np.allclose(expected[values].to_numpy(dtype=float), actual[values].to_numpy(dtype=float),
+                       rtol=1e-9, equal_nan=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Arrival-to-KPI latency of the micro-batch stream mode')
+    parser.add_argument('--orders', type=int, default=20_000)
+    parser.add_argument('--part-rows', type=int, default=1_000, help='rows per part file')
+    parser.add_argument('--days', type=int, default=3, help='order dates covered by the parts')
+    parser.add_argument('--rate', type=float, default=20.0, help='part files announced per second')
+    parser.add_argument('--flush-seconds', type=float, nargs='+', default=[0.5, 2.0, 5.0])
+    parser.add_argument('--flush-rows', type=int, default=100_000)
+    parser.add_argument('--workers', type=int, default=2, help='files prepared at the same time')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as folder:
+        # The stream mode only picks up parts laid out as data/<date>/orders/ and data/<date>/order_items/
+        parts = os.path.join(folder, 'data', 'parts')
+        manifest = generate(parts, args.orders, part_rows=args.part_rows, days=args.days, seed=args.seed)
+        products_file = os.path.join(parts, 'products.csv')
+        paths = part_paths(parts, manifest)
+        expected_category, expected_order = batch_kpis(parts, manifest, products_file)
+        print(f"{len(paths)} part files ({manifest['rows']['orders']} orders, {manifest['rows']['order_items']} "
+              f"items) at {args.rate:g} files/s, flush at {args.flush_rows} rows or:")
+        print(f"{'flush s':>8} {'flushes':>8} {'p50 s':>8} {'p95 s':>8} {'max s':>8} {'wall s':>8}  KPIs")
+
+        failed = False
+        for flush_seconds in args.flush_seconds:
+            state_path = tempfile.mkdtemp(dir=folder)
+            start = time.perf_counter()
+            # Each flush prints its metrics record; keep them out of the table
+            with contextlib.redirect_stdout(io.StringIO()):
+                consumer = asyncio.run(stream(paths, products_file, args.rate, flush_seconds, args.flush_rows,
+                                              args.workers, state_path))
+            wall = time.perf_counter() - start
+            summary = latency_summary(consumer.latencies)
+            category_kpis, order_kpis = running_kpis(state_path)
+            same = (len(consumer.latencies) == len(paths)
+                    and same_kpis(expected_category, category_kpis, ['category', 'order_date'])
+                    and same_kpis(expected_order, order_kpis, ['order_date']))
+            failed = failed or not same
+            print(f"{flush_seconds:>8g} {len(consumer.flushes):>8} {summary['latency_p50_seconds']:>8.3f} "
+                  f"{summary['latency_p95_seconds']:>8.3f} {summary['latency_max_seconds']:>8.3f} {wall:>8.2f}  "
+                  f"{'same as batch' if same else 'DIFFERENT from batch'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
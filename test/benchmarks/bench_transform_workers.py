@@ -0,0 +1,109 @@
+# Scaling of the parallel transform (TRANSFORM_WORKERS) with the number of workers. A generated day
+# is merged into one orders and one order items file, each is read unconverted and transformed with
+# every worker count, and the output written as CSV and Parquet must be byte-identical to the serial
+# transform's. Run it on the CPU count being considered for transform-task.json: speedup stops where
+# the workers outnumber the cores.
+#
+#   python test/benchmarks/bench_transform_workers.py --orders 1000000 --workers 1 2 4 8
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..', '..'))
+sys.path.append(os.path.join(REPO_ROOT, 'scripts', 'containers', 'transform'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.pop('PRODUCTS_CACHE_PATH', None)
+
+import pandas as pd  # noqa: E402
+import transform_data  # noqa: E402
+from transform_data import INPUT_COLUMNS, build_products_dimension, read_table, transform_parallel  # noqa: E402
+from generate_data import generate  # noqa: E402
+
+# Every run stamps the same transformed_at, so outputs of different runs can be compared byte for byte
+TRANSFORMED_AT = '2025-04-09T00:00:00+00:00'
+
+
+class FixedClock:
+    """Stand-in for transform_data.datetime that always returns TRANSFORMED_AT"""
+
+    @staticmethod
+    def now(tz=None):
+        return pd.Timestamp(TRANSFORMED_AT).to_pydatetime()
+
+
+def merge(folder, manifest, kind, path):
+    """Concatenate one kind's parts into a single merged CSV, as the merge Lambda does"""
+    frames = [pd.read_csv(os.path.join(folder, kind, name), dtype=str, keep_default_na=False)
+              for name in manifest['files'][kind]]
+    pd.concat(frames, ignore_index=True).to_csv(path, index=False)
+
+
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def output_digests(df, folder, name):
+    """SHA-256 of the transformed frame written as CSV and as Parquet"""
+    digests = []
+    for extension in ('csv', 'parquet'):
+        path = os.path.join(folder, f'{name}.{extension}')
+        if extension == 'csv':
+            df.to_csv(path, index=False)
+        else:
+            df.to_parquet(path, index=False, compression=transform_data.PARQUET_COMPRESSION)
+        digests.append(digest(path))
+    return digests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel transform speedup by worker count')
+    parser.add_argument('--orders', type=int, default=300_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--chunk-rows', type=int, default=transform_data.TRANSFORM_CHUNK_ROWS,
+                        help='largest row chunk handed to one worker')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    transform_data.datetime = FixedClock
+
+    with tempfile.TemporaryDirectory() as folder:
+        source = os.path.join(folder, 'source')
+        manifest = generate(source, args.orders, part_rows=100_000, seed=args.seed)
+        products = build_products_dimension(read_table(os.path.join(source, 'products.csv'), 'products'))
+        print(f"{os.cpu_count()} CPUs, {manifest['rows']['orders']} orders and "
+              f"{manifest['rows']['order_items']} order items, chunks of at most {args.chunk_rows} rows")
+        print(f"{'kind':>12} {'workers':>8} {'seconds':>8} {'rows/s':>10} {'speedup':>8}  output")
+
+        failed = False
+        for kind in ('orders', 'order_items'):
+            merged = os.path.join(folder, f'{kind}.csv')
+            merge(source, manifest, kind, merged)
+            expected = baseline = None
+            for workers in args.workers:
+                df = read_table(merged, kind, columns=INPUT_COLUMNS[kind], strict=False)
+                start = time.perf_counter()
+                transformed, _ = transform_parallel(df, kind, products, workers=workers, chunk_rows=args.chunk_rows)
+                seconds = time.perf_counter() - start
+                digests = output_digests(transformed, folder, f'{kind}_{workers}')
+                if expected is None:
+                    # The serial transform of the strictly typed read, as the container ran it before
+                    serial, _ = transform_parallel(read_table(merged, kind, columns=INPUT_COLUMNS[kind]), kind,
+                                                   products, workers=1)
+                    expected = output_digests(serial, folder, f'{kind}_serial')
+                    baseline = seconds
+                same = digests == expected
+                failed = failed or not same
+                print(f"{kind:>12} {workers:>8} {seconds:>8.2f} {len(df) / seconds:>10.0f} "
+                      f"{baseline / seconds:>7.2f}x  {'identical' if same else 'DIFFERENT'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
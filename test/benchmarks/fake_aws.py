@@ -0,0 +1,247 @@
+# In-process stand-ins for the AWS clients used by the Lambdas, for local benchmarks
+import datetime
+import io
+import random
+import threading
+import time
+import types
+
+from botocore.exceptions import ClientError
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class FakeS3Exceptions:
+    NoSuchKey = NoSuchKey
+    ClientError = ClientError
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeStreamingBody:
+    """Mimic botocore's StreamingBody, optionally throttled to a bandwidth in bytes/sec"""
+
+    def __init__(self, data, bandwidth=None):
+        self._stream = io.BytesIO(data)
+        self._bandwidth = bandwidth
+
+    def _throttle(self, nbytes):
+        if self._bandwidth:
+            time.sleep(nbytes / self._bandwidth)
+
+    def read(self, amt=None):
+        data = self._stream.read(-1 if amt is None else amt)
+        self._throttle(len(data))
+        return data
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class FakeS3:
+    """Dictionary-backed S3 client with an injected per-request latency"""
+
+    exceptions = FakeS3Exceptions
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.objects = {}
+        self.modified = {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_object(self, Bucket, Key):
+        self._request()
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(f"{Bucket}/{Key}")
+        data = self.objects[(Bucket, Key)]
+        return {
+            'Body': FakeStreamingBody(data, self.bandwidth),
+            'ContentLength': len(data),
+            'ETag': f'"{hash(data) & 0xffffffff:08x}"'
+        }
+
+    def head_object(self, Bucket, Key):
+        self._request()
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(f"{Bucket}/{Key}")
+        data = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(data), 'ETag': self._etag(Bucket, Key),
+                'LastModified': self.modified.get((Bucket, Key), datetime.datetime.now(datetime.timezone.utc))}
+
+    def _etag(self, bucket, key):
+        return f'"{hash(self.objects[(bucket, key)]) & 0xffffffff:08x}"'
+
+    def _check_conditions(self, Bucket, Key, operation, IfMatch=None, IfNoneMatch=None):
+        """S3 conditional requests: If-None-Match '*' only creates, If-Match needs the current ETag"""
+        exists = (Bucket, Key) in self.objects
+        if IfNoneMatch == '*' and exists:
+            raise client_error('PreconditionFailed', operation)
+        if IfMatch is not None:
+            if not exists:
+                raise client_error('NoSuchKey', operation)
+            if IfMatch != self._etag(Bucket, Key):
+                raise client_error('PreconditionFailed', operation)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self._request()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif not isinstance(Body, (bytes, bytearray)):
+            Body = Body.read()
+        with self._lock:
+            self._check_conditions(Bucket, Key, 'PutObject', IfMatch, IfNoneMatch)
+            self.objects[(Bucket, Key)] = bytes(Body)
+            self.modified[(Bucket, Key)] = datetime.datetime.now(datetime.timezone.utc)
+            return {'ETag': self._etag(Bucket, Key)}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        return self.put_object(Bucket, Key, self.get_object(CopySource['Bucket'], CopySource['Key'])['Body'].read())
+
+    def delete_object(self, Bucket, Key, IfMatch=None):
+        self._request()
+        with self._lock:
+            self._check_conditions(Bucket, Key, 'DeleteObject', IfMatch)
+            self.objects.pop((Bucket, Key), None)
+            self.modified.pop((Bucket, Key), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._request()
+        with self._lock:
+            upload_id = str(len(self._uploads) + 1)
+            self._uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        self._request()
+        self._uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request()
+        parts = self._uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request()
+        self._uploads.pop(UploadId, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._request()
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)]),
+                              'ETag': f'"{hash(self.objects[(Bucket, key)]) & 0xffffffff:08x}"'} for key in keys],
+                'KeyCount': len(keys), 'IsTruncated': False}
+
+
+class FakeDynamoDBClient:
+    """BatchWriteItem stand-in with per-request latency and a fraction of items returned unprocessed"""
+
+    def __init__(self, latency=0.0, unprocessed_rate=0.0, key_attributes=None, seed=0, store=True):
+        self.tables = {}
+        # With store=False items are validated and counted but not kept, for memory measurements
+        self.store = store
+        self.items_written = 0
+        self.latency = latency
+        self.unprocessed_rate = unprocessed_rate
+        # Table name -> key attribute names; items are stored under their key values
+        self.key_attributes = key_attributes or {}
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _key(self, table_name, item):
+        names = self.key_attributes.get(table_name) or sorted(item)
+        return tuple(item[name] for name in names)
+
+    def batch_write_item(self, RequestItems):
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise ValueError("Too many items requested for the BatchWriteItem call")
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        unprocessed = {}
+        with self._lock:
+            for table_name, requests in RequestItems.items():
+                for request in requests:
+                    item = request['PutRequest']['Item']
+                    # boto3 refuses Python floats; mirror that so conversion bugs surface here
+                    if any(isinstance(value, float) for value in item.values()):
+                        raise TypeError("Float types are not supported. Use Decimal types instead.")
+                    if self._random.random() < self.unprocessed_rate:
+                        unprocessed.setdefault(table_name, []).append(request)
+                    else:
+                        self.items_written += 1
+                        if self.store:
+                            self.tables.setdefault(table_name, {})[self._key(table_name, item)] = item
+        return {'UnprocessedItems': unprocessed}
+
+
+class FakeBatchWriter:
+    """boto3's Table.batch_writer(): buffer 25 puts and resend unprocessed items without backoff"""
+
+    def __init__(self, client, table_name):
+        self._client = client
+        self._table_name = table_name
+        self._buffer = []
+
+    def put_item(self, Item):
+        self._buffer.append({'PutRequest': {'Item': Item}})
+        if len(self._buffer) >= 25:
+            self._flush()
+
+    def _flush(self):
+        batch, self._buffer = self._buffer[:25], self._buffer[25:]
+        response = self._client.batch_write_item(RequestItems={self._table_name: batch})
+        self._buffer.extend(response['UnprocessedItems'].get(self._table_name, []))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        while self._buffer:
+            self._flush()
+
+
+class FakeTable:
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+
+    @property
+    def key_schema(self):
+        return [{'AttributeName': name, 'KeyType': 'HASH' if i == 0 else 'RANGE'}
+                for i, name in enumerate(self._client.key_attributes[self.name])]
+
+    def batch_writer(self):
+        return FakeBatchWriter(self._client, self.name)
+
+
+class FakeDynamoDBResource:
+    """boto3.resource('dynamodb') stand-in exposing Table() and meta.client"""
+
+    def __init__(self, client):
+        self.meta = types.SimpleNamespace(client=client)
+
+    def Table(self, name):
+        return FakeTable(self.meta.client, name)
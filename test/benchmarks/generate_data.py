@@ -0,0 +1,203 @@
+# Generate a synthetic day of e-commerce data in the same shape as data/: manifest-style part
+# files for orders and order items plus a products file, at any size.
+#
+#   python test/benchmarks/generate_data.py /tmp/synthetic --orders 1000000 --category-skew 1.2
+#
+# Rows are generated in blocks, so memory stays flat however many orders are asked for.
+# The same arguments and seed always produce the same files.
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Category -> department, as in data/products.csv
+CATEGORIES = {
+    'Beauty': 'Personal Care',
+    'Books': 'Media',
+    'Clothing': 'Fashion',
+    'Electronics': 'Tech',
+    'Home & Kitchen': 'Home',
+    'Sports': 'Outdoors',
+    'Toys': 'Kids',
+}
+BRANDS = ['Acme', 'Globex', 'Initech', 'Soylent', 'Stark', 'Umbrella', 'Wonka']
+HOUR = 3600
+DAY = 24 * HOUR
+# Rows generated per block; parts are cut from the blocks
+BLOCK_ORDERS = 250_000
+
+
+def zipf_weights(n, skew):
+    """Probability of each of n ranks, falling off as 1 / rank**skew (skew 0 is uniform)"""
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def timestamps(seconds, present=None):
+    """Raw-file timestamp strings (2025-03-30T16:14:26) for epoch seconds, empty where not present"""
+    text = np.datetime_as_string(np.asarray(seconds, dtype='datetime64[s]'), unit='s').astype(object)
+    if present is not None:
+        text[~present] = ''
+    return text
+
+
+def generate_products(count, category_skew, rng):
+    """Products table; the category skew decides how often each category's products are sold"""
+    names = list(CATEGORIES)
+    category = rng.integers(0, len(names), count)
+    retail_price = np.round(rng.uniform(10, 150, count), 2)
+    products = pd.DataFrame({
+        'id': np.arange(1, count + 1),
+        'sku': [f"SKU-{index:08d}" for index in range(1, count + 1)],
+        'cost': np.round(retail_price * rng.uniform(0.3, 0.7, count), 2),
+        'category': np.asarray(names, dtype=object)[category],
+        'name': [f"Product {index}" for index in range(1, count + 1)],
+        'brand': np.asarray(BRANDS, dtype=object)[rng.integers(0, len(BRANDS), count)],
+        'retail_price': retail_price,
+        'department': [CATEGORIES[names[code]] for code in category],
+    })
+    # Spread each category's share evenly over its products
+    category_share = zipf_weights(len(names), category_skew)[category]
+    per_category = np.bincount(category, minlength=len(names))[category]
+    popularity = category_share / per_category
+    return products, popularity / popularity.sum()
+
+
+def generate_block(first_order_id, count, first_item_id, start, days, date_weights, products, popularity,
+                   users, return_rate, rng):
+    """One block of orders and their items"""
+    order_id = np.arange(first_order_id, first_order_id + count)
+    user_id = rng.integers(1, users + 1, count)
+    num_of_item = rng.integers(1, 6, count)
+    created = (start + rng.choice(days, count, p=date_weights) * DAY + rng.integers(0, DAY, count))
+    returned = rng.random(count) < return_rate
+
+    shipped = created + rng.integers(1, 49, count) * HOUR
+    delivered = shipped + rng.integers(12, 73, count) * HOUR
+    # A few orders are still in transit; returned orders always arrived first
+    in_transit = (rng.random(count) < 0.01) & ~returned
+    returned_at = delivered + rng.integers(24, 121, count) * HOUR
+    orders = pd.DataFrame({
+        'order_id': order_id,
+        'user_id': user_id,
+        'status': np.where(returned, 'returned', 'delivered'),
+        'created_at': timestamps(created),
+        'returned_at': timestamps(returned_at, returned),
+        'shipped_at': timestamps(shipped),
+        'delivered_at': timestamps(delivered, ~in_transit),
+        'num_of_item': num_of_item,
+    })
+
+    # Items belong to one order and are created within the hour after it
+    parent = np.repeat(np.arange(count), num_of_item)
+    items = len(parent)
+    item_created = created[parent] + rng.integers(0, 61, items) * 60
+    item_shipped = item_created + rng.integers(2, 25, items) * HOUR
+    item_delivered = item_shipped + rng.integers(6, 73, items) * HOUR
+    # Most items of a returned order come back with it
+    item_returned = returned[parent] & (rng.random(items) < 0.8)
+    item_returned_at = item_created + rng.integers(34, 216, items) * HOUR
+    product = rng.choice(len(products), items, p=popularity)
+    sale_price = np.round(products['retail_price'].to_numpy()[product] * rng.uniform(0.8, 1.0, items), 2)
+    order_items = pd.DataFrame({
+        'id': np.arange(first_item_id, first_item_id + items),
+        'order_id': order_id[parent],
+        'user_id': user_id[parent],
+        'product_id': products['id'].to_numpy()[product],
+        'status': np.where(item_returned, 'returned', 'delivered'),
+        'created_at': timestamps(item_created),
+        'shipped_at': timestamps(item_shipped),
+        'delivered_at': timestamps(item_delivered),
+        'returned_at': timestamps(item_returned_at, item_returned),
+        'sale_price': sale_price,
+    })
+    return orders, order_items
+
+
+class PartWriter:
+    """Append rows to numbered part files of at most part_rows rows each"""
+
+    def __init__(self, folder, name, part_rows):
+        self.folder = os.path.join(folder, name)
+        self.name = name
+        self.part_rows = part_rows
+        self.files = []
+        self.rows_in_part = part_rows
+        os.makedirs(self.folder, exist_ok=True)
+
+    def write(self, df):
+        while len(df):
+            if self.rows_in_part == self.part_rows:
+                self.files.append(f"{self.name}_part{len(self.files) + 1}.csv")
+                self.rows_in_part = 0
+            take = min(len(df), self.part_rows - self.rows_in_part)
+            # A new part starts with the header and replaces any file left from an earlier run
+            first = self.rows_in_part == 0
+            df.iloc[:take].to_csv(os.path.join(self.folder, self.files[-1]), mode='w' if first else 'a',
+                                  index=False, header=first)
+            self.rows_in_part += take
+            df = df.iloc[take:]
+
+
+def generate(folder, orders, part_rows=100_000, products=10_000, days=31, end_date='2025-04-07', users=10_000,
+             category_skew=0.0, date_skew=0.0, return_rate=0.2, seed=42):
+    """Write a synthetic dataset to folder and return its manifest.
+
+    category_skew and date_skew are Zipf exponents: 0 spreads sales evenly, larger values put more
+    of them in the first category and on the most recent days.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    products_df, popularity = generate_products(products, category_skew, rng)
+    products_df.to_csv(os.path.join(folder, 'products.csv'), index=False)
+
+    end = int(pd.Timestamp(end_date).timestamp()) // DAY * DAY
+    start = end - (days - 1) * DAY
+    # Rank 1 is the most recent day
+    date_weights = zipf_weights(days, date_skew)[::-1]
+    writers = {name: PartWriter(folder, name, part_rows) for name in ('orders', 'order_items')}
+    rows = {'orders': 0, 'order_items': 0}
+    for first in range(0, orders, BLOCK_ORDERS):
+        block = generate_block(first + 1, min(BLOCK_ORDERS, orders - first), rows['order_items'] + 1, start, days,
+                               date_weights, products_df, popularity, users, return_rate, rng)
+        for name, df in zip(('orders', 'order_items'), block):
+            writers[name].write(df)
+            rows[name] += len(df)
+
+    manifest = {
+        'date': end_date.replace('-', ''),
+        'files': {name: writer.files for name, writer in writers.items()},
+        'rows': rows,
+    }
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic orders, order items and products')
+    parser.add_argument('folder', help='output folder (orders/, order_items/, products.csv, manifest.json)')
+    parser.add_argument('--orders', type=int, default=10_000, help='orders to generate (about 3 items each)')
+    parser.add_argument('--part-rows', type=int, default=100_000, help='rows per part file')
+    parser.add_argument('--products', type=int, default=10_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--days', type=int, default=31, help='order dates covered, ending at --end-date')
+    parser.add_argument('--end-date', default='2025-04-07')
+    parser.add_argument('--category-skew', type=float, default=0.0, help='Zipf exponent over categories')
+    parser.add_argument('--date-skew', type=float, default=0.0, help='Zipf exponent over days, newest first')
+    parser.add_argument('--return-rate', type=float, default=0.2, help='share of orders returned')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    manifest = generate(args.folder, args.orders, part_rows=args.part_rows, products=args.products,
+                        days=args.days, end_date=args.end_date, users=args.users,
+                        category_skew=args.category_skew, date_skew=args.date_skew,
+                        return_rate=args.return_rate, seed=args.seed)
+    for name, files in manifest['files'].items():
+        print(f"{name}: {manifest['rows'][name]} rows in {len(files)} part files")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+# Recompute the KPIs from the sample data and compare them with the DynamoDB exports in test_result/
+#
+#   python test/check_kpi_parity.py
+import glob
+import math
+import os
+import sys
+import tempfile
+from decimal import ROUND_HALF_EVEN, Decimal
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(HERE, '..'))
+sys.path.append(os.path.join(REPO_ROOT, 'scripts', 'containers', 'transform'))
+sys.path.append(os.path.join(REPO_ROOT, 'scripts', 'containers', 'compute'))
+sys.path.append(os.path.join(REPO_ROOT, 'scripts', 'containers', 'shard'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import pandas as pd  # noqa: E402
+from transform_data import transform_orders, transform_order_items, write_partitioned  # noqa: E402
+from compute_kpis import (ORDERS_COLUMNS, ORDER_ITEMS_COLUMNS, REVENUE_DECIMALS,  # noqa: E402
+                          compute_category_kpis, compute_order_kpis, read_input)
+from shard_pipeline import aggregate_shard, combine_shards, partition_file  # noqa: E402
+
+EXPORTS = os.path.join(HERE, 'test_result', 'dynamo_result')
+# DynamoDB exports round numbers to about 15 significant digits
+REL_TOLERANCE = 1e-12
+# Sharded mode must give the same KPIs however the orders are split
+SHARD_COUNTS = (1, 3, 8)
+
+
+def read_parts(folder):
+    """Read the sample part files of one type in part order"""
+    files = sorted(glob.glob(os.path.join(REPO_ROOT, 'data', folder, '*.csv')),
+                   key=lambda path: int(path.rsplit('part', 1)[1].split('.')[0]))
+    return pd.concat([pd.read_csv(path) for path in files], ignore_index=True)
+
+
+def compare(name, computed, exported, keys):
+    """Compare every exported row with the computed row for the same key"""
+    computed = computed.assign(order_date=computed['order_date'].astype(str)).set_index(keys)
+    exported = exported.set_index(keys)
+    missing_cols = sorted(set(exported.columns) - set(computed.columns))
+    problems = [f"missing columns {missing_cols}"] if missing_cols else []
+    for key, row in exported.iterrows():
+        if key not in computed.index:
+            problems.append(f"{key}: not computed")
+            continue
+        for column, expected in row.items():
+            actual = computed.at[key, column]
+            if not math.isclose(float(actual), float(expected), rel_tol=REL_TOLERANCE):
+                problems.append(f"{key} {column}: expected {expected}, got {actual}")
+    status = "OK" if not problems else "MISMATCH"
+    print(f"{name}: {len(exported)} exported rows checked, {status}")
+    for problem in problems[:20]:
+        print(f"  {problem}")
+    return not problems
+
+
+def sharded_kpis(orders_file, order_items_file, products_file, shard_count):
+    """Run the partition, aggregate and combine steps locally"""
+    with tempfile.TemporaryDirectory() as prefix:
+        partition_file(orders_file, 'orders', prefix, shard_count)
+        partition_file(order_items_file, 'order_items', prefix, shard_count)
+        for index in range(shard_count):
+            aggregate_shard(prefix, index, products_file)
+        category_kpis, order_kpis, _ = combine_shards(prefix, shard_count, state_path='')
+    return category_kpis, order_kpis
+
+
+def sub_cent_prices(order_items):
+    """Order items with a third price decimal, half of them exactly on a half cent"""
+    extra = [0.005 if index % 2 else 0.003 for index in range(len(order_items))]
+    return order_items.assign(sale_price=(order_items['sale_price'] + extra).round(3))
+
+
+def rounded_half_even(prices):
+    """Reference rounding of each price to REVENUE_DECIMALS, through Decimal"""
+    quantum = Decimal(1).scaleb(-REVENUE_DECIMALS)
+    return [float(Decimal(repr(price)).quantize(quantum, ROUND_HALF_EVEN)) for price in prices]
+
+
+def as_expected(df, table):
+    """Computed KPIs in place of an export: the exported columns, with order_date as text"""
+    columns = pd.read_csv(os.path.join(EXPORTS, table), nrows=0).columns
+    return df.assign(order_date=df['order_date'].astype(str))[list(columns)]
+
+
+def batch_half(df, batch):
+    """Rows of the 'odd' or 'even' batch, split by order id like two runs' uploads"""
+    return df[(df['order_id'] % 2 == 1) == (batch == 'odd')]
+
+
+def partitioned_kpis(orders_df, order_items_df, folder, date_from='', date_to='', batch_id=''):
+    """Write both transformed frames into order_date datasets as two batches and compute from the
+    batch's files, or from every batch's partitions in range"""
+    orders_dataset = os.path.join(folder, 'orders_transformed') + '/'
+    order_items_dataset = os.path.join(folder, 'order_items_transformed') + '/'
+    for batch in ('odd', 'even'):
+        write_partitioned(batch_half(orders_df, batch), orders_dataset, batch)
+        write_partitioned(batch_half(order_items_df, batch), order_items_dataset, batch)
+    orders_df = read_input(orders_dataset, 'orders_transformed', columns=ORDERS_COLUMNS,
+                           date_from=date_from, date_to=date_to, batch_id=batch_id)
+    order_items_df = read_input(order_items_dataset, 'order_items_transformed', columns=ORDER_ITEMS_COLUMNS,
+                                date_from=date_from, date_to=date_to, batch_id=batch_id)
+    return compute_category_kpis(order_items_df), compute_order_kpis(order_items_df, orders_df)
+
+
+def main():
+    products_df = pd.read_csv(os.path.join(REPO_ROOT, 'data', 'products.csv'))
+    orders_df, _ = transform_orders(read_parts('orders'))
+    order_items_df, _ = transform_order_items(read_parts('order_items'), products_df)
+
+    category_kpis = compute_category_kpis(order_items_df)
+    order_kpis = compute_order_kpis(order_items_df, orders_df)
+
+    ok = compare('category-level', category_kpis,
+                 pd.read_csv(os.path.join(EXPORTS, 'category-level-table.csv')), ['category', 'order_date'])
+    ok = compare('order-level', order_kpis,
+                 pd.read_csv(os.path.join(EXPORTS, 'order-level-table.csv')), ['order_date']) and ok
+
+    with tempfile.TemporaryDirectory() as folder:
+        orders_file = os.path.join(folder, 'orders.csv')
+        order_items_file = os.path.join(folder, 'order_items.csv')
+        read_parts('orders').to_csv(orders_file, index=False)
+        read_parts('order_items').to_csv(order_items_file, index=False)
+        for shard_count in SHARD_COUNTS:
+            category_kpis, order_kpis = sharded_kpis(orders_file, order_items_file,
+                                                     os.path.join(REPO_ROOT, 'data', 'products.csv'), shard_count)
+            ok = compare(f'category-level ({shard_count} shards)', category_kpis,
+                         pd.read_csv(os.path.join(EXPORTS, 'category-level-table.csv')),
+                         ['category', 'order_date']) and ok
+            ok = compare(f'order-level ({shard_count} shards)', order_kpis,
+                         pd.read_csv(os.path.join(EXPORTS, 'order-level-table.csv')), ['order_date']) and ok
+
+        # Partitioned datasets: every batch's partitions give the full result, a date range only those
+        # days, and a batch id without a range only that batch's rows
+        category_kpis, order_kpis = partitioned_kpis(orders_df, order_items_df, folder)
+        ok = compare('category-level (partitioned)', category_kpis,
+                     pd.read_csv(os.path.join(EXPORTS, 'category-level-table.csv')), ['category', 'order_date']) and ok
+        ok = compare('order-level (partitioned)', order_kpis,
+                     pd.read_csv(os.path.join(EXPORTS, 'order-level-table.csv')), ['order_date']) and ok
+        exported = pd.read_csv(os.path.join(EXPORTS, 'order-level-table.csv'))
+        dates = sorted(exported['order_date'].astype(str))
+        date_from, date_to = dates[len(dates) // 3], dates[len(dates) // 2]
+        category_kpis, order_kpis = partitioned_kpis(orders_df, order_items_df, folder, date_from, date_to)
+        in_range = lambda df: df[(df['order_date'] >= date_from) & (df['order_date'] <= date_to)]
+        ok = compare(f'order-level ({date_from} to {date_to})', order_kpis, in_range(exported), ['order_date']) and ok
+        if set(order_kpis['order_date'].astype(str)) != set(in_range(exported)['order_date']):
+            print(f"  computed dates outside {date_from} to {date_to}")
+            ok = False
+        category_kpis, order_kpis = partitioned_kpis(orders_df, order_items_df, folder, batch_id='even')
+        even_items = batch_half(order_items_df, 'even')
+        ok = compare('category-level (one batch)', category_kpis,
+                     as_expected(compute_category_kpis(even_items), 'category-level-table.csv'),
+                     ['category', 'order_date']) and ok
+        ok = compare('order-level (one batch)', order_kpis,
+                     as_expected(compute_order_kpis(even_items, batch_half(orders_df, 'even')), 'order-level-table.csv'),
+                     ['order_date']) and ok
+
+        # Prices with more decimals than REVENUE_DECIMALS are rounded half to even by the sharded
+        # partials, so they must match the staged KPIs of the prices rounded up front
+        order_items = sub_cent_prices(read_parts('order_items'))
+        order_items.to_csv(order_items_file, index=False, float_format='%.3f')
+        rounded_df, _ = transform_order_items(
+            order_items.assign(sale_price=rounded_half_even(order_items['sale_price'])), products_df)
+        category_kpis, order_kpis = sharded_kpis(orders_file, order_items_file,
+                                                 os.path.join(REPO_ROOT, 'data', 'products.csv'), 3)
+        ok = compare('category-level (sub-cent prices)', category_kpis,
+                     as_expected(compute_category_kpis(rounded_df), 'category-level-table.csv'), ['category', 'order_date']) and ok
+        ok = compare('order-level (sub-cent prices)', order_kpis,
+                     as_expected(compute_order_kpis(rounded_df, orders_df), 'order-level-table.csv'), ['order_date']) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()